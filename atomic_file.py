@@ -0,0 +1,15 @@
+import os
+
+
+# Writes the content to a temporary file next to the file, which then replaces it, so that
+# readers find either the old or the new content and never part of it. The content is synced
+# first, so that a crash cannot leave an empty file in place of either.
+def save_atomically(file_path, content):
+    temp_file_path = '{}.tmp'.format(file_path)
+
+    with open(temp_file_path, 'wt') as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_file_path, file_path)
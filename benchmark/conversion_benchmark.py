@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Compares converting and writing Elasticsearch pages one record at a time, as the generator
+# used to, with the batch conversion into URL and lastmod columns.
+#
+# Run from the repository root: python benchmark/conversion_benchmark.py [--pages N] [--pageSize N]
+
+import argparse
+import os
+import sys
+import timeit
+from collections import namedtuple
+from datetime import datetime
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elasticsearch_scan import ElasticsearchClient, convert_entry_datetime
+from site_map_writer import SiteMapWriter
+from models import SiteMapUrl
+
+BenchmarkConfig = namedtuple('BenchmarkConfig', [
+    'elasticsearch_url', 'base_page_url', 'url_change_frequency', 'es_max_connections', 'es_compression',
+    'es_sniff_interval', 'page_size', 'adaptive_page_size', 'max_retries', 'retry_backoff_seconds',
+    'max_requests_per_second', 'max_documents_per_second', 'record_file_path',
+])
+
+CONFIG = BenchmarkConfig(
+    elasticsearch_url='http://localhost:9200',
+    base_page_url='http://www.example.gov.uk/property',
+    url_change_frequency='weekly',
+    es_max_connections=10,
+    es_compression=False,
+    es_sniff_interval=0,
+    page_size=1000,
+    adaptive_page_size=False,
+    max_retries=3,
+    retry_backoff_seconds=1.0,
+    max_requests_per_second=0,
+    max_documents_per_second=0,
+    record_file_path=None,
+)
+
+def create_address_page(page_number, page_size):
+    return [
+        {
+            '_source': {
+                'postcode': 'EX{} {}RQ'.format(page_number % 10, i % 10),
+                'addressKey': '{}_RIVERSIDE_ROAD_EXETER_EX{}_{}RQ'.format(i, page_number % 10, i % 10),
+                'entryDatetime': '2014-06-{:02}T09:{:02}:38+00'.format(1 + i % 28, i % 60),
+            }
+        } for i in range(0, page_size)
+    ]
+
+
+def convert_per_record(address_page):
+    site_map_urls = []
+
+    for address in address_page:
+        data = address['_source']
+        postcode = data['postcode']
+        address_key = data['addressKey']
+        address_url_segment = address_key[:len(address_key) - len(postcode) - 1]
+        entry_datetime = datetime.strptime(data['entryDatetime'], '%Y-%m-%dT%H:%M:%S+00')
+
+        site_map_urls.append(SiteMapUrl(
+            location='{}/{}/{}'.format(CONFIG.base_page_url, postcode.replace(' ', '_'), address_url_segment),
+            last_modified=entry_datetime.strftime('%Y-%m-%dT%H:%M+00:00'),
+            change_frequency=CONFIG.url_change_frequency,
+        ))
+
+    return site_map_urls
+
+
+def run_per_record(address_pages):
+    writer = SiteMapWriter(BytesIO(), 'UTF-8')
+
+    for address_page in address_pages:
+        for url in convert_per_record(address_page):
+            writer.write_url(url.location, url.last_modified, url.change_frequency)
+
+    writer.close()
+
+
+def run_batch(address_pages, client):
+    writer = SiteMapWriter(BytesIO(), 'UTF-8')
+
+    for address_page in address_pages:
+        writer.write_url_page(client._convert_to_site_map_entries(address_page))
+
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks per-record against batch page conversion')
+    parser.add_argument('--pages', type=int, dest='pages', default=50)
+    parser.add_argument('--pageSize', type=int, dest='page_size', default=1000)
+    parser.add_argument('--repeat', type=int, dest='repeat', default=5)
+    args = parser.parse_args()
+
+    address_pages = [create_address_page(page_number, args.page_size) for page_number in range(0, args.pages)]
+    nof_records = args.pages * args.page_size
+
+    client = ElasticsearchClient(CONFIG)
+
+    per_record = min(timeit.repeat(lambda: run_per_record(address_pages), number=1, repeat=args.repeat))
+    batch = min(timeit.repeat(lambda: run_batch(address_pages, client), number=1, repeat=args.repeat))
+
+    print('records:    {}'.format(nof_records))
+    print('per record: {:.3f}s ({:,.0f} records/s)'.format(per_record, nof_records / per_record))
+    print('batch:      {:.3f}s ({:,.0f} records/s)'.format(batch, nof_records / batch))
+    print('speedup:    {:.2f}x'.format(per_record / batch))
+    print('datetime cache: {}'.format(convert_entry_datetime.cache_info()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+# Synthetic property documents served through the parts of the Elasticsearch API the generator
+# uses: search with scroll, sorted search with search_after, scroll, clear scroll and search shards. FakeElasticsearch stands in
+# for the client in process; FakeElasticsearchServer serves the same documents over HTTP, so that
+# transport and JSON decoding are measured too.
+#
+# Document i is derived from i alone, so any scale can be served without holding the documents
+# in memory and every run sees exactly the same data.
+
+import bisect
+import json
+import re
+import threading
+from array import array
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from sharding import POSTCODE_AREAS
+
+STREETS = [
+    'HIGH_STREET', 'STATION_ROAD', 'MAIN_STREET', 'PARK_ROAD', 'CHURCH_ROAD', 'CHURCH_STREET', 'LONDON_ROAD',
+    'VICTORIA_ROAD', 'GREEN_LANE', 'MANOR_ROAD', 'CHURCH_LANE', 'PARK_AVENUE', 'THE_AVENUE', 'THE_CRESCENT',
+    'QUEENS_ROAD', 'NEW_ROAD', 'GRANGE_ROAD', 'KINGS_ROAD', 'KINGSWAY', 'WINDSOR_ROAD', 'HIGHFIELD_ROAD',
+    'MILL_LANE', 'ALEXANDER_ROAD', 'YORK_ROAD', 'ST_JOHNS_ROAD', 'RIVERSIDE_ROAD', 'MAIN_ROAD', 'BROADWAY',
+]
+
+TOWNS = [
+    'LONDON', 'BIRMINGHAM', 'LEEDS', 'GLASGOW', 'SHEFFIELD', 'BRADFORD', 'LIVERPOOL', 'EDINBURGH', 'MANCHESTER',
+    'BRISTOL', 'KIRKLEES', 'FIFE', 'WIRRAL', 'NORTH_LANARKSHIRE', 'WAKEFIELD', 'CARDIFF', 'DUDLEY', 'WIGAN',
+    'EAST_RIDING', 'SOUTH_LANARKSHIRE', 'COVENTRY', 'BELFAST', 'LEICESTER', 'SUNDERLAND', 'SANDWELL', 'DONCASTER',
+    'STOCKPORT', 'SEFTON', 'NOTTINGHAM', 'NEWCASTLE_UPON_TYNE', 'KINGSTON_UPON_HULL', 'BARNSLEY', 'EXETER',
+]
+
+UNIT_LETTERS = 'ABDEFGHJLNPQRSTUWXYZ'
+
+ENTRY_DATETIME_BASE = datetime(2014, 6, 1, 9, 0, 0)
+
+# Records are loaded in bulk, so neighbouring documents share their entryDatetime
+DOCUMENTS_PER_LOAD = 2500
+
+SORT = [{'postcode': 'asc'}, {'addressKey': 'asc'}]
+
+# Ranks of the parts of postcodes and address keys in string order. A district is followed by a
+# space in the postcode and a house number by an underscore in the address key, which both decide
+# where a number sorts against the longer numbers it is a prefix of.
+AREA_RANKS = [sorted(POSTCODE_AREAS).index(area) for area in POSTCODE_AREAS]
+DISTRICT_RANKS = {district: rank for rank, district in enumerate(sorted(range(1, 29), key='{} '.format))}
+HOUSE_NUMBER_RANKS = {house_number: rank for rank, house_number in enumerate(sorted(range(1, 251), key='{}_'.format))}
+
+
+def create_document(i):
+    area = POSTCODE_AREAS[i % len(POSTCODE_AREAS)]
+    i //= len(POSTCODE_AREAS)
+    postcode = '{}{} {}{}{}'.format(
+        area, 1 + i % 28, (i // 28) % 10, UNIT_LETTERS[(i // 280) % 20], UNIT_LETTERS[(i // 5600) % 20])
+    house_number = 1 + (i // 112000) % 250
+    street = STREETS[(i // 7) % len(STREETS)]
+    town = TOWNS[(i // 13) % len(TOWNS)]
+    entry_datetime = ENTRY_DATETIME_BASE + timedelta(seconds=37 * (i * len(POSTCODE_AREAS) // DOCUMENTS_PER_LOAD))
+
+    return {
+        'postcode': postcode,
+        'addressKey': '{}_{}_{}_{}'.format(house_number, street, town, postcode.replace(' ', '_')),
+        'entryDatetime': entry_datetime.strftime('%Y-%m-%dT%H:%M:%S+00'),
+    }
+
+
+# The key of document i in postcode and address key order, worked out without creating it. It
+# mirrors create_document, and the document number breaks the ties of repeated address keys.
+def get_sort_key(i):
+    area_rank = AREA_RANKS[i % len(POSTCODE_AREAS)]
+    i //= len(POSTCODE_AREAS)
+    return (
+        area_rank, DISTRICT_RANKS[1 + i % 28], (i // 28) % 10, (i // 280) % 20, (i // 5600) % 20,
+        HOUSE_NUMBER_RANKS[1 + (i // 112000) % 250], i,
+    )
+
+
+def get_sort_values(document):
+    return [document['postcode'], document['addressKey']]
+
+
+# Keeps the position of every open scroll. Document i lives in shard i % nof_shards, and slice n
+# of m holds the documents with i % m == n, so that slices and shard preferences each see their
+# own part of the data set. A scroll reads the documents of its part in turn.
+class FakeScrolls():
+
+    def __init__(self, nof_documents, nof_shards):
+        self.nof_documents = nof_documents
+        self.nof_shards = nof_shards
+        self.scrolls = {}
+        self.nof_created_scrolls = 0
+        self.sorted_documents = None
+        self.lock = threading.Lock()
+
+    def search(self, body, params):
+        if body and 'sort' in body:
+            return self._search_sorted(body, params or {})
+
+        modulus, remainders = self._get_partition(body or {}, params or {})
+        matches = _create_query_matcher((body or {}).get('query'))
+        size = int(params.get('size', 10))
+
+        with self.lock:
+            scroll_id = 'scroll_{}'.format(self.nof_created_scrolls)
+            self.nof_created_scrolls += 1
+            self.scrolls[scroll_id] = (0, modulus, remainders, matches, size)
+
+        return self._next_page(scroll_id, size)
+
+    # A sliced scroll keeps the size it was opened with, as it is not given again
+    def scroll(self, scroll_id, params):
+        return self._next_page(scroll_id, int(params['size']) if 'size' in params else None)
+
+    def clear_scroll(self, scroll_id):
+        with self.lock:
+            self.scrolls.pop(scroll_id, None)
+
+    def search_shards(self):
+        return {'shards': [[{'shard': shard}] for shard in range(0, self.nof_shards)]}
+
+    def _next_page(self, scroll_id, size):
+        with self.lock:
+            position, modulus, remainders, matches, scroll_size = self.scrolls[scroll_id]
+
+        size = size or scroll_size
+        documents = []
+
+        while len(documents) < size:
+            # The position counts the documents of the partition, whose remainders repeat every modulus
+            i = position // len(remainders) * modulus + remainders[position % len(remainders)]
+
+            if i >= self.nof_documents:
+                break
+
+            document = create_document(i)
+            position += 1
+
+            if matches(document):
+                documents.append(document)
+
+        with self.lock:
+            self.scrolls[scroll_id] = (position, modulus, remainders, matches, scroll_size)
+
+        return {
+            '_scroll_id': scroll_id,
+            'hits': {'hits': [{'_source': document} for document in documents]},
+        }
+
+    # A sorted search is not kept open: each one finds its place again after the search_after values
+    def _search_sorted(self, body, params):
+        if body['sort'] != SORT:
+            raise Exception('The fake Elasticsearch only sorts on postcode and address key', body['sort'])
+
+        modulus, remainders = self._get_partition(body, params)
+        matches = _create_query_matcher(body.get('query'))
+        size = int(params.get('size', 10))
+        sorted_documents = self._get_sorted_documents()
+        position = 0
+
+        if 'search_after' in body:
+            position = bisect.bisect_right(
+                sorted_documents, body['search_after'], key=lambda i: get_sort_values(create_document(i)))
+
+        documents = []
+
+        while len(documents) < size and position < len(sorted_documents):
+            i = sorted_documents[position]
+            position += 1
+
+            if i % modulus in remainders:
+                document = create_document(i)
+
+                if matches(document):
+                    documents.append(document)
+
+        return {'hits': {'hits': [
+            {'_source': document, 'sort': get_sort_values(document)} for document in documents]}}
+
+    # The document numbers in key order, sorted once on numbers alone
+    def _get_sorted_documents(self):
+        with self.lock:
+            if self.sorted_documents is None:
+                self.sorted_documents = array('q', sorted(range(0, self.nof_documents), key=get_sort_key))
+
+            return self.sorted_documents
+
+    def _get_partition(self, body, params):
+        if 'slice' in body:
+            return body['slice']['max'], [body['slice']['id']]
+
+        preference = params.get('preference', '')
+
+        if preference.startswith('_shards:'):
+            return self.nof_shards, sorted(int(shard) for shard in preference[len('_shards:'):].split(','))
+
+        return 1, [0]
+
+
+# Supports the queries the generator sends when sharding: regexp and bool with should or must_not
+def _create_query_matcher(query):
+    if not query:
+        return lambda document: True
+
+    if 'regexp' in query:
+        (field, pattern), = query['regexp'].items()
+        regexp = re.compile(pattern)
+        return lambda document: regexp.fullmatch(document[field]) is not None
+
+    if 'bool' in query:
+        should = [_create_query_matcher(clause) for clause in query['bool'].get('should', [])]
+        must_not = [_create_query_matcher(clause) for clause in query['bool'].get('must_not', [])]
+        return lambda document: (
+            (not should or any(matches(document) for matches in should)) and
+            not any(matches(document) for matches in must_not)
+        )
+
+    raise Exception('The fake Elasticsearch does not support the query', query)
+
+
+# Takes the place of elasticsearch.Elasticsearch in process
+class FakeElasticsearch():
+
+    def __init__(self, scrolls):
+        self.scrolls = scrolls
+
+    def search(self, index=None, doc_type=None, body=None, params=None):
+        return self.scrolls.search(body, params)
+
+    def scroll(self, scroll_id, params=None):
+        return self.scrolls.scroll(scroll_id, params or {})
+
+    def clear_scroll(self, scroll_id=None, body=None, params=None):
+        self.scrolls.clear_scroll(scroll_id)
+
+    def search_shards(self, index=None, doc_type=None, params=None):
+        return self.scrolls.search_shards()
+
+
+class FakeElasticsearchServer():
+
+    def __init__(self, scrolls, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), _create_request_handler(scrolls))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _create_request_handler(scrolls):
+
+    class FakeElasticsearchRequestHandler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {name: values[0] for name, values in parse_qs(url.query).items()}
+            body = self._read_body()
+
+            if url.path == '/_search/scroll':
+                self._respond(scrolls.scroll(body.decode('utf-8'), params))
+            elif url.path.endswith('/_search_shards'):
+                self._respond(scrolls.search_shards())
+            elif url.path.endswith('/_search'):
+                self._respond(scrolls.search(json.loads(body.decode('utf-8')) if body else {}, params))
+            else:
+                self.send_error(404)
+
+        do_POST = do_GET
+
+        def do_DELETE(self):
+            self._read_body()
+            scrolls.clear_scroll(urlparse(self.path).path.rsplit('/', 1)[-1])
+            self._respond({'succeeded': True})
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_body(self):
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _respond(self, content):
+            response = json.dumps(content).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    return FakeElasticsearchRequestHandler
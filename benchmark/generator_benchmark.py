@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Runs the whole generator against synthetic property documents and reports records/s, peak RSS
+# and the time spent in each stage, as measured by the generator's metrics. The documents are
+# served by an in-process stand-in for the Elasticsearch client, or with --server by a local HTTP
+# server speaking the scroll API. With the in-process stand-in, Elasticsearch request time is
+# mostly the time spent synthesising documents.
+#
+# Run from the repository root:
+#   python benchmark/generator_benchmark.py [--documents N] [--server] [--output FILE] [--baseline FILE] \
+#       [-- generator arguments, e.g. --slices 4 --compress]
+#
+# Results are written as JSON, so runs on different commits can be compared with --baseline.
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import elasticsearch_scan
+import settings
+from generate import Generator
+from metrics import METRICS
+from fake_elasticsearch import FakeElasticsearch, FakeElasticsearchServer, FakeScrolls
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks site map generation against synthetic Elasticsearch data')
+    parser.add_argument('--documents', type=int, dest='documents', default=100000)
+    parser.add_argument('--shardsInIndex', type=int, dest='shards_in_index', default=5,
+                        help='Number of shards the fake index reports, for --sliceMethod shards')
+    parser.add_argument('--server', action='store_true', dest='server',
+                        help='Serve the documents over HTTP instead of replacing the Elasticsearch client')
+    parser.add_argument('--output', dest='output', default='generator_benchmark.json')
+    parser.add_argument('--baseline', dest='baseline', help='Results of an earlier run to compare with')
+    parser.add_argument('--keepOutput', action='store_true', dest='keep_output',
+                        help='Keep the generated site map directory')
+    return parser.parse_known_args()
+
+
+def create_generator_config(elasticsearch_url, site_map_directory_path, generator_arguments):
+    return settings.parse_command_line_arguments([
+        '--basePageUrl', 'http://www.example.gov.uk/property',
+        '--elasticsearchUrl', elasticsearch_url,
+        '--siteMapDirectoryPath', site_map_directory_path,
+        '--siteMapDirectoryUrl', 'http://www.example.gov.uk/site-map',
+        '--pageSize', '1000',
+        '--maxRecordsPerFile', '50000',
+    ] + [argument for argument in generator_arguments if argument != '--'])
+
+
+def run(arguments, generator_arguments, site_map_directory_path):
+    scrolls = FakeScrolls(arguments.documents, arguments.shards_in_index)
+    patches = []
+
+    if arguments.server:
+        server = FakeElasticsearchServer(scrolls)
+        elasticsearch_url = server.url
+    else:
+        server = None
+        elasticsearch_url = 'http://localhost:9200'
+        patches.append(mock.patch.object(
+            elasticsearch_scan, 'Elasticsearch', lambda *args, **kwargs: FakeElasticsearch(scrolls)))
+
+    config = create_generator_config(elasticsearch_url, site_map_directory_path, generator_arguments)
+
+    for patch in patches:
+        patch.start()
+
+    try:
+        if server:
+            server.__enter__()
+
+        METRICS.reset()
+        start = time.perf_counter()
+        Generator(config).generate_property_site_map()
+        seconds = time.perf_counter() - start
+    finally:
+        if server:
+            server.__exit__(None, None, None)
+
+        for patch in reversed(patches):
+            patch.stop()
+
+    return seconds, METRICS.snapshot()
+
+
+def get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return unit * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def get_directory_size(directory_path):
+    return sum(os.path.getsize(os.path.join(directory_path, name)) for name in os.listdir(directory_path))
+
+
+def compare(results, baseline):
+    print('compared with {} ({}):'.format(baseline['commit'], baseline['timestamp']))
+    print('  records/s: {:+.1%}'.format(results['records_per_second'] / baseline['records_per_second'] - 1))
+    print('  peak RSS:  {:+.1%}'.format(results['peak_rss_bytes'] / baseline['peak_rss_bytes'] - 1))
+
+    for stage, timing in results['stages'].items():
+        baseline_timing = baseline['stages'].get(stage)
+
+        if baseline_timing and baseline_timing['seconds']:
+            print('  {:<22} {:+.1%}'.format(stage, timing['seconds'] / baseline_timing['seconds'] - 1))
+
+
+def main():
+    arguments, generator_arguments = parse_arguments()
+    site_map_directory_path = tempfile.mkdtemp(prefix='site_map_benchmark_')
+
+    try:
+        seconds, metrics = run(arguments, generator_arguments, site_map_directory_path)
+        output_bytes = get_directory_size(site_map_directory_path)
+    finally:
+        if arguments.keep_output:
+            print('site maps:  {}'.format(site_map_directory_path))
+        else:
+            shutil.rmtree(site_map_directory_path)
+
+    results = {
+        'commit': get_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'documents': arguments.documents,
+        'server': arguments.server,
+        'generator_arguments': [argument for argument in generator_arguments if argument != '--'],
+        'seconds': round(seconds, 6),
+        'records_per_second': round(arguments.documents / seconds, 1),
+        'peak_rss_bytes': get_peak_rss_bytes(),
+        'output_bytes': output_bytes,
+        'stages': metrics['stages'],
+        'counters': metrics['counters'],
+    }
+
+    print('records:    {}'.format(arguments.documents))
+    print('time:       {:.3f}s ({:,.0f} records/s)'.format(seconds, results['records_per_second']))
+    print('peak RSS:   {:,.1f} MB'.format(results['peak_rss_bytes'] / 1024 / 1024))
+    print('output:     {:,.1f} MB'.format(output_bytes / 1024 / 1024))
+
+    for stage, timing in sorted(results['stages'].items()):
+        print('  {:<22} {:8.3f}s in {} calls'.format(stage, timing['seconds'], timing['calls']))
+
+    if arguments.baseline:
+        with open(arguments.baseline, 'rt') as baseline_file:
+            compare(results, json.load(baseline_file))
+
+    with open(arguments.output, 'wt') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+from atomic_file import save_atomically
+import json
+import os
+
+class Checkpoint():
+
+    def __init__(self, cursor, files):
+        self.cursor = cursor
+        self.files = files
+
+    def to_json(self):
+        return {
+            'cursor': self.cursor,
+            'files': self.files,
+        }
+
+
+def load_checkpoint(file_path):
+    if not os.path.isfile(file_path):
+        return None
+
+    try:
+        with open(file_path, 'rt') as file:
+            checkpoint = json.load(file)
+
+        return Checkpoint(checkpoint['cursor'], checkpoint['files'])
+    except Exception as e:
+        raise Exception('Failed to load checkpoint: {}'.format(file_path), e)
+
+
+def save_checkpoint(checkpoint, file_path):
+    try:
+        save_atomically(file_path, json.dumps(checkpoint.to_json()))
+    except Exception as e:
+        raise Exception('Failed to save checkpoint: {}'.format(file_path), e)
+
+
+def remove_checkpoint(file_path):
+    if os.path.isfile(file_path):
+        os.unlink(file_path)
@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import logging
+import os
+import shutil
+from metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def compress_file(source_path, target_path, compression_level):
+    with METRICS.time('compression'):
+        _compress_file(source_path, target_path, compression_level)
+
+
+def _compress_file(source_path, target_path, compression_level):
+    temp_path = '{}.tmp'.format(target_path)
+
+    # No file name or timestamp in the gzip header, so the same content always compresses to the same bytes
+    with open(source_path, 'rb') as source, open(temp_path, 'wb') as raw_target:
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=compression_level, fileobj=raw_target, mtime=0) as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+    os.replace(temp_path, target_path)
+    os.unlink(source_path)
+
+
+class FileCompressor():
+
+    def __init__(self, nof_workers, compression_level):
+        self.compression_level = compression_level
+        self.executor = ThreadPoolExecutor(max_workers=nof_workers)
+        self.pending = []
+
+    # The callback is called by the worker once the file is compressed
+    def submit(self, source_path, target_path, on_compressed=None):
+        self.pending.append((target_path, self.executor.submit(
+            self._compress_file, source_path, target_path, on_compressed)))
+
+    def _compress_file(self, source_path, target_path, on_compressed):
+        compress_file(source_path, target_path, self.compression_level)
+
+        if on_compressed:
+            on_compressed()
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+
+        for target_path, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                raise Exception('Failed to compress site map file: {}'.format(target_path), e)
+
+            LOGGER.info('Compressed site map file: {}'.format(target_path))
@@ -0,0 +1,153 @@
+from array import array
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from metrics import METRICS
+from models import SiteMapUrlPage
+
+LOGGER = logging.getLogger(__name__)
+
+HASH_SLOT_SIZE = 8
+MAX_HASH_TABLE_LOAD = 0.75
+
+# SQLite limits the number of parameters of a statement
+SQLITE_MAX_PARAMETERS = 999
+
+
+# Drops URLs that were already seen earlier in the run, such as documents indexed twice or
+# addresses sharing a key. Pages without duplicates are passed on as they are.
+class UrlDeduplicator():
+
+    def __init__(self, index):
+        self.index = index
+        self.nof_duplicates = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.index.close()
+        LOGGER.info('Dropped {} duplicate site map URLs'.format(self.nof_duplicates))
+
+    def filter(self, page):
+        new_positions = self.index.add_new(page.locations)
+
+        if len(new_positions) == len(page):
+            return page
+
+        self.nof_duplicates += len(page) - len(new_positions)
+        METRICS.increment('duplicate_urls', len(page) - len(new_positions))
+
+        return SiteMapUrlPage(
+            [page.locations[i] for i in new_positions],
+            [page.last_modified[i] for i in new_positions],
+            page.change_frequency,
+            [page.cursors[i] for i in new_positions] if page.cursors is not None else None,
+        )
+
+
+# Keeps a 64-bit hash of every location in an open addressing table of 8-byte slots, which doubles
+# as it fills up to the memory budget. Distinct locations sharing a hash are taken as duplicates,
+# which is vanishingly unlikely even for tens of millions of URLs.
+class HashedUrlIndex():
+
+    def __init__(self, memory_budget, initial_nof_slots=1 << 16):
+        self.max_nof_slots = 1 << max(4, (memory_budget // HASH_SLOT_SIZE).bit_length() - 1)
+        self.size = 0
+        self._allocate(min(initial_nof_slots, self.max_nof_slots))
+
+    def add_new(self, locations):
+        new_positions = []
+
+        for position, location in enumerate(locations):
+            # Zero marks an empty slot
+            if self._add(hash(location) or 1):
+                new_positions.append(position)
+
+        return new_positions
+
+    def close(self):
+        self.slots = None
+
+    def _add(self, location_hash):
+        slots = self.slots
+        mask = self.mask
+        slot = location_hash & mask
+
+        while slots[slot]:
+            if slots[slot] == location_hash:
+                return False
+
+            slot = (slot + 1) & mask
+
+        if self.size == self.max_size:
+            self._grow()
+            return self._add(location_hash)
+
+        slots[slot] = location_hash
+        self.size += 1
+        return True
+
+    def _grow(self):
+        if len(self.slots) == self.max_nof_slots:
+            raise Exception('The URL deduplication memory budget is too small for more than {} URLs'.format(self.size))
+
+        old_slots = self.slots
+        self.size = 0
+        self._allocate(2 * len(old_slots))
+
+        for location_hash in old_slots:
+            if location_hash:
+                self._add(location_hash)
+
+    def _allocate(self, nof_slots):
+        self.slots = array('q', [0]) * nof_slots
+        self.mask = nof_slots - 1
+        self.max_size = int(nof_slots * MAX_HASH_TABLE_LOAD)
+
+
+# Keeps every location in an SQLite database on disk, with a page cache limited to the memory
+# budget, for exact deduplication of more URLs than fit in memory
+class SpillingUrlIndex():
+
+    def __init__(self, memory_budget, directory_path=None):
+        self.directory_path = tempfile.mkdtemp(prefix='site_map_dedup_', dir=directory_path)
+        self.connection = sqlite3.connect(os.path.join(self.directory_path, 'urls.db'))
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA cache_size = -{}'.format(max(1, memory_budget // 1024)))
+        self.connection.execute('CREATE TABLE urls (location TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def add_new(self, locations):
+        positions = {}
+
+        for position, location in enumerate(locations):
+            positions.setdefault(location, position)
+
+        unique_locations = list(positions)
+
+        for start in range(0, len(unique_locations), SQLITE_MAX_PARAMETERS):
+            batch = unique_locations[start:start + SQLITE_MAX_PARAMETERS]
+            known_locations = self.connection.execute(
+                'SELECT location FROM urls WHERE location IN ({})'.format(','.join('?' * len(batch))), batch)
+
+            for known_location, in known_locations:
+                del positions[known_location]
+
+        self.connection.executemany('INSERT INTO urls VALUES (?)', ((location,) for location in positions))
+        return sorted(positions.values())
+
+    def close(self):
+        self.connection.close()
+        shutil.rmtree(self.directory_path, ignore_errors=True)
+
+
+def create_url_deduplicator(config):
+    memory_budget = config.dedup_memory_mb * 1024 * 1024
+
+    if config.dedup_mode == 'exact':
+        return UrlDeduplicator(SpillingUrlIndex(memory_budget, config.dedup_directory_path))
+
+    return UrlDeduplicator(HashedUrlIndex(memory_budget))
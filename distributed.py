@@ -0,0 +1,205 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from atomic_file import save_atomically
+from publish import SiteMapPublisher
+from sharding import get_shard_queries
+from site_map import SiteMapCreator
+from sinks import create_sink
+
+LOGGER = logging.getLogger(__name__)
+
+WORK_MANIFEST_FILENAME = 'work_manifest.json'
+
+# Spreads the shards of a run across hosts sharing a work directory. The coordinator lists the
+# shards, each worker claims shards with exclusively created lock files and records the site map
+# files it wrote for them, and the merge step writes the index once every shard has a result.
+#
+# A worker keeps touching its claim while it generates the shard. A claim that has not been
+# touched for the claim timeout belongs to a worker that is gone, and another worker takes the
+# shard over.
+class DistributedGeneration():
+
+    def __init__(self, config, generator):
+        self.config = config
+        self.generator = generator
+        self.work_directory_path = config.work_directory_path
+
+    def coordinate(self):
+        site_map_directory_path = self._prepare_site_map_directory()
+        shard_queries = get_shard_queries(self.config.shards, self.config.shard_field)
+
+        try:
+            for directory_name in ['claims', 'results']:
+                shutil.rmtree(self._get_work_path(directory_name), ignore_errors=True)
+                os.makedirs(self._get_work_path(directory_name))
+
+            self._save_json(self._get_work_path(WORK_MANIFEST_FILENAME), {
+                'site_map_directory_path': site_map_directory_path,
+                'shards': [{'shard': shard, 'query': query} for shard, query in enumerate(shard_queries)],
+            })
+        except Exception as e:
+            raise Exception('Failed to create work manifest in {}'.format(self.work_directory_path), e)
+
+        LOGGER.info('Created work manifest with {} shards'.format(len(shard_queries)))
+
+    def work(self):
+        work_manifest = self._load_work_manifest()
+        nof_generated_shards = 0
+
+        for shard in work_manifest['shards']:
+            if not self._claim(shard['shard']):
+                continue
+
+            try:
+                with self._keeping_claim(shard['shard']):
+                    site_map_files = self.generator.generate_shard(
+                        work_manifest['site_map_directory_path'], shard['shard'], shard['query'])
+            except Exception:
+                os.unlink(self._get_claim_path(shard['shard']))
+                raise
+
+            self._save_json(self._get_result_path(shard['shard']), site_map_files)
+            nof_generated_shards += 1
+
+        LOGGER.info('Generated {} shards'.format(nof_generated_shards))
+
+    def merge(self):
+        work_manifest = self._load_work_manifest()
+        shards = [shard['shard'] for shard in work_manifest['shards']]
+        missing_shards = [shard for shard in shards if not os.path.isfile(self._get_result_path(shard))]
+
+        if missing_shards:
+            raise Exception('Shards have not been generated yet', missing_shards, self._describe_claims(missing_shards))
+
+        site_map_directory_path = work_manifest['site_map_directory_path']
+
+        # Workers only write to the shared directory, so the whole site map goes to the sink here
+        with create_sink(self.config) as sink:
+            site_map_creator = SiteMapCreator(self.config, site_map_directory_path, sink=sink)
+
+            for shard in shards:
+                site_map_creator.add_site_map_files(self._load_json(self._get_result_path(shard)))
+
+            site_map_creator.create_site_map_index_file()
+            site_map_creator.save_manifest()
+            site_map_creator.finish_sink()
+
+        if self.config.atomic_publish:
+            SiteMapPublisher(self.config).publish(site_map_directory_path)
+
+        LOGGER.info('Merged {} shards into the site map index'.format(len(shards)))
+
+    def _prepare_site_map_directory(self):
+        if self.config.atomic_publish:
+            return SiteMapPublisher(self.config).create_staging_directory()
+
+        SiteMapCreator(self.config).clear_site_map_directory()
+        return self.config.site_map_directory_path
+
+    def _claim(self, shard):
+        try:
+            claim = os.open(self._get_claim_path(shard), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._release_stale_claim(shard):
+                return False
+
+            return self._claim(shard)
+
+        try:
+            os.write(claim, '{}:{}'.format(socket.gethostname(), os.getpid()).encode('utf-8'))
+        finally:
+            os.close(claim)
+
+        LOGGER.info('Claimed shard {}'.format(shard))
+        return True
+
+    # The claim of a finished shard is never stale. A stale claim is renamed out of the way first,
+    # so that only one of the workers finding it stale releases it.
+    def _release_stale_claim(self, shard):
+        claim_path = self._get_claim_path(shard)
+
+        try:
+            if os.path.isfile(self._get_result_path(shard)) or not self._is_stale(os.path.getmtime(claim_path)):
+                return False
+
+            released_claim_path = '{}.{}.{}.released'.format(claim_path, socket.gethostname(), os.getpid())
+            os.rename(claim_path, released_claim_path)
+        except FileNotFoundError:
+            return False
+
+        LOGGER.warning('Released stale claim on shard {} held by {}'.format(shard, self._read_claim(released_claim_path)))
+        os.unlink(released_claim_path)
+        return True
+
+    # Touches the claim on the shard until the block ends
+    @contextmanager
+    def _keeping_claim(self, shard):
+        claim_path = self._get_claim_path(shard)
+        stopped = threading.Event()
+
+        def touch_claim():
+            while not stopped.wait(self.config.claim_timeout_seconds / 4):
+                try:
+                    os.utime(claim_path)
+                except OSError as e:
+                    LOGGER.warning('Failed to touch claim on shard {}: {}'.format(shard, e))
+
+        thread = threading.Thread(target=touch_claim, daemon=True)
+        thread.start()
+
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def _describe_claims(self, shards):
+        claims = {}
+
+        for shard in shards:
+            claim_path = self._get_claim_path(shard)
+
+            try:
+                modified = os.path.getmtime(claim_path)
+                claims[shard] = '{}, touched {:.0f}s ago{}'.format(
+                    self._read_claim(claim_path), time.time() - modified, ', stale' if self._is_stale(modified) else '')
+            except FileNotFoundError:
+                pass
+
+        return claims
+
+    def _is_stale(self, modified):
+        return time.time() - modified > self.config.claim_timeout_seconds
+
+    def _read_claim(self, claim_path):
+        with open(claim_path, 'rt') as file:
+            return file.read()
+
+    def _load_work_manifest(self):
+        try:
+            return self._load_json(self._get_work_path(WORK_MANIFEST_FILENAME))
+        except Exception as e:
+            raise Exception('Failed to load work manifest from {}'.format(self.work_directory_path), e)
+
+    def _load_json(self, file_path):
+        with open(file_path, 'rt') as file:
+            return json.load(file)
+
+    def _save_json(self, file_path, content):
+        save_atomically(file_path, json.dumps(content))
+
+    def _get_claim_path(self, shard):
+        return self._get_work_path(os.path.join('claims', '{}.lock'.format(shard)))
+
+    def _get_result_path(self, shard):
+        return self._get_work_path(os.path.join('results', '{}.json'.format(shard)))
+
+    def _get_work_path(self, name):
+        return os.path.join(self.work_directory_path, name)
+
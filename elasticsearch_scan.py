@@ -1,73 +1,274 @@
-from elasticsearch import Elasticsearch, Transport
-from models import SiteMapUrl
+from elasticsearch import Elasticsearch, Transport, JSONSerializer, Urllib3HttpConnection
+from models import SiteMapUrlPage, concatenate_pages
+from metrics import METRICS
+from request_control import RetryPolicy, create_page_size, create_rate_limiter
+from recording import create_snapshot_recorder
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import bisect
+import heapq
 import logging
+import re
+import threading
+import time
+import urllib3
 from datetime import datetime
 
 LOGGER = logging.getLogger(__name__)
 
+# Sorting on the postcode first keeps the URLs of a postcode together, and the address key makes
+# the order total, so the same data always comes out in the same order
+SORT_FIELDS = ['postcode', 'addressKey']
+
+# Only the parts of the response the client reads: the scroll ID, the source of each hit and its sort values
+RESPONSE_FILTER_PATH = '_scroll_id,hits.hits._source,hits.hits.sort'
+
+ENTRY_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S+00'
+LAST_MODIFIED_FORMAT = '%Y-%m-%dT%H:%M+00:00'
+ENTRY_DATETIME_PATTERN = re.compile(r'([1-9]\d{3}-\d\d-\d\d)T([01]\d|2[0-3]):[0-5]\d:[0-5]\d\+00')
+
+# Records loaded in bulk share their entryDatetime, so conversions are cached
+@lru_cache(maxsize=65536)
+def convert_entry_datetime(entry_datetime):
+    match = ENTRY_DATETIME_PATTERN.fullmatch(entry_datetime)
+
+    # Values in the usual format only need the seconds cut off, once the date is known to be valid
+    if match and _is_valid_date(match.group(1)):
+        return entry_datetime[:16] + '+00:00'
+
+    return datetime.strptime(entry_datetime, ENTRY_DATETIME_FORMAT).strftime(LAST_MODIFIED_FORMAT)
+
+
+@lru_cache(maxsize=4096)
+def _is_valid_date(date):
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+# The size of the last response decoded in each thread, as requests are made by the thread
+# that reads their response
+_last_response = threading.local()
+
+
+def get_last_response_bytes():
+    return getattr(_last_response, 'nof_bytes', 0)
+
+
+# Converts a whole page of hits at once into columns, which the site map writer reads directly
+def convert_to_site_map_entries(config, address_page, sort=False):
+    sources = [address['_source'] for address in address_page]
+
+    return SiteMapUrlPage(
+        locations=_get_page_urls(config, sources),
+        last_modified=[convert_entry_datetime(source['entryDatetime']) for source in sources],
+        change_frequency=config.url_change_frequency,
+        cursors=[address.get('sort') for address in address_page] if sort else None,
+    )
+
+
+def _get_page_urls(config, sources):
+    base_page_url = config.base_page_url + '/'
+
+    return [
+        base_page_url + postcode.replace(' ', '_') + '/' + address_key[:len(address_key) - len(postcode) - 1]
+        for postcode, address_key in ((source['postcode'], source['addressKey']) for source in sources)
+    ]
+
+
+# Measures the decoding of responses, which is part of each request's time, and their size
+class MeasuredJSONSerializer(JSONSerializer):
+
+    def loads(self, s):
+        METRICS.increment('response_bytes', len(s))
+        _last_response.nof_bytes = len(s)
+
+        with METRICS.time('json_decode'):
+            return super().loads(s)
+
+
+# Asks for gzip-compressed responses, which urllib3 decompresses as they are read. The cluster
+# only compresses them with http.compression enabled.
+class CompressedUrllib3HttpConnection(Urllib3HttpConnection):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.headers.update(urllib3.make_headers(accept_encoding=True))
+
+
+# Requests are spread round-robin over the nodes of the comma-separated Elasticsearch URL, each
+# with a pool of keep-alive connections. Sniffing replaces these seed nodes by the nodes of the
+# cluster.
+def create_elasticsearch(config):
+    options = {
+        'serializer': MeasuredJSONSerializer(),
+        'maxsize': config.es_max_connections,
+    }
+
+    if config.es_compression:
+        options['connection_class'] = CompressedUrllib3HttpConnection
+
+    if config.es_sniff_interval:
+        options['sniff_on_start'] = True
+        options['sniff_on_connection_fail'] = True
+        options['sniffer_timeout'] = config.es_sniff_interval
+
+    return Elasticsearch(config.elasticsearch_url.split(','), **options)
+
+
+# Reads records with a scroll in no particular order or, when sorting, page by page with
+# search_after, which continues after the sort values of the last record read. Sorted reading can
+# start after a given cursor.
+#
+# Transient failures are retried with backoff, and requests are held back to the configured rate.
+# The page size of each search adapts to the latency and size of the responses, when configured.
+# A scroll keeps the page size it was opened with, so only sorted reading makes full use of it.
+#
+# The hits read are saved as a snapshot when recording.
 class ElasticsearchClient():
 
-    def __init__(self, config):
+    def __init__(self, config, slice_id=None, shards=None, query=None, sort=False, client=None, search_after=None,
+                 rate_limiter=None):
         self.config = config
-        self.client = Elasticsearch(config.elasticsearch_url)
+        self.client = client or create_elasticsearch(config)
+        self.rate_limiter = rate_limiter or create_rate_limiter(config)
+        self.recorder = create_snapshot_recorder(config)
+        self.retry_policy = RetryPolicy(config.max_retries, config.retry_backoff_seconds)
+        self.page_size = create_page_size(config)
         self.scroll_id = None
+        self.slice_id = slice_id
+        self.shards = shards
+        self.query = query
+        self.sort = sort
+        self.search_after = search_after
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._try_clear_scroll()
+        if self.scroll_id:
+            self._try_clear_scroll()
+
+        if self.recorder:
+            self.recorder.close()
 
     def next_page_of_records(self):
-        result = self._retrieve_page_of_data()
-        self.scroll_id = self._get_scroll_id(result)
-        site_map_entries = self._get_site_map_entries(result)
+        with METRICS.time('elasticsearch_request'):
+            result = self._retrieve_page_of_data()
+
+        if not self.sort:
+            self.scroll_id = self._get_scroll_id(result)
+
+        with METRICS.time('conversion'):
+            site_map_entries = self._get_site_map_entries(result)
+
+        if self.sort and site_map_entries:
+            self.search_after = site_map_entries.cursors[-1]
+
+        METRICS.increment('scroll_round_trips')
+        METRICS.increment('records', len(site_map_entries))
         LOGGER.info('Retrieved {} records from elasticsearch'.format(len(site_map_entries)))
         return site_map_entries
 
     def _retrieve_page_of_data(self):
         try:
-            if self.scroll_id:
-                result = self._scroll(self.scroll_id)
-            else:
-                result = self._search()
-
-            return result
+            # Until a scroll is open, every request is a search, which can be repeated as it is
+            return self.retry_policy.call(
+                self._request_page_of_data, repeatable=not self.scroll_id, on_retry=self.page_size.shrink)
         except Exception as e:
             raise Exception('Failed to retrieve a page of data from elasticsearch', e)
 
+    def _request_page_of_data(self):
+        self.rate_limiter.wait_for_request()
+        _last_response.nof_bytes = 0
+        start = time.perf_counter()
+
+        if self.scroll_id:
+            result = self._scroll(self.scroll_id)
+        else:
+            result = self._search()
+
+        self.page_size.observe(time.perf_counter() - start, get_last_response_bytes())
+        self.rate_limiter.record_documents(len(self._get_addresses(result)))
+        return result
+
     def _get_site_map_entries(self, result):
         try:
             address_page = self._get_addresses(result)
+
+            if self.recorder:
+                self.recorder.record(address_page)
+
             site_map_entries = self._convert_to_site_map_entries(address_page)
             return site_map_entries
         except Exception as e:
             raise Exception('Failed to convert elasticsearch result to a list of site map entries', e)
 
     def _scroll(self, scroll_id):
-        return self.client.scroll(
-            scroll_id=scroll_id,
-            params={
-                'scroll': self.config.scroll_expiry,
-                'search_type': 'scan',
-                'size': self.config.page_size,
-                'timeout': self.config.request_timeout,
-            }
-        )
+        params = {'scroll': self.config.scroll_expiry}
+
+        if self.config.filter_response:
+            params['filter_path'] = RESPONSE_FILTER_PATH
 
+        # Sliced scrolls need Elasticsearch 5.0 or later, which rejects any other scroll parameter
+        if self.slice_id is None:
+            params['size'] = self.config.page_size
+            params['timeout'] = self.config.request_timeout
+            # A scan returns documents in no particular order
+            params['search_type'] = 'scan'
+
+        return self.client.scroll(scroll_id=scroll_id, params=params)
+
+
+    def count_shards(self):
+        try:
+            return len(self.client.search_shards(index=self.config.es_index)['shards'])
+        except Exception as e:
+            raise Exception('Failed to retrieve the number of shards from elasticsearch', e)
 
     def _search(self):
         return self.client.search(
             self.config.es_index,
             self.config.es_doc_type,
-            body=None,
-            params={
-                'size': self.config.page_size,
-                'scroll': self.config.scroll_expiry,
-                'timeout': self.config.request_timeout,
-            }
+            body=self._get_search_body(),
+            params=self._get_search_params(),
         )
 
+    def _get_search_body(self):
+        body = {'_source': self.config.source_fields}
+
+        if self.query:
+            body['query'] = self.query
+
+        if self.slice_id is not None:
+            body['slice'] = {'id': self.slice_id, 'max': self.config.slices}
+
+        if self.sort:
+            body['sort'] = [{field: 'asc'} for field in SORT_FIELDS]
+
+        if self.search_after:
+            body['search_after'] = self.search_after
+
+        return body
+
+    def _get_search_params(self):
+        params = {
+            'size': self.page_size.size,
+            'timeout': self.config.request_timeout,
+        }
+
+        if not self.sort:
+            params['scroll'] = self.config.scroll_expiry
+
+        if self.config.filter_response:
+            params['filter_path'] = RESPONSE_FILTER_PATH
+
+        if self.shards is not None:
+            params['preference'] = '_shards:{}'.format(','.join(str(shard) for shard in self.shards))
+
+        return params
+
     def _try_clear_scroll(self):
         try:
             self.client.clear_scroll(self.scroll_id)
@@ -82,24 +283,120 @@ class ElasticsearchClient():
             raise Exception('Failed to extract scroll ID from the elasticsearch result', e)
 
     def _get_addresses(self, search_result):
-        return search_result['hits']['hits']
+        # A filtered response leaves out 'hits' altogether when there are none
+        return search_result.get('hits', {}).get('hits', [])
 
     def _convert_to_site_map_entries(self, address_page):
-        return [self._get_site_map_entry(address) for address in address_page]
-
-    def _get_page_url(self, address):
-        data = address['_source']
-        postcode = data['postcode']
-        address_key = data['addressKey']
-        address_url_segment = address_key[:len(address_key) - len(postcode) - 1]
-
-        return '{}/{}/{}'.format(self.config.base_page_url, postcode.replace(' ', '_'), address_url_segment)
-
-    def _get_site_map_entry(self, address):
-        entry_datetime = datetime.strptime(address['_source']['entryDatetime'], '%Y-%m-%dT%H:%M:%S+00')
-        
-        return SiteMapUrl(
-            location=self._get_page_url(address),
-            last_modified=entry_datetime.strftime('%Y-%m-%dT%H:%M+00:00'),
-            change_frequency=self.config.url_change_frequency,
+        return convert_to_site_map_entries(self.config, address_page, self.sort)
+
+
+class SlicedElasticsearchClient():
+
+    def __init__(self, config, query=None, sort=False):
+        self.config = config
+        self.query = query
+        self.sort = sort
+        # The slices share one client, so their requests reuse the same keep-alive connections, and
+        # one rate limiter, so the rate limits hold for all of them together
+        self.client = create_elasticsearch(config)
+        self.rate_limiter = create_rate_limiter(config)
+        self.slices = self._create_slices()
+        self.active_slices = list(self.slices)
+        self.unmerged_pages = {}
+        self.executor = ThreadPoolExecutor(max_workers=len(self.slices))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown()
+
+        for es_slice in self.slices:
+            es_slice.__exit__(exc_type, exc_val, exc_tb)
+
+    # Reads the next page of every unfinished slice in parallel and merges them in slice
+    # order, so the output does not depend on which slice responds first
+    def next_page_of_records(self):
+        if self.sort:
+            return self._next_page_in_sort_order()
+
+        while self.active_slices:
+            pages = list(self.executor.map(lambda es_slice: es_slice.next_page_of_records(), self.active_slices))
+            self.active_slices = [es_slice for es_slice, page in zip(self.active_slices, pages) if page]
+            site_map_entries = concatenate_pages(pages)
+
+            if site_map_entries:
+                return site_map_entries
+
+        return []
+
+    # Sorted slices are merged on their cursors. The page sizes of slices adapt separately, so
+    # pages end at different points in the sort order. Only the records up to the earliest last
+    # cursor of the slices' pages are merged, as no slice can return a record before it later on,
+    # and the rest waits for the next pages. The output is in sort order whatever the page sizes.
+    def _next_page_in_sort_order(self):
+        while self.active_slices:
+            used_up_slices = [es_slice for es_slice in self.active_slices if not self.unmerged_pages.get(es_slice)]
+            pages = self.executor.map(lambda es_slice: es_slice.next_page_of_records(), used_up_slices)
+
+            for es_slice, page in zip(used_up_slices, pages):
+                if page:
+                    self.unmerged_pages[es_slice] = page
+                else:
+                    self.active_slices.remove(es_slice)
+
+            if not self.active_slices:
+                break
+
+            last_cursor = min(self.unmerged_pages[es_slice].cursors[-1] for es_slice in self.active_slices)
+            merged_pages = []
+
+            for es_slice in self.active_slices:
+                page = self.unmerged_pages[es_slice]
+                nof_merged = bisect.bisect_right(page.cursors, last_cursor)
+                merged_pages.append(page[:nof_merged])
+                self.unmerged_pages[es_slice] = page[nof_merged:]
+
+            return self._merge_sorted_pages(merged_pages)
+
+        return []
+
+    def _merge_sorted_pages(self, pages):
+        entries = list(heapq.merge(*[zip(page.cursors, page.locations, page.last_modified) for page in pages]))
+
+        return SiteMapUrlPage(
+            [location for cursor, location, last_modified in entries],
+            [last_modified for cursor, location, last_modified in entries],
+            self.config.url_change_frequency,
+            [cursor for cursor, location, last_modified in entries],
         )
+
+    def _create_slices(self):
+        nof_slices = self.config.slices
+
+        if self.config.slice_method == 'shards':
+            nof_shards = ElasticsearchClient(self.config, client=self.client).count_shards()
+            shards_per_slice = [list(range(i, nof_shards, nof_slices)) for i in range(0, nof_slices)]
+            LOGGER.info('Reading {} shards in {} slices'.format(nof_shards, nof_slices))
+            return [
+                ElasticsearchClient(
+                    self.config,
+                    shards=shards,
+                    query=self.query,
+                    sort=self.sort,
+                    client=self.client,
+                    rate_limiter=self.rate_limiter,
+                )
+                for shards in shards_per_slice if shards
+            ]
+
+        return [
+            ElasticsearchClient(
+                self.config,
+                slice_id=i,
+                query=self.query,
+                client=self.client,
+                rate_limiter=self.rate_limiter,
+            )
+            for i in range(0, nof_slices)
+        ]
@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 
 from site_map import SiteMapCreator
-from elasticsearch_scan import ElasticsearchClient
+from elasticsearch_scan import ElasticsearchClient, SlicedElasticsearchClient
+from snapshot import SnapshotClient
+from prefetch import PrefetchingClient
+from incremental import SiteMapUpdater, get_modified_since_query
+from publish import SiteMapPublisher
+from sharding import get_shard_queries
+from distributed import DistributedGeneration
+from models import concatenate_pages
+from dedup import create_url_deduplicator
+from sinks import create_sink
+from metrics import METRICS, profiling, report_metrics
+from logging_setup import setup_logging
 import logging
-from logging import config
-import json
+import multiprocessing
 import settings
 
 LOGGER = logging.getLogger(__name__)
@@ -16,33 +26,215 @@ class Generator():
 
     def generate_property_site_map(self):
         LOGGER.info('Started generating site map')
-        
-        site_map_creator = SiteMapCreator(config)
-        site_map_creator.clear_site_map_directory()
+        self._check_options()
+
+        with profiling(self.config), METRICS.time('total'):
+            if self.config.atomic_publish:
+                self._generate_and_publish()
+            else:
+                self._generate(self.config.site_map_directory_path)
+
+        LOGGER.info('Completed generating site map')
+        report_metrics(self.config, METRICS.snapshot())
+
+    def rollback_property_site_map(self):
+        SiteMapPublisher(self.config).rollback()
+
+    def run_distributed_role(self, role):
+        self._check_options()
+
+        # Workers share the site map directory, so they cannot keep a checkpoint or a recording there
+        if self.config.checkpoint_interval or self.config.resume or self.config.record_file_path:
+            raise Exception('Checkpoints, resuming and recording cannot be used in a distributed generation')
+
+        distributed_generation = DistributedGeneration(self.config, self)
+
+        if role == 'coordinate':
+            distributed_generation.coordinate()
+        elif role == 'work':
+            distributed_generation.work()
+        elif role == 'merge':
+            distributed_generation.merge()
+
+    def _check_options(self):
+        if self.config.checkpoint_interval and (self.config.slices > 1 or self.config.shards > 1):
+            raise Exception('Checkpoints can only be used when reading a single slice in a single shard')
+
+        # Elasticsearch cannot combine search_after with scroll slices
+        if self._is_sorted() and self.config.slices > 1 and self.config.slice_method == 'scroll':
+            raise Exception('Sorted extraction and incremental runs can only read several slices with the shards '
+                            'slice method')
+
+        # A recording holds the records in the order the run reads them, which only a single slice
+        # of a single shard keeps. A resumed run would not record the records read before it.
+        if self.config.record_file_path and (
+                self.config.slices > 1 or self.config.shards > 1 or self.config.resume):
+            raise Exception('Elasticsearch pages can only be recorded when reading a single slice in a single shard, '
+                            'without resuming')
+
+    def _generate_and_publish(self):
+        publisher = SiteMapPublisher(self.config)
+        staging_directory_path = None
+
+        if self.config.resume:
+            staging_directory_path = publisher.find_resumable_staging_directory()
+
+        if not staging_directory_path:
+            staging_directory_path = publisher.create_staging_directory(
+                self.config.incremental or self.config.skip_unchanged_files)
+
+        try:
+            self._generate(staging_directory_path)
+            publisher.publish(staging_directory_path)
+        except Exception:
+            # A checkpointed staging directory is kept so the run can be resumed
+            if not self.config.checkpoint_interval:
+                publisher.discard(staging_directory_path)
+            raise
+
+    def _generate(self, site_map_directory_path):
+        with create_sink(self.config) as sink:
+            site_map_creator = SiteMapCreator(self.config, site_map_directory_path, sink=sink)
+            manifest = site_map_creator.load_manifest() if self.config.incremental else None
+
+            if manifest:
+                self._update_site_map(site_map_creator, manifest)
+            else:
+                self._create_site_map(site_map_creator)
+
+            site_map_creator.save_manifest()
+            site_map_creator.finish_sink()
+
+    def generate_shard(self, site_map_directory_path, shard_number, query):
+        file_name_prefix = '{}_{}'.format(self.config.base_site_map_filename, shard_number)
+        site_map_creator = SiteMapCreator(self.config, site_map_directory_path, file_name_prefix)
+
+        if self.config.skip_unchanged_files:
+            site_map_creator.load_previous_site_map_files()
+
+        with self._create_client(query, sort=self._is_sorted()) as client:
+            self._add_addresses_to_site_map(client, site_map_creator)
+
+        site_map_creator.wait_for_compressed_files()
+        LOGGER.info('Completed shard {} with {} site map files'.format(shard_number, len(site_map_creator.site_map_files)))
+        return site_map_creator.site_map_files
+
+    def _create_site_map(self, site_map_creator):
+        if self.config.skip_unchanged_files:
+            site_map_creator.load_previous_site_map_files()
+
+        if self.config.shards > 1:
+            self._create_sharded_site_map(site_map_creator)
+            return
+
+        checkpoint = site_map_creator.load_checkpoint() if self.config.resume else None
+        search_after = None
+
+        if checkpoint:
+            LOGGER.info('Resuming after {} site map files'.format(len(checkpoint.files)))
+            site_map_creator.clear_site_map_directory(except_file_names=site_map_creator.site_map_file_names)
+            search_after = checkpoint.cursor
+        else:
+            site_map_creator.clear_site_map_directory()
+
+        # Checkpoints need a stable order to resume in
+        sort = self._is_sorted() or self.config.checkpoint_interval > 0
 
-        with ElasticsearchClient(self.config) as client:
+        with self._create_client(sort=sort, search_after=search_after) as client:
             self._add_addresses_to_site_map(client, site_map_creator)
+
+            if self.config.skip_unchanged_files:
+                site_map_creator.remove_stale_site_map_files()
+
             site_map_creator.create_site_map_index_file()
 
-        LOGGER.info('Completed generating site map')
+        site_map_creator.remove_checkpoint()
+
+    # Each shard is generated by its own process, with its own Elasticsearch client and site map
+    # files named basename_<shard>_X.xml. The index lists the shards' files in shard order. The
+    # shards only write to the site map directory, and their files go to the sink once all are done.
+    def _create_sharded_site_map(self, site_map_creator):
+        site_map_creator.clear_site_map_directory()
+        shard_queries = get_shard_queries(self.config.shards, self.config.shard_field)
+        LOGGER.info('Generating site map in {} shards'.format(len(shard_queries)))
+
+        with multiprocessing.Pool(len(shard_queries)) as pool:
+            shard_results = pool.starmap(generate_shard, [
+                (self.config, site_map_creator.site_map_directory_path, shard_number, query)
+                for shard_number, query in enumerate(shard_queries)
+            ])
+
+        for site_map_files, shard_metrics in shard_results:
+            site_map_creator.add_site_map_files(site_map_files)
+            METRICS.merge(shard_metrics)
+
+        if self.config.skip_unchanged_files:
+            site_map_creator.remove_stale_site_map_files()
+
+        site_map_creator.create_site_map_index_file()
+
+    def _update_site_map(self, site_map_creator, manifest):
+        LOGGER.info('Updating site map with records modified since {}'.format(manifest.high_water_mark))
+
+        with self._create_client(get_modified_since_query(manifest.high_water_mark)) as client:
+            changed_urls = self._read_all_records(client)
+
+        SiteMapUpdater(self.config, site_map_creator).apply_changes(changed_urls)
+        site_map_creator.create_site_map_index_file()
+
+        # Files added for new URLs save checkpoints without a cursor, which cannot be resumed from
+        site_map_creator.remove_checkpoint()
+
+    # Incremental runs update the files of a full run by their location ranges, which only stay
+    # narrow when the full run reads records in order
+    def _is_sorted(self):
+        return self.config.sorted_extraction or self.config.incremental
+
+    def _create_client(self, query=None, sort=False, search_after=None):
+        if self.config.snapshot_file_path:
+            client = SnapshotClient(self.config, query=query, sort=sort, search_after=search_after)
+        elif self.config.slices > 1:
+            client = SlicedElasticsearchClient(self.config, query=query, sort=sort)
+        else:
+            client = ElasticsearchClient(self.config, query=query, sort=sort, search_after=search_after)
+
+        if self.config.prefetch_depth > 0:
+            return PrefetchingClient(client, self.config.prefetch_depth)
+
+        return client
 
     def _add_addresses_to_site_map(self, client, site_map):
+        if self.config.dedup_mode:
+            with create_url_deduplicator(self.config) as deduplicator:
+                self._append_all_records(client, site_map, deduplicator.filter)
+        else:
+            self._append_all_records(client, site_map, lambda site_map_entries: site_map_entries)
+
+        site_map.flush_site_map()
+
+    def _append_all_records(self, client, site_map, filter_entries):
         site_map_entries = client.next_page_of_records()
 
         while site_map_entries:
-            site_map.append_urls_to_site_map(site_map_entries)
+            site_map.append_urls_to_site_map(filter_entries(site_map_entries))
             site_map_entries = client.next_page_of_records()
 
-        site_map.flush_site_map()
+    def _read_all_records(self, client):
+        pages = []
+        site_map_entries = client.next_page_of_records()
 
+        while site_map_entries:
+            pages.append(site_map_entries)
+            site_map_entries = client.next_page_of_records()
 
-def setup_logging(logging_config_file_path):
-    try:
-        with open(logging_config_file_path, 'rt') as file:
-            config = json.load(file)
-        logging.config.dictConfig(config)
-    except IOError as e:
-        raise(Exception('Failed to load logging configuration', e))
+        return concatenate_pages(pages)
+
+
+# Shard processes start with a copy of the parent's metrics, so they only report their own
+def generate_shard(config, site_map_directory_path, shard_number, query):
+    METRICS.reset()
+    site_map_files = Generator(config).generate_shard(site_map_directory_path, shard_number, query)
+    return site_map_files, METRICS.snapshot()
 
 
 if __name__ == '__main__':    
@@ -50,6 +242,12 @@ if __name__ == '__main__':
     
     try:
         setup_logging(config.logging_config_file_path)
-        Generator(config).generate_property_site_map()
+
+        if config.rollback:
+            Generator(config).rollback_property_site_map()
+        elif config.distributed_role:
+            Generator(config).run_distributed_role(config.distributed_role)
+        else:
+            Generator(config).generate_property_site_map()
     except Exception as e:
         LOGGER.error("An error occurred when running the script", e)
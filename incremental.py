@@ -0,0 +1,161 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from itertools import accumulate
+from models import SiteMapUrlPage, create_page
+from site_map_writer import get_url_entry_size
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+def get_modified_since_query(high_water_mark):
+    if not high_water_mark:
+        return None
+
+    # The high water mark is a site map lastmod value, which is only precise to the minute,
+    # so the records from that minute are read again
+    modified_since = datetime.strptime(high_water_mark, '%Y-%m-%dT%H:%M+00:00')
+    return {'range': {'entryDatetime': {'gte': modified_since.strftime('%Y-%m-%dT%H:%M:%S+00')}}}
+
+
+class SiteMapUpdater():
+
+    def __init__(self, config, site_map_creator):
+        self.config = config
+        self.site_map_creator = site_map_creator
+        self.file_contents = {}
+        self.file_sizes = {}
+        self.change_frequency = None
+
+    # Changes and file contents are held as pages of columns, with the change frequency kept
+    # once per page rather than on every URL
+    def apply_changes(self, urls):
+        if not isinstance(urls, SiteMapUrlPage):
+            urls = create_page(urls)
+
+        self.change_frequency = urls.change_frequency
+        changes = dict(zip(urls.locations, urls.last_modified))
+        LOGGER.info('Applying {} changed site map URLs'.format(len(changes)))
+
+        modified_file_names = self._update_existing_urls(changes)
+        new_locations = sorted(changes)
+        overflow_locations = []
+        file_ranges = SiteMapFileRanges(self.site_map_creator.site_map_files)
+
+        for location in new_locations:
+            entry_size = get_url_entry_size(
+                location, changes[location], self.change_frequency, self.config.file_encoding)
+            file_name = self._find_file_with_space(location, entry_size, file_ranges)
+
+            if file_name:
+                self.file_sizes[file_name] += entry_size
+                file_contents = self._get_file_contents(file_name)
+                file_contents.locations.append(location)
+                file_contents.last_modified.append(changes[location])
+                file_contents.change_frequency = self.change_frequency
+                modified_file_names.add(file_name)
+            else:
+                overflow_locations.append(location)
+
+        for file_name in list(self.site_map_creator.site_map_file_names):
+            if file_name in modified_file_names:
+                refused_urls = self.site_map_creator.rewrite_site_map_file(file_name, self.file_contents[file_name])
+                overflow_locations += refused_urls.locations
+                changes.update(zip(refused_urls.locations, refused_urls.last_modified))
+
+        if overflow_locations:
+            self.site_map_creator.append_urls_to_site_map(SiteMapUrlPage(
+                overflow_locations, [changes[location] for location in overflow_locations], self.change_frequency))
+            self.site_map_creator.flush_site_map()
+
+        LOGGER.info('Rewrote {} site map files and added {} new URLs'.format(
+            len(modified_file_names), len(new_locations)))
+
+    # Removes the URLs found in existing files from the changes and returns the names of the
+    # files where any of them has a different entry now
+    def _update_existing_urls(self, changes):
+        changed_locations = sorted(changes)
+        modified_file_names = set()
+
+        for site_map_file in self.site_map_creator.site_map_files:
+            start = bisect_left(changed_locations, site_map_file['first_location'])
+            end = bisect_right(changed_locations, site_map_file['last_location'])
+
+            if not any(location in changes for location in changed_locations[start:end]):
+                continue
+
+            file_contents = self._get_file_contents(site_map_file['name'])
+
+            for i, location in enumerate(file_contents.locations):
+                if location not in changes:
+                    continue
+
+                last_modified = changes.pop(location)
+
+                if (last_modified != file_contents.last_modified[i] or
+                        self.change_frequency != file_contents.change_frequency):
+                    file_contents.last_modified[i] = last_modified
+                    file_contents.change_frequency = self.change_frequency
+                    modified_file_names.add(site_map_file['name'])
+
+        return modified_file_names
+
+    # New URLs go to a file whose key range already covers them, then to the last file,
+    # and only then to new files
+    def _find_file_with_space(self, location, entry_size, file_ranges):
+        site_map_files = self.site_map_creator.site_map_files
+
+        for site_map_file in file_ranges.find_files_covering(location):
+            if self._has_space(site_map_file, entry_size):
+                return site_map_file['name']
+
+        if site_map_files and self._has_space(site_map_files[-1], entry_size):
+            return site_map_files[-1]['name']
+
+        return None
+
+    # The byte count is taken from the manifest and grows with the URLs added here. Manifests
+    # written before byte counts were recorded leave the size limit to the rewrite, which
+    # returns the URLs that do not fit.
+    def _has_space(self, site_map_file, entry_size):
+        file_name = site_map_file['name']
+
+        if file_name in self.file_contents:
+            nof_urls = len(self.file_contents[file_name])
+        else:
+            nof_urls = site_map_file['url_count']
+
+        if file_name not in self.file_sizes:
+            self.file_sizes[file_name] = site_map_file.get('byte_count', 0)
+
+        return (nof_urls < self.config.max_urls_per_file and
+                self.file_sizes[file_name] + entry_size <= self.config.max_bytes_per_file)
+
+    def _get_file_contents(self, file_name):
+        if file_name not in self.file_contents:
+            self.file_contents[file_name] = self.site_map_creator.read_site_map_file(file_name)
+
+        return self.file_contents[file_name]
+
+
+# The location ranges of the site map files, sorted on their first location. Each file also
+# keeps the furthest last location of the files up to it, so that the search for the files
+# covering a location stops at the first file none of the files before can reach.
+class SiteMapFileRanges():
+
+    def __init__(self, site_map_files):
+        self.site_map_files = sorted(
+            (site_map_file for site_map_file in site_map_files if site_map_file['first_location'] is not None),
+            key=lambda site_map_file: site_map_file['first_location'])
+        self.first_locations = [site_map_file['first_location'] for site_map_file in self.site_map_files]
+        self.furthest_last_locations = list(
+            accumulate((site_map_file['last_location'] for site_map_file in self.site_map_files), max))
+
+    # Files nearest to the location come first
+    def find_files_covering(self, location):
+        i = bisect_right(self.first_locations, location)
+
+        while i > 0 and self.furthest_last_locations[i - 1] >= location:
+            i -= 1
+
+            if self.site_map_files[i]['last_location'] >= location:
+                yield self.site_map_files[i]
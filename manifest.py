@@ -0,0 +1,36 @@
+from atomic_file import save_atomically
+import json
+import os
+
+class SiteMapManifest():
+
+    def __init__(self, high_water_mark=None, files=None):
+        self.high_water_mark = high_water_mark
+        self.files = files or []
+
+    def to_json(self):
+        return {
+            'high_water_mark': self.high_water_mark,
+            'url_count': sum(site_map_file['url_count'] for site_map_file in self.files),
+            'files': self.files,
+        }
+
+
+def load_manifest(file_path):
+    if not os.path.isfile(file_path):
+        return None
+
+    try:
+        with open(file_path, 'rt') as file:
+            manifest = json.load(file)
+
+        return SiteMapManifest(manifest['high_water_mark'], manifest['files'])
+    except Exception as e:
+        raise Exception('Failed to load site map manifest: {}'.format(file_path), e)
+
+
+def save_manifest(manifest, file_path):
+    try:
+        save_atomically(file_path, json.dumps(manifest.to_json(), indent=2, sort_keys=True))
+    except Exception as e:
+        raise Exception('Failed to save site map manifest: {}'.format(file_path), e)
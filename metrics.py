@@ -0,0 +1,168 @@
+from atomic_file import save_atomically
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+LOGGER = logging.getLogger(__name__)
+
+PROMETHEUS_METRIC_PREFIX = 'property_site_map'
+
+# Time spent in each stage of a run and counts of what went through it. Stages timed in several
+# threads add up, so they can exceed the total time of the run.
+class Metrics():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stage_seconds = defaultdict(float)
+            self.stage_calls = defaultdict(int)
+            self.counters = defaultdict(int)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_calls[stage] += calls
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {
+                    stage: {'seconds': seconds, 'calls': self.stage_calls[stage]}
+                    for stage, seconds in self.stage_seconds.items()
+                },
+                'counters': dict(self.counters),
+            }
+
+    # Adds the metrics of another process, such as a shard
+    def merge(self, snapshot):
+        for stage, timing in snapshot['stages'].items():
+            self.add_time(stage, timing['seconds'], timing['calls'])
+
+        for counter, value in snapshot['counters'].items():
+            self.increment(counter, value)
+
+
+METRICS = Metrics()
+
+
+def report_metrics(config, snapshot):
+    log_metrics_summary(snapshot)
+
+    if config.metrics_file_path:
+        save_metrics_file(snapshot, config.metrics_file_path)
+
+    if config.prometheus_file_path:
+        save_prometheus_file(snapshot, config.prometheus_file_path)
+
+
+def log_metrics_summary(snapshot):
+    total_seconds = snapshot['stages'].get('total', {}).get('seconds', 0)
+    nof_records = snapshot['counters'].get('records', 0)
+
+    LOGGER.info('Processed {} records in {:.3f}s ({:.0f} records/s)'.format(
+        nof_records, total_seconds, nof_records / total_seconds if total_seconds else 0))
+
+    for stage, timing in sorted(snapshot['stages'].items()):
+        LOGGER.info('Stage {}: {:.3f}s in {} calls'.format(stage, timing['seconds'], timing['calls']))
+
+    for counter, value in sorted(snapshot['counters'].items()):
+        LOGGER.info('Counter {}: {}'.format(counter, value))
+
+
+def save_metrics_file(snapshot, file_path):
+    _save_metrics_file(file_path, json.dumps(snapshot, indent=2, sort_keys=True))
+
+
+# Written in the format of the node exporter's textfile collector, which requires files to be
+# replaced atomically. Every value describes the last run, so they are all gauges.
+def save_prometheus_file(snapshot, file_path):
+    lines = [
+        '# HELP {}_stage_seconds Time spent in each stage of the last run.'.format(PROMETHEUS_METRIC_PREFIX),
+        '# TYPE {}_stage_seconds gauge'.format(PROMETHEUS_METRIC_PREFIX),
+    ]
+    lines += [
+        '{}_stage_seconds{{stage="{}"}} {}'.format(PROMETHEUS_METRIC_PREFIX, stage, timing['seconds'])
+        for stage, timing in sorted(snapshot['stages'].items())
+    ]
+    lines += [
+        '# HELP {}_stage_calls Number of times each stage ran in the last run.'.format(PROMETHEUS_METRIC_PREFIX),
+        '# TYPE {}_stage_calls gauge'.format(PROMETHEUS_METRIC_PREFIX),
+    ]
+    lines += [
+        '{}_stage_calls{{stage="{}"}} {}'.format(PROMETHEUS_METRIC_PREFIX, stage, timing['calls'])
+        for stage, timing in sorted(snapshot['stages'].items())
+    ]
+
+    for counter, value in sorted(snapshot['counters'].items()):
+        lines += [
+            '# TYPE {}_{} gauge'.format(PROMETHEUS_METRIC_PREFIX, counter),
+            '{}_{} {}'.format(PROMETHEUS_METRIC_PREFIX, counter, value),
+        ]
+
+    lines += [
+        '# TYPE {}_last_run_timestamp_seconds gauge'.format(PROMETHEUS_METRIC_PREFIX),
+        '{}_last_run_timestamp_seconds {}'.format(PROMETHEUS_METRIC_PREFIX, time.time()),
+    ]
+
+    _save_metrics_file(file_path, '\n'.join(lines) + '\n')
+
+
+# Profiles the run with cProfile, which only sees the main thread, and traces memory allocations
+# with tracemalloc, as configured
+@contextmanager
+def profiling(config):
+    profile = cProfile.Profile() if config.profile_file_path else None
+
+    if config.trace_memory:
+        tracemalloc.start()
+
+    if profile:
+        profile.enable()
+
+    try:
+        yield
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(config.profile_file_path)
+            LOGGER.info('Saved profile to {}'.format(config.profile_file_path))
+
+        if config.trace_memory:
+            _log_memory_trace()
+            tracemalloc.stop()
+
+
+def _log_memory_trace(nof_allocation_sites=10):
+    current, peak = tracemalloc.get_traced_memory()
+    LOGGER.info('Traced memory: {} bytes allocated, {} bytes at peak'.format(current, peak))
+
+    for statistic in tracemalloc.take_snapshot().statistics('lineno')[:nof_allocation_sites]:
+        LOGGER.info('Allocated: {}'.format(statistic))
+
+
+def _save_metrics_file(file_path, content):
+    try:
+        save_atomically(file_path, content)
+    except Exception as e:
+        raise Exception('Failed to save metrics file: {}'.format(file_path), e)
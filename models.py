@@ -1,3 +1,60 @@
 from collections import namedtuple
 
-SiteMapUrl = namedtuple('SiteMapEntry', ['location', 'last_modified', 'change_frequency'])
+SiteMapUrl = namedtuple('SiteMapEntry', ['location', 'last_modified', 'change_frequency', 'cursor'])
+
+# The cursor holds the sort values of the record when it was read in sorted order, so that
+# reading can be resumed after it
+SiteMapUrl.__new__.__defaults__ = (None,)
+
+
+# A page of site map URLs held as columns, so that no object is created per URL. Every URL in a
+# page has the same change frequency, which is only held once.
+class SiteMapUrlPage():
+
+    __slots__ = ['locations', 'last_modified', 'change_frequency', 'cursors']
+
+    def __init__(self, locations, last_modified, change_frequency, cursors=None):
+        self.locations = locations
+        self.last_modified = last_modified
+        self.change_frequency = change_frequency
+        self.cursors = cursors
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, index):
+        cursors = self.cursors[index] if self.cursors is not None else None
+
+        if isinstance(index, slice):
+            return SiteMapUrlPage(self.locations[index], self.last_modified[index], self.change_frequency, cursors)
+
+        return SiteMapUrl(self.locations[index], self.last_modified[index], self.change_frequency, cursors)
+
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self[i]
+
+
+# All URLs take the change frequency of the first one
+def create_page(urls):
+    urls = list(urls)
+
+    return SiteMapUrlPage(
+        [url.location for url in urls],
+        [url.last_modified for url in urls],
+        urls[0].change_frequency if urls else None,
+    )
+
+
+def concatenate_pages(pages):
+    pages = [page for page in pages if len(page)]
+
+    if len(pages) == 1:
+        return pages[0]
+
+    return SiteMapUrlPage(
+        [location for page in pages for location in page.locations],
+        [last_modified for page in pages for last_modified in page.last_modified],
+        pages[0].change_frequency if pages else None,
+        [cursor for page in pages for cursor in page.cursors] if pages and pages[0].cursors is not None else None,
+    )
@@ -0,0 +1,54 @@
+import queue
+import threading
+
+class PrefetchingClient():
+
+    def __init__(self, client, queue_depth):
+        self.client = client
+        self.pages = queue.Queue(maxsize=queue_depth)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.producer = threading.Thread(target=self._fetch_pages, name='prefetch', daemon=True)
+
+    def __enter__(self):
+        self.client.__enter__()
+        self.producer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # The producer has to stop using the scroll before the wrapped client clears it
+        self.stopped.set()
+        self.producer.join()
+        return self.client.__exit__(exc_type, exc_val, exc_tb)
+
+    def next_page_of_records(self):
+        if self.finished:
+            return []
+
+        page = self.pages.get()
+
+        if isinstance(page, Exception):
+            self.finished = True
+            raise page
+
+        self.finished = not page
+        return page
+
+    def _fetch_pages(self):
+        try:
+            while not self.stopped.is_set():
+                page = self.client.next_page_of_records()
+                self._put(page)
+
+                if not page:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
@@ -0,0 +1,202 @@
+from datetime import datetime
+from atomic_file import save_atomically
+import json
+import logging
+import os
+import shutil
+from site_map import is_site_map_index_file
+
+LOGGER = logging.getLogger(__name__)
+
+GENERATION_NAME_FORMAT = '%Y%m%dT%H%M%S%f'
+
+# Generations are published in turn, and a rollback returns to the one published before. The
+# history of publications, oldest first, decides which generations are kept and which one a
+# rollback returns to, as it differs from the order of the generations once one is rolled back.
+class SiteMapPublisher():
+
+    def __init__(self, config):
+        self.config = config
+        self.site_map_directory_path = os.path.normpath(config.site_map_directory_path)
+        self.generations_directory_path = '{}.generations'.format(self.site_map_directory_path)
+        self.history_file_path = '{}.history.json'.format(self.site_map_directory_path)
+
+    def create_staging_directory(self, seed_with_published_files=False):
+        try:
+            os.makedirs(self.generations_directory_path, exist_ok=True)
+            staging_directory_path = self._get_generation_path(datetime.now().strftime(GENERATION_NAME_FORMAT))
+            os.mkdir(staging_directory_path)
+
+            if seed_with_published_files:
+                self._link_published_files(staging_directory_path)
+        except Exception as e:
+            raise Exception('Failed to create site map staging directory', e)
+
+        LOGGER.info('Building site map in {}'.format(staging_directory_path))
+        return staging_directory_path
+
+    def find_resumable_staging_directory(self):
+        if not os.path.isdir(self.generations_directory_path):
+            return None
+
+        history = self._load_history()
+
+        # Staging directories are the generations created since the last publication
+        generations = [
+            generation for generation in self._list_generations()
+            if generation not in history and (not history or generation > history[-1])
+        ]
+
+        for generation in reversed(generations):
+            generation_path = self._get_generation_path(generation)
+
+            if os.path.isfile(os.path.join(generation_path, self.config.checkpoint_filename)):
+                LOGGER.info('Resuming site map build in {}'.format(generation_path))
+                return generation_path
+
+        return None
+
+    def publish(self, staging_directory_path):
+        try:
+            self._sync_directory(staging_directory_path)
+            history = self._load_history()
+
+            if os.path.isdir(self.site_map_directory_path) and not os.path.islink(self.site_map_directory_path):
+                history.append(self._adopt_site_map_directory())
+
+            self._point_site_map_directory_to(staging_directory_path)
+            history.append(os.path.basename(staging_directory_path))
+            self._remove_old_generations(history)
+        except Exception as e:
+            raise Exception('Failed to publish site map from {}'.format(staging_directory_path), e)
+
+        LOGGER.info('Published site map from {}'.format(staging_directory_path))
+
+    def discard(self, staging_directory_path):
+        shutil.rmtree(staging_directory_path, ignore_errors=True)
+        LOGGER.info('Discarded site map staging directory {}'.format(staging_directory_path))
+
+    # The generation rolled back from is removed, so that it cannot be published again by mistake
+    def rollback(self):
+        history = self._load_history()
+
+        if len(history) < 2:
+            raise Exception('There is no previous site map generation to roll back to')
+
+        current_generation = history.pop()
+        previous_generation = history[-1]
+        self._point_site_map_directory_to(self._get_generation_path(previous_generation))
+        self._save_history(history)
+        shutil.rmtree(self._get_generation_path(current_generation), ignore_errors=True)
+        LOGGER.info('Rolled site map back to generation {}'.format(previous_generation))
+
+    def _link_published_files(self, staging_directory_path):
+        if not os.path.isdir(self.site_map_directory_path):
+            return
+
+        # Files are only ever replaced by rename, never rewritten in place, so the published
+        # generation is not affected when the staging copy of a file changes
+        for file_name in os.listdir(self.site_map_directory_path):
+            source_path = os.path.join(self.site_map_directory_path, file_name)
+
+            if os.path.isfile(source_path) and not is_site_map_index_file(self.config, file_name):
+                target_path = os.path.join(staging_directory_path, file_name)
+
+                try:
+                    os.link(source_path, target_path)
+                except OSError:
+                    shutil.copy2(source_path, target_path)
+
+    def _sync_directory(self, directory_path):
+        for file_name in os.listdir(directory_path):
+            file_path = os.path.join(directory_path, file_name)
+
+            if os.path.isfile(file_path):
+                with open(file_path, 'rb') as file:
+                    os.fsync(file.fileno())
+
+        self._sync_directory_entries(directory_path)
+
+    def _sync_directory_entries(self, directory_path):
+        directory = os.open(directory_path, os.O_RDONLY)
+
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    # A site map directory from before generations were used becomes the oldest generation.
+    # Replacing a directory with a link cannot be done atomically, so this leaves a short gap once.
+    def _adopt_site_map_directory(self):
+        modified = datetime.fromtimestamp(os.path.getmtime(self.site_map_directory_path))
+        generation = modified.strftime(GENERATION_NAME_FORMAT)
+        os.rename(self.site_map_directory_path, self._get_generation_path(generation))
+        LOGGER.warning('Moved existing site map directory to {}'.format(self._get_generation_path(generation)))
+        return generation
+
+    def _point_site_map_directory_to(self, generation_path):
+        parent_directory_path = os.path.dirname(os.path.abspath(self.site_map_directory_path))
+        link_path = '{}.link'.format(self.site_map_directory_path)
+
+        if os.path.lexists(link_path):
+            os.unlink(link_path)
+
+        os.symlink(os.path.relpath(generation_path, parent_directory_path), link_path)
+        os.replace(link_path, self.site_map_directory_path)
+        self._sync_directory_entries(parent_directory_path)
+
+    def _remove_old_generations(self, history):
+        nof_removed_generations = max(len(history) - self.config.keep_generations - 1, 0)
+
+        for generation in history[:nof_removed_generations]:
+            shutil.rmtree(self._get_generation_path(generation), ignore_errors=True)
+            LOGGER.info('Removed old site map generation {}'.format(generation))
+
+        self._save_history(history[nof_removed_generations:])
+
+    # Without a history, as before there was one, the generations up to the published one are
+    # taken to have been published in order. The published generation always comes last, even if
+    # a run stopped before recording it.
+    def _load_history(self):
+        if not os.path.isdir(self.generations_directory_path):
+            return []
+
+        generations = self._list_generations()
+        published_generation = self._get_published_generation()
+
+        if os.path.isfile(self.history_file_path):
+            try:
+                with open(self.history_file_path, 'rt') as file:
+                    history = json.load(file)
+            except Exception as e:
+                raise Exception('Failed to load site map publication history: {}'.format(self.history_file_path), e)
+        elif published_generation in generations:
+            history = generations[:generations.index(published_generation) + 1]
+        else:
+            history = []
+
+        history = [generation for generation in history if generation in generations]
+
+        if published_generation in generations and history[-1:] != [published_generation]:
+            history = [generation for generation in history if generation != published_generation]
+            history.append(published_generation)
+
+        return history
+
+    def _save_history(self, history):
+        save_atomically(self.history_file_path, json.dumps(history))
+
+    def _list_generations(self):
+        return sorted(
+            name for name in os.listdir(self.generations_directory_path)
+            if os.path.isdir(self._get_generation_path(name))
+        )
+
+    def _get_published_generation(self):
+        if not os.path.islink(self.site_map_directory_path):
+            return None
+
+        return os.path.basename(os.path.normpath(os.readlink(self.site_map_directory_path)))
+
+    def _get_generation_path(self, generation):
+        return os.path.join(self.generations_directory_path, generation)
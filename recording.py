@@ -0,0 +1,30 @@
+import json
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Saves the hits read from Elasticsearch as a snapshot, which can be read again instead of the
+# cluster, in the order they were read
+class SnapshotRecorder():
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'wt')
+
+    # Only the source and sort values of each hit are kept, which is all the generator reads
+    def record(self, address_page):
+        lines = ''.join(
+            json.dumps({key: address[key] for key in ('_source', 'sort') if key in address}, separators=(',', ':')) + '\n'
+            for address in address_page
+        )
+
+        self.file.write(lines)
+
+    def close(self):
+        self.file.close()
+        LOGGER.info('Saved snapshot: {}'.format(self.file_path))
+
+
+def create_snapshot_recorder(config):
+    return SnapshotRecorder(config.record_file_path) if config.record_file_path else None
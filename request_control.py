@@ -0,0 +1,141 @@
+from elasticsearch import ConnectionError as ElasticsearchConnectionError, TransportError
+from metrics import METRICS
+import logging
+import random
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Responses of a cluster that turned the request away without carrying it out
+REJECTED_STATUS_CODES = {429, 503}
+
+# Responses of a proxy that gave up waiting, while the cluster may still have carried the request out
+GATEWAY_STATUS_CODES = {502, 504}
+
+
+# A request that failed after reaching the cluster may still have been carried out, which moves a
+# scroll on to its next page. Only requests that can be repeated, such as a search, are retried
+# after failed connections and timeouts, so that a page of a scroll is never skipped.
+def is_transient_error(e, repeatable):
+    if isinstance(e, ElasticsearchConnectionError):
+        return repeatable
+
+    if isinstance(e, TransportError):
+        return e.status_code in REJECTED_STATUS_CODES or (repeatable and e.status_code in GATEWAY_STATUS_CODES)
+
+    return False
+
+
+# Retries transient failures after a random delay of up to backoff_seconds, doubled for every
+# attempt. The random delay keeps slices that failed together from retrying together.
+class RetryPolicy():
+
+    def __init__(self, max_retries, backoff_seconds, max_backoff_seconds=60, sleep=time.sleep):
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.sleep = sleep
+
+    def call(self, request, repeatable, on_retry=None):
+        attempt = 0
+
+        while True:
+            try:
+                return request()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient_error(e, repeatable):
+                    raise
+
+                delay = random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+                attempt += 1
+                LOGGER.warning('Retrying elasticsearch request in {:.1f}s after attempt {} failed: {}'.format(
+                    delay, attempt, e))
+                METRICS.increment('request_retries')
+
+                if on_retry:
+                    on_retry()
+
+                with METRICS.time('retry_backoff'):
+                    self.sleep(delay)
+
+
+# Keeps requests near a target latency and responses under a maximum size. The page size is halved
+# after a slow or large response and grows by a quarter after one well within both limits.
+class AdaptivePageSize():
+
+    def __init__(self, page_size, min_page_size, max_page_size, target_seconds, max_response_bytes):
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.target_seconds = target_seconds
+        self.max_response_bytes = max_response_bytes
+        self.size = min(max(page_size, min_page_size), max_page_size)
+
+    def observe(self, seconds, nof_response_bytes):
+        if seconds > self.target_seconds or nof_response_bytes > self.max_response_bytes:
+            self.shrink()
+        elif seconds < self.target_seconds / 2 and nof_response_bytes < self.max_response_bytes / 2:
+            self._resize(self.size + max(1, self.size // 4))
+
+    def shrink(self):
+        self._resize(self.size // 2)
+
+    def _resize(self, size):
+        size = min(max(size, self.min_page_size), self.max_page_size)
+
+        if size != self.size:
+            LOGGER.info('Changing page size from {} to {}'.format(self.size, size))
+            self.size = size
+
+
+def create_page_size(config):
+    if not config.adaptive_page_size:
+        return AdaptivePageSize(config.page_size, config.page_size, config.page_size, float('inf'), float('inf'))
+
+    return AdaptivePageSize(
+        config.page_size,
+        config.min_page_size,
+        config.max_page_size,
+        config.target_latency_seconds,
+        config.max_response_mb * 1024 * 1024,
+    )
+
+
+# Spaces requests out to at most max_requests_per_second and, once documents have been received,
+# holds the next request back until they fit within max_documents_per_second. A limit of 0 does
+# not limit anything. Slices share one limiter, so the limits hold for the run as a whole.
+class RateLimiter():
+
+    def __init__(self, max_requests_per_second=0, max_documents_per_second=0, clock=time.monotonic, sleep=time.sleep):
+        self.max_requests_per_second = max_requests_per_second
+        self.max_documents_per_second = max_documents_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_request_time = 0
+        self.next_document_time = 0
+
+    def wait_for_request(self):
+        with self.lock:
+            now = self.clock()
+            start = max(now, self.next_request_time, self.next_document_time)
+
+            if self.max_requests_per_second:
+                self.next_request_time = start + 1 / self.max_requests_per_second
+
+        # The slot is taken before sleeping, so that requests waiting together start one after another
+        if start > now:
+            with METRICS.time('throttling'):
+                self.sleep(start - now)
+
+    def record_documents(self, nof_documents):
+        if not self.max_documents_per_second:
+            return
+
+        with self.lock:
+            self.next_document_time = (
+                max(self.next_document_time, self.clock()) + nof_documents / self.max_documents_per_second)
+
+
+def create_rate_limiter(config):
+    return RateLimiter(config.max_requests_per_second, config.max_documents_per_second)
@@ -0,0 +1,125 @@
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+from xml.etree.ElementTree import fromstring
+from xml.sax.saxutils import escape
+import hashlib
+import hmac
+import urllib3
+
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+SIGNING_ALGORITHM = 'AWS4-HMAC-SHA256'
+
+
+# Signs a request with AWS Signature Version 4, adding the headers it needs to the given ones.
+# The payload hash is the hex SHA-256 of the body.
+def sign_request(method, host, path, query, headers, payload_hash, access_key, secret_key, region, now=None):
+    amz_date = (now or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+    date = amz_date[:8]
+
+    headers['host'] = host
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+
+    signed_headers = sorted(name.lower() for name in headers)
+    lowered_headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+    canonical_request = '\n'.join([
+        method,
+        quote(path, safe='/~'),
+        encode_query(query),
+        ''.join('{}:{}\n'.format(name, lowered_headers[name]) for name in signed_headers),
+        ';'.join(signed_headers),
+        payload_hash,
+    ])
+    scope = '{}/{}/s3/aws4_request'.format(date, region)
+    string_to_sign = '\n'.join([
+        SIGNING_ALGORITHM, amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+    signing_key = ('AWS4' + secret_key).encode('utf-8')
+    for part in [date, region, 's3', 'aws4_request']:
+        signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+
+    headers['Authorization'] = '{} Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+        SIGNING_ALGORITHM,
+        access_key,
+        scope,
+        ';'.join(signed_headers),
+        hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest(),
+    )
+    return headers
+
+
+# Encoded as the signature requires, sorted by name, which is also a valid query string
+def encode_query(query):
+    return '&'.join(
+        '{}={}'.format(quote(name, safe='~'), quote(value, safe='~')) for name, value in sorted(query.items()))
+
+
+# The few object storage requests the site map needs, for any S3-compatible service. Buckets are
+# addressed by path, which every such service supports.
+class S3Client():
+
+    def __init__(self, endpoint_url, region, access_key, secret_key, max_connections=10):
+        self.endpoint_url = endpoint_url.rstrip('/')
+        self.host = urlsplit(self.endpoint_url).netloc
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.http = urllib3.PoolManager(maxsize=max_connections)
+
+    def put_object(self, bucket, key, body, content_type):
+        self._request('PUT', bucket, key, body=body, headers={'Content-Type': content_type})
+
+    def get_object(self, bucket, key):
+        return self._request('GET', bucket, key).data
+
+    def create_multipart_upload(self, bucket, key, content_type):
+        response = self._request('POST', bucket, key, query={'uploads': ''}, headers={'Content-Type': content_type})
+        return fromstring(response.data).findtext(S3_NAMESPACE + 'UploadId')
+
+    def upload_part(self, bucket, key, upload_id, part_number, body):
+        response = self._request(
+            'PUT', bucket, key, query={'partNumber': str(part_number), 'uploadId': upload_id}, body=body)
+        return response.headers['ETag']
+
+    # Parts are listed by number, with the ETag each of them was uploaded with
+    def complete_multipart_upload(self, bucket, key, upload_id, etags):
+        body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(''.join(
+            '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(part_number, escape(etag))
+            for part_number, etag in enumerate(etags, 1)
+        ))
+        response = self._request('POST', bucket, key, query={'uploadId': upload_id}, body=body.encode('utf-8'))
+
+        # The service may still fail the upload after accepting the request
+        if fromstring(response.data).tag == 'Error':
+            raise Exception('Failed to complete multipart upload of {}'.format(key), response.data)
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self._request('DELETE', bucket, key, query={'uploadId': upload_id})
+
+    def _request(self, method, bucket, key, query=None, body=b'', headers=None):
+        query = query or {}
+        path = '/{}/{}'.format(bucket, key)
+        headers = sign_request(
+            method,
+            self.host,
+            path,
+            query,
+            dict(headers or {}),
+            hashlib.sha256(body).hexdigest(),
+            self.access_key,
+            self.secret_key,
+            self.region,
+        )
+        url = self.endpoint_url + quote(path, safe='/~')
+
+        if query:
+            url += '?' + encode_query(query)
+
+        response = self.http.request(method, url, body=body or None, headers=headers, retries=False)
+
+        if response.status >= 300:
+            raise Exception('{} request for {} failed with status {}'.format(method, path, response.status),
+                            response.data)
+
+        return response
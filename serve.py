@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate, parsedate_to_datetime
+from datetime import datetime, timezone
+from manifest import load_manifest
+from site_map import is_site_map_index_file
+from sinks import get_content_type
+from logging_setup import setup_logging
+import gzip
+import logging
+import os
+import shutil
+import threading
+import settings
+
+LOGGER = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+# A file to serve, with the headers that identify its content. A compressed file is either sent
+# with its content encoding or decompressed on the way.
+class ServedFile():
+
+    def __init__(self, path, content_type, etag, last_modified):
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_encoding = None
+        self.decompress = False
+
+
+# Finds the files of the published site map. Only files listed in the manifest and the indexes are
+# served. Site map files are identified by the digest and date the manifest gives them, which stay
+# the same for files that did not change between runs. Indexes are not in the manifest, so they are
+# identified by their size and modification time.
+class SiteMapFiles():
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.manifest_key = None
+        self.manifest_files = {}
+
+    # A site map file is served as stored, or by its uncompressed name when only a compressed copy
+    # is stored, which is decompressed for clients that do not accept gzip. A compressed copy of
+    # any other file is served instead of it to clients that accept gzip.
+    def find(self, file_name, accepts_gzip):
+        # The directory is resolved once, so that all files of a request come from the same
+        # generation even if a new one is published meanwhile
+        directory_path = os.path.realpath(self.config.site_map_directory_path)
+        manifest_files = self._load_manifest_files(directory_path)
+        compressed_file_name = '{}.gz'.format(file_name)
+
+        if accepts_gzip or compressed_file_name in manifest_files:
+            compressed_file = self._find_file(directory_path, compressed_file_name, manifest_files)
+
+            if compressed_file:
+                compressed_file.content_type = get_content_type(file_name)
+
+                if accepts_gzip:
+                    compressed_file.content_encoding = 'gzip'
+                    compressed_file.etag = '"{}-gzip"'.format(compressed_file.etag.strip('"'))
+                else:
+                    compressed_file.decompress = True
+
+                return compressed_file
+
+        return self._find_file(directory_path, file_name, manifest_files)
+
+    def _find_file(self, directory_path, file_name, manifest_files):
+        if file_name not in manifest_files and not self._is_index_file(file_name):
+            return None
+
+        file_path = os.path.join(directory_path, file_name)
+
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+
+        manifest_file = manifest_files.get(file_name)
+
+        if manifest_file and manifest_file.get('digest'):
+            etag = '"{}"'.format(manifest_file['digest'])
+            last_modified = get_last_modified(manifest_file['last_modified'], stat.st_mtime)
+        else:
+            etag = '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+            last_modified = int(stat.st_mtime)
+
+        return ServedFile(file_path, get_content_type(file_name), etag, last_modified)
+
+    def _is_index_file(self, file_name):
+        base_name, extension = os.path.splitext(file_name)
+        return is_site_map_index_file(self.config, base_name if extension == '.gz' else file_name)
+
+    # The manifest is only read again once it has been replaced
+    def _load_manifest_files(self, directory_path):
+        manifest_path = os.path.join(directory_path, self.config.manifest_filename)
+
+        try:
+            stat = os.stat(manifest_path)
+            manifest_key = (manifest_path, stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            return {}
+
+        with self.lock:
+            if manifest_key != self.manifest_key:
+                manifest = load_manifest(manifest_path)
+                self.manifest_files = {site_map_file['name']: site_map_file for site_map_file in manifest.files}
+                self.manifest_key = manifest_key
+
+            return self.manifest_files
+
+
+# The manifest only dates files to the day. The modification time of the file is more precise,
+# and used when it falls on that day, so that a file changed twice in a day is not taken as
+# unchanged by clients that saw the first version.
+def get_last_modified(manifest_date, mtime):
+    day_start = datetime.strptime(manifest_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+
+    if day_start <= mtime < day_start + 24 * 60 * 60:
+        return int(mtime)
+
+    return int(day_start)
+
+
+class SiteMapRequestHandler(BaseHTTPRequestHandler):
+
+    # Crawlers fetch many files in a row, so connections are kept open between them
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        LOGGER.info('%s %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def _serve(self, send_body):
+        file_name = self.path.split('?', 1)[0].lstrip('/')
+        served_file = self.server.site_map_files.find(file_name, self._accepts_gzip())
+
+        if not served_file:
+            self.send_error(404)
+            return
+
+        try:
+            file = open(served_file.path, 'rb')
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        with file:
+            if self._is_not_modified(served_file):
+                self.send_response(304)
+                self._send_validators(served_file)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', served_file.content_type)
+            self._send_validators(served_file)
+
+            if served_file.content_encoding:
+                self.send_header('Content-Encoding', served_file.content_encoding)
+
+            if served_file.decompress:
+                # The decompressed size is only known at the end, so the connection ends the response
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            else:
+                self.send_header('Content-Length', str(os.fstat(file.fileno()).st_size))
+
+            self.end_headers()
+
+            if not send_body:
+                return
+
+            if served_file.decompress:
+                with gzip.GzipFile(fileobj=file) as decompressed_file:
+                    shutil.copyfileobj(decompressed_file, self.wfile, COPY_BUFFER_SIZE)
+            else:
+                # The kernel copies the file straight to the socket
+                self.wfile.flush()
+                self.connection.sendfile(file)
+
+    def _send_validators(self, served_file):
+        self.send_header('ETag', served_file.etag)
+        self.send_header('Last-Modified', formatdate(served_file.last_modified, usegmt=True))
+        self.send_header('Vary', 'Accept-Encoding')
+
+    # An entity tag given by the client takes precedence over its date
+    def _is_not_modified(self, served_file):
+        if_none_match = self.headers.get('If-None-Match')
+
+        if if_none_match:
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            return '*' in etags or served_file.etag in etags or 'W/' + served_file.etag in etags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+
+        if if_modified_since:
+            try:
+                return served_file.last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+        return False
+
+    def _accepts_gzip(self):
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, parameters = coding.strip().partition(';')
+
+            if name.strip().lower() in ('gzip', '*'):
+                return parameters.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+
+        return False
+
+
+# Serves the site map directory, following it to each newly published generation
+class SiteMapServer(ThreadingHTTPServer):
+
+    def __init__(self, config):
+        super().__init__((config.host, config.port), SiteMapRequestHandler)
+        self.site_map_files = SiteMapFiles(config)
+
+
+if __name__ == '__main__':
+    config = settings.parse_serve_command_line_arguments()
+
+    try:
+        setup_logging(config.logging_config_file_path)
+        server = SiteMapServer(config)
+        LOGGER.info('Serving site map from {} on port {}'.format(config.site_map_directory_path, config.port))
+        server.serve_forever()
+    except Exception as e:
+        LOGGER.error("An error occurred when running the script", e)
@@ -1,6 +1,8 @@
 import argparse
+import os
+from sharding import POSTCODE_AREAS
 
-def parse_command_line_arguments():
+def parse_command_line_arguments(args=None):
     parser = argparse.ArgumentParser(description='Creates site map files based on Elasticsearch data')
 
     _add_base_page_url_arg(parser)
@@ -18,23 +20,112 @@ def parse_command_line_arguments():
     _add_logging_config_file(parser)
     _add_es_index_name(parser)
     _add_es_doc_type(parser)
+    _add_slices_arg(parser)
+    _add_slice_method_arg(parser)
+    _add_prefetch_depth_arg(parser)
+    _add_incremental_arg(parser)
+    _add_manifest_filename_arg(parser)
+    _add_compress_output_arg(parser)
+    _add_compression_level_arg(parser)
+    _add_compression_workers_arg(parser)
+    _add_atomic_publish_arg(parser)
+    _add_keep_generations_arg(parser)
+    _add_rollback_arg(parser)
+    _add_checkpoint_interval_arg(parser)
+    _add_checkpoint_filename_arg(parser)
+    _add_resume_arg(parser)
+    _add_source_fields_arg(parser)
+    _add_filter_response_arg(parser)
+    _add_shards_arg(parser)
+    _add_shard_field_arg(parser)
+    _add_distributed_role_arg(parser)
+    _add_work_directory_arg(parser)
+    _add_claim_timeout_arg(parser)
+    _add_max_site_maps_per_index_arg(parser)
+    _add_max_bytes_per_file_arg(parser)
+    _add_skip_unchanged_files_arg(parser)
+    _add_metrics_file_arg(parser)
+    _add_prometheus_file_arg(parser)
+    _add_profile_file_arg(parser)
+    _add_trace_memory_arg(parser)
+    _add_es_max_connections_arg(parser)
+    _add_es_compression_arg(parser)
+    _add_es_sniff_interval_arg(parser)
+    _add_dedup_mode_arg(parser)
+    _add_dedup_memory_arg(parser)
+    _add_dedup_directory_arg(parser)
+    _add_sorted_extraction_arg(parser)
+    _add_adaptive_page_size_arg(parser)
+    _add_min_page_size_arg(parser)
+    _add_max_page_size_arg(parser)
+    _add_target_latency_arg(parser)
+    _add_max_response_size_arg(parser)
+    _add_max_retries_arg(parser)
+    _add_retry_backoff_arg(parser)
+    _add_max_requests_per_second_arg(parser)
+    _add_max_documents_per_second_arg(parser)
+    _add_sink_arg(parser)
+    _add_tar_file_arg(parser)
+    _add_s3_endpoint_arg(parser)
+    _add_s3_region_arg(parser)
+    _add_s3_bucket_arg(parser)
+    _add_s3_prefix_arg(parser)
+    _add_s3_access_key_arg(parser)
+    _add_s3_secret_key_arg(parser)
+    _add_s3_part_size_arg(parser)
+    _add_upload_workers_arg(parser)
+    _add_snapshot_file_arg(parser)
+    _add_record_file_arg(parser)
 
-    return parser.parse_args()
+    config = parser.parse_args(args)
+
+    # A rollback only publishes an earlier generation again, so it needs none of the generation options
+    if not config.rollback:
+        _require_generation_args(parser, config)
+
+    return config
+
+def _require_generation_args(parser, config):
+    missing_args = [
+        arg for arg, value in [('--basePageUrl', config.base_page_url), ('--siteMapDirectoryUrl', config.site_map_directory_url)]
+        if not value
+    ]
+
+    if missing_args:
+        parser.error('the following arguments are required: {}'.format(', '.join(missing_args)))
+
+    if not config.elasticsearch_url and not config.snapshot_file_path:
+        parser.error('either --elasticsearchUrl or --snapshotFile is required')
+
+    if not 1 <= config.shards <= len(POSTCODE_AREAS):
+        parser.error('--shards must be between 1 and the number of postcode areas, {}'.format(len(POSTCODE_AREAS)))
+
+def parse_serve_command_line_arguments(args=None):
+    parser = argparse.ArgumentParser(description='Serves the generated site map files')
+
+    _add_served_site_map_directory_path_arg(parser)
+    _add_index_filename_arg(parser)
+    _add_manifest_filename_arg(parser)
+    _add_logging_config_file(parser)
+    _add_host_arg(parser)
+    _add_port_arg(parser)
+
+    return parser.parse_args(args)
 
 def _add_base_page_url_arg(parser):
     parser.add_argument(
         '--basePageUrl',
-        help='Base URL for property pages',
+        help='Base URL for property pages. Required unless rolling back',
         dest='base_page_url',
-        required=True,
+        default=None,
     )
 
 def _add_elasticsearch_url_arg(parser):
     parser.add_argument(
         '--elasticsearchUrl',
-        help='URL of the Elasticsearch instance',
+        help='URL of the Elasticsearch instance, or comma-separated URLs of several nodes to use in turn',
         dest='elasticsearch_url',
-        required=True,
+        default=None,
     )
 
 def _add_site_map_directory_path_arg(parser):
@@ -48,9 +139,9 @@ def _add_site_map_directory_path_arg(parser):
 def _add_site_map_directory_url_arg(parser):
     parser.add_argument(
         '--siteMapDirectoryUrl',
-        help='URL of the directory where site map files will be available',
+        help='URL of the directory where site map files will be available. Required unless rolling back',
         dest='site_map_directory_url',
-        required=True,
+        default=None,
     )
 
 def _add_page_size_arg(parser):
@@ -145,3 +236,526 @@ def _add_es_doc_type(parser):
         dest='es_doc_type',
         default='property',
     )
+
+def _add_slices_arg(parser):
+    parser.add_argument(
+        '--slices',
+        help='Number of independent slices to read from Elasticsearch in parallel',
+        type=int,
+        dest='slices',
+        default=1,
+    )
+
+def _add_slice_method_arg(parser):
+    parser.add_argument(
+        '--sliceMethod',
+        help='How the index is split into slices: "scroll" uses sliced scroll (Elasticsearch 5+), '
+             '"shards" gives each slice its own set of shards (older clusters)',
+        choices=['scroll', 'shards'],
+        dest='slice_method',
+        default='scroll',
+    )
+
+def _add_prefetch_depth_arg(parser):
+    parser.add_argument(
+        '--prefetchDepth',
+        help='Number of Elasticsearch pages to fetch ahead while site map files are being written '
+             '(0 disables prefetching)',
+        type=int,
+        dest='prefetch_depth',
+        default=0,
+    )
+
+def _add_incremental_arg(parser):
+    parser.add_argument(
+        '--incremental',
+        help='Only read records modified since the last run and rewrite the site map files they change. '
+             'Falls back to a full run when there is no manifest from a previous run, which reads records sorted '
+             'as with --sortedExtraction so that each file covers a narrow range of URLs',
+        action='store_true',
+        dest='incremental',
+    )
+
+def _add_manifest_filename_arg(parser):
+    parser.add_argument(
+        '--manifestFilename',
+        help='Name of the file, in the site map directory, describing the files written by the last run',
+        dest='manifest_filename',
+        default='site_map_manifest.json',
+    )
+
+def _add_compress_output_arg(parser):
+    parser.add_argument(
+        '--compress',
+        help='Write site map files gzip-compressed (basename_X.xml.gz)',
+        action='store_true',
+        dest='compress_output',
+    )
+
+def _add_compression_level_arg(parser):
+    parser.add_argument(
+        '--compressionLevel',
+        help='gzip compression level of site map files, from 1 (fastest) to 9 (smallest)',
+        type=int,
+        choices=range(1, 10),
+        dest='compression_level',
+        default=6,
+    )
+
+def _add_compression_workers_arg(parser):
+    parser.add_argument(
+        '--compressionWorkers',
+        help='Number of threads compressing finished site map files',
+        type=int,
+        dest='compression_workers',
+        default=2,
+    )
+
+def _add_atomic_publish_arg(parser):
+    parser.add_argument(
+        '--atomicPublish',
+        help='Build the site map in a new generation directory and publish it by switching the site map '
+             'directory path, which becomes a symbolic link, to it once complete',
+        action='store_true',
+        dest='atomic_publish',
+    )
+
+def _add_keep_generations_arg(parser):
+    parser.add_argument(
+        '--keepGenerations',
+        help='Number of previously published site map generations kept for rollback',
+        type=int,
+        dest='keep_generations',
+        default=1,
+    )
+
+def _add_rollback_arg(parser):
+    parser.add_argument(
+        '--rollback',
+        help='Publish the site map generation before the current one again instead of generating a site map',
+        action='store_true',
+        dest='rollback',
+    )
+
+def _add_checkpoint_interval_arg(parser):
+    parser.add_argument(
+        '--checkpointInterval',
+        help='Save a checkpoint every N completed site map files, reading Elasticsearch in postcode and addressKey '
+             'order so the run can be resumed (0 disables checkpoints)',
+        type=int,
+        dest='checkpoint_interval',
+        default=0,
+    )
+
+def _add_checkpoint_filename_arg(parser):
+    parser.add_argument(
+        '--checkpointFilename',
+        help='Name of the checkpoint file in the site map directory',
+        dest='checkpoint_filename',
+        default='site_map_checkpoint.json',
+    )
+
+def _add_resume_arg(parser):
+    parser.add_argument(
+        '--resume',
+        help='Continue a failed run from its last checkpoint instead of starting again',
+        action='store_true',
+        dest='resume',
+    )
+
+def _add_source_fields_arg(parser):
+    parser.add_argument(
+        '--sourceFields',
+        help='Document fields requested from Elasticsearch. Must include postcode, addressKey and entryDatetime',
+        nargs='+',
+        dest='source_fields',
+        default=['postcode', 'addressKey', 'entryDatetime'],
+    )
+
+def _add_filter_response_arg(parser):
+    parser.add_argument(
+        '--noResponseFilter',
+        help='Do not ask Elasticsearch to leave unused metadata out of responses (filter_path)',
+        action='store_false',
+        dest='filter_response',
+    )
+
+def _add_shards_arg(parser):
+    parser.add_argument(
+        '--shards',
+        help='Number of worker processes, each generating the site map files for its own set of postcode areas. '
+             'There can be at most one shard per postcode area',
+        type=int,
+        dest='shards',
+        default=1,
+    )
+
+def _add_shard_field_arg(parser):
+    parser.add_argument(
+        '--shardField',
+        help='Not analysed Elasticsearch field holding the postcode, used to split records by postcode area',
+        dest='shard_field',
+        default='postcode',
+    )
+
+def _add_distributed_role_arg(parser):
+    parser.add_argument(
+        '--distributedRole',
+        help='Step of a site map generation spread across hosts: "coordinate" lists the shards in the work '
+             'directory, "work" generates unclaimed shards and "merge" writes the index once all are done',
+        choices=['coordinate', 'work', 'merge'],
+        dest='distributed_role',
+        default=None,
+    )
+
+def _add_work_directory_arg(parser):
+    parser.add_argument(
+        '--workDirectory',
+        help='Directory shared by all hosts taking part in a distributed site map generation',
+        dest='work_directory_path',
+        default='work',
+    )
+
+def _add_claim_timeout_arg(parser):
+    parser.add_argument(
+        '--claimTimeout',
+        help='Time in seconds after which the claim of a worker that stopped touching it is released, so that '
+             'another worker can generate its shard',
+        type=float,
+        dest='claim_timeout_seconds',
+        default=600,
+    )
+
+def _add_max_site_maps_per_index_arg(parser):
+    parser.add_argument(
+        '--maxSiteMapsPerIndex',
+        help='Maximum number of site map files listed in one index. Larger site maps get child indexes '
+             'listed by the top-level index',
+        type=int,
+        dest='max_site_maps_per_index',
+        default=50000,
+    )
+
+def _add_max_bytes_per_file_arg(parser):
+    parser.add_argument(
+        '--maxBytesPerFile',
+        help='Maximum uncompressed size of a site map file in bytes. A new file is started before a URL '
+             'would take the current one past this size',
+        type=int,
+        dest='max_bytes_per_file',
+        default=50 * 1024 * 1024,
+    )
+
+def _add_skip_unchanged_files_arg(parser):
+    parser.add_argument(
+        '--skipUnchanged',
+        help='Leave site map files whose content matches the digest in the previous manifest untouched, '
+             'keeping their modification time and their last modified date in the index',
+        action='store_true',
+        dest='skip_unchanged_files',
+    )
+
+def _add_metrics_file_arg(parser):
+    parser.add_argument(
+        '--metricsFile',
+        help='Path of a JSON file to save the timings and counts of the run to',
+        dest='metrics_file_path',
+        default=None,
+    )
+
+def _add_prometheus_file_arg(parser):
+    parser.add_argument(
+        '--prometheusFile',
+        help='Path of a .prom file to save the timings and counts of the run to, for the Prometheus '
+             'node exporter textfile collector',
+        dest='prometheus_file_path',
+        default=None,
+    )
+
+def _add_profile_file_arg(parser):
+    parser.add_argument(
+        '--profileFile',
+        help='Path to save cProfile statistics of the main thread to',
+        dest='profile_file_path',
+        default=None,
+    )
+
+def _add_trace_memory_arg(parser):
+    parser.add_argument(
+        '--traceMemory',
+        help='Trace memory allocations and log the peak and the largest allocation sites at the end of the run',
+        action='store_true',
+        dest='trace_memory',
+    )
+
+def _add_es_max_connections_arg(parser):
+    parser.add_argument(
+        '--esMaxConnections',
+        help='Maximum number of keep-alive connections to each Elasticsearch node',
+        type=int,
+        dest='es_max_connections',
+        default=10,
+    )
+
+def _add_es_compression_arg(parser):
+    parser.add_argument(
+        '--esCompression',
+        help='Ask Elasticsearch for gzip-compressed responses. The cluster needs http.compression enabled',
+        action='store_true',
+        dest='es_compression',
+    )
+
+def _add_es_sniff_interval_arg(parser):
+    parser.add_argument(
+        '--esSniffInterval',
+        help='Discover the nodes of the Elasticsearch cluster at start, on connection failures and every '
+             'given number of seconds. 0 only uses the nodes of the Elasticsearch URL',
+        type=int,
+        dest='es_sniff_interval',
+        default=0,
+    )
+
+def _add_dedup_mode_arg(parser):
+    parser.add_argument(
+        '--dedup',
+        help='Drop URLs already written earlier in the run. "hashed" keeps a 64-bit hash of each URL in memory, '
+             '"exact" keeps the URLs themselves in a database on disk',
+        choices=['hashed', 'exact'],
+        dest='dedup_mode',
+        default=None,
+    )
+
+def _add_dedup_memory_arg(parser):
+    parser.add_argument(
+        '--dedupMemoryMb',
+        help='Memory budget for URL deduplication in megabytes. "hashed" fits about 100,000 URLs per megabyte',
+        type=int,
+        dest='dedup_memory_mb',
+        default=256,
+    )
+
+def _add_dedup_directory_arg(parser):
+    parser.add_argument(
+        '--dedupDirectory',
+        help='Directory for the "exact" URL deduplication database, by default the system temporary directory',
+        dest='dedup_directory_path',
+        default=None,
+    )
+
+def _add_sorted_extraction_arg(parser):
+    parser.add_argument(
+        '--sortedExtraction',
+        help='Read records sorted on postcode and address key with search_after instead of an unordered scan, '
+             'so that unchanged data always produces the same site map files',
+        action='store_true',
+        dest='sorted_extraction',
+    )
+
+def _add_adaptive_page_size_arg(parser):
+    parser.add_argument(
+        '--adaptivePageSize',
+        help='Adapt the page size to the latency and size of Elasticsearch responses, starting from the page size. '
+             'A scroll keeps the page size it was opened with, so this works best with --sortedExtraction',
+        action='store_true',
+        dest='adaptive_page_size',
+    )
+
+def _add_min_page_size_arg(parser):
+    parser.add_argument(
+        '--minPageSize',
+        help='Smallest page size to adapt to',
+        type=int,
+        dest='min_page_size',
+        default=100,
+    )
+
+def _add_max_page_size_arg(parser):
+    parser.add_argument(
+        '--maxPageSize',
+        help='Largest page size to adapt to',
+        type=int,
+        dest='max_page_size',
+        default=10000,
+    )
+
+def _add_target_latency_arg(parser):
+    parser.add_argument(
+        '--targetLatency',
+        help='Time in seconds that a page of data should take to retrieve when adapting the page size',
+        type=float,
+        dest='target_latency_seconds',
+        default=1.0,
+    )
+
+def _add_max_response_size_arg(parser):
+    parser.add_argument(
+        '--maxResponseMb',
+        help='Largest Elasticsearch response in megabytes to aim for when adapting the page size',
+        type=float,
+        dest='max_response_mb',
+        default=10,
+    )
+
+def _add_max_retries_arg(parser):
+    parser.add_argument(
+        '--maxRetries',
+        help='Number of times to retry an Elasticsearch request after a transient failure',
+        type=int,
+        dest='max_retries',
+        default=3,
+    )
+
+def _add_retry_backoff_arg(parser):
+    parser.add_argument(
+        '--retryBackoff',
+        help='Longest time in seconds to wait before the first retry. It doubles for every further retry',
+        type=float,
+        dest='retry_backoff_seconds',
+        default=1.0,
+    )
+
+def _add_max_requests_per_second_arg(parser):
+    parser.add_argument(
+        '--maxRequestsPerSecond',
+        help='Maximum number of Elasticsearch requests per second over all slices. 0 does not limit requests',
+        type=float,
+        dest='max_requests_per_second',
+        default=0,
+    )
+
+def _add_max_documents_per_second_arg(parser):
+    parser.add_argument(
+        '--maxDocumentsPerSecond',
+        help='Maximum number of documents per second to read from Elasticsearch over all slices. '
+             '0 does not limit documents',
+        type=float,
+        dest='max_documents_per_second',
+        default=0,
+    )
+
+def _add_sink_arg(parser):
+    parser.add_argument(
+        '--sink',
+        help='Where the site map goes besides the site map directory: nowhere else, a tar archive or an '
+             'S3-compatible bucket. Files are stored as soon as they are finished, with the index last',
+        choices=['local', 'tar', 's3'],
+        dest='sink',
+        default='local',
+    )
+
+def _add_tar_file_arg(parser):
+    parser.add_argument(
+        '--tarFile',
+        help='Path of the tar archive for the tar sink, by default the site map directory path with .tar appended',
+        dest='tar_file_path',
+        default=None,
+    )
+
+def _add_s3_endpoint_arg(parser):
+    parser.add_argument(
+        '--s3Endpoint',
+        help='URL of the S3-compatible object store for the s3 sink',
+        dest='s3_endpoint_url',
+        default='https://s3.amazonaws.com',
+    )
+
+def _add_s3_region_arg(parser):
+    parser.add_argument(
+        '--s3Region',
+        help='Region of the bucket for the s3 sink',
+        dest='s3_region',
+        default='us-east-1',
+    )
+
+def _add_s3_bucket_arg(parser):
+    parser.add_argument(
+        '--s3Bucket',
+        help='Bucket to upload the site map to for the s3 sink',
+        dest='s3_bucket',
+        default=None,
+    )
+
+def _add_s3_prefix_arg(parser):
+    parser.add_argument(
+        '--s3Prefix',
+        help='Prefix of the object keys of the site map files in the bucket, such as sitemaps/',
+        dest='s3_prefix',
+        default='',
+    )
+
+def _add_s3_access_key_arg(parser):
+    parser.add_argument(
+        '--s3AccessKey',
+        help='Access key for the s3 sink, by default taken from the AWS_ACCESS_KEY_ID environment variable',
+        dest='s3_access_key',
+        default=os.environ.get('AWS_ACCESS_KEY_ID'),
+    )
+
+def _add_s3_secret_key_arg(parser):
+    parser.add_argument(
+        '--s3SecretKey',
+        help='Secret key for the s3 sink, by default taken from the AWS_SECRET_ACCESS_KEY environment variable',
+        dest='s3_secret_key',
+        default=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+    )
+
+def _add_s3_part_size_arg(parser):
+    parser.add_argument(
+        '--s3PartSizeMb',
+        help='Size in megabytes of the parts that larger files are uploaded in. S3 needs parts of at least 5MB',
+        type=float,
+        dest='s3_part_size_mb',
+        default=8,
+    )
+
+def _add_upload_workers_arg(parser):
+    parser.add_argument(
+        '--uploadWorkers',
+        help='Number of files, and of parts of larger files, to upload at the same time',
+        type=int,
+        dest='upload_workers',
+        default=4,
+    )
+
+def _add_snapshot_file_arg(parser):
+    parser.add_argument(
+        '--snapshotFile',
+        help='Generate from a local snapshot instead of Elasticsearch: a file with one JSON document per line, '
+             'either a recording made with --recordFile or an export in the bulk API format',
+        dest='snapshot_file_path',
+        default=None,
+    )
+
+def _add_record_file_arg(parser):
+    parser.add_argument(
+        '--recordFile',
+        help='Record the records read from Elasticsearch to this file, to generate from later with --snapshotFile. '
+             'Only for runs reading a single slice in a single shard, without --resume',
+        dest='record_file_path',
+        default=None,
+    )
+
+def _add_served_site_map_directory_path_arg(parser):
+    parser.add_argument(
+        '--siteMapDirectoryPath',
+        help='Path to the directory, or published link, holding the site map files to serve',
+        dest='site_map_directory_path',
+        required=True,
+    )
+
+def _add_host_arg(parser):
+    parser.add_argument(
+        '--host',
+        help='Address to serve site map files on',
+        dest='host',
+        default='0.0.0.0',
+    )
+
+def _add_port_arg(parser):
+    parser.add_argument(
+        '--port',
+        help='Port to serve site map files on',
+        type=int,
+        dest='port',
+        default=8080,
+    )
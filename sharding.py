@@ -0,0 +1,30 @@
+POSTCODE_AREAS = [
+    'AB', 'AL', 'B', 'BA', 'BB', 'BD', 'BH', 'BL', 'BN', 'BR', 'BS', 'BT', 'CA', 'CB', 'CF', 'CH', 'CM', 'CO',
+    'CR', 'CT', 'CV', 'CW', 'DA', 'DD', 'DE', 'DG', 'DH', 'DL', 'DN', 'DT', 'DY', 'E', 'EC', 'EH', 'EN', 'EX',
+    'FK', 'FY', 'G', 'GL', 'GU', 'GY', 'HA', 'HD', 'HG', 'HP', 'HR', 'HS', 'HU', 'HX', 'IG', 'IM', 'IP', 'IV',
+    'JE', 'KA', 'KT', 'KW', 'KY', 'L', 'LA', 'LD', 'LE', 'LL', 'LN', 'LS', 'LU', 'M', 'ME', 'MK', 'ML', 'N',
+    'NE', 'NG', 'NN', 'NP', 'NR', 'NW', 'OL', 'OX', 'PA', 'PE', 'PH', 'PL', 'PO', 'PR', 'RG', 'RH', 'RM', 'S',
+    'SA', 'SE', 'SG', 'SK', 'SL', 'SM', 'SN', 'SO', 'SP', 'SR', 'SS', 'ST', 'SW', 'SY', 'TA', 'TD', 'TF', 'TN',
+    'TQ', 'TR', 'TS', 'TW', 'UB', 'W', 'WA', 'WC', 'WD', 'WF', 'WN', 'WR', 'WS', 'WV', 'YO', 'ZE',
+]
+
+# A shard without areas would match every postcode followed by a digit, so there can be no
+# more shards than areas
+def get_shard_areas(nof_shards):
+    if not 1 <= nof_shards <= len(POSTCODE_AREAS):
+        raise Exception('Number of shards must be between 1 and {}'.format(len(POSTCODE_AREAS)), nof_shards)
+
+    return [POSTCODE_AREAS[i::nof_shards] for i in range(0, nof_shards)]
+
+
+# The first shard also reads every postcode outside the known areas, so the shards cover the whole index
+def get_shard_queries(nof_shards, postcode_field):
+    shard_queries = [_get_areas_query(areas, postcode_field) for areas in get_shard_areas(nof_shards)]
+    unknown_area_query = {'bool': {'must_not': [_get_areas_query(POSTCODE_AREAS, postcode_field)]}}
+    shard_queries[0] = {'bool': {'should': [shard_queries[0], unknown_area_query]}}
+    return shard_queries
+
+
+def _get_areas_query(areas, postcode_field):
+    # An area is the letters before the first digit, so the digit keeps 'E' from matching 'EX'
+    return {'regexp': {postcode_field: '({})[0-9].*'.format('|'.join(areas))}}
@@ -0,0 +1,195 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from s3 import S3Client
+from metrics import METRICS
+import logging
+import os
+import tarfile
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    '.xml': 'application/xml',
+    '.gz': 'application/gzip',
+    '.json': 'application/json',
+}
+
+
+# The site map is always generated in a local directory, which is where it stays by default
+class LocalDirectorySink():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def submit(self, file_path, file_name):
+        pass
+
+    def finish(self, files):
+        pass
+
+
+# Stores the files of the site map elsewhere as they are finished, while generation goes on.
+# Finishing stores the files that were not submitted along the way, such as those kept from an
+# earlier run, in the order given, so that the index can come last, and then waits for all of them.
+class FileSink(ABC):
+
+    def __init__(self, nof_workers):
+        self.executor = ThreadPoolExecutor(max_workers=nof_workers)
+        self.lock = threading.Lock()
+        self.submitted_file_names = set()
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+
+        if exc_type:
+            self._abort()
+
+    def submit(self, file_path, file_name):
+        with self.lock:
+            self.submitted_file_names.add(file_name)
+            self.pending.append((file_name, self.executor.submit(self._store_measured, file_path, file_name)))
+
+    def finish(self, files):
+        self._wait()
+
+        for file_path, file_name in files:
+            if file_name not in self.submitted_file_names:
+                self.submit(file_path, file_name)
+
+        self._wait()
+        self._complete()
+
+    def _wait(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        for file_name, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                raise Exception('Failed to store site map file: {}'.format(file_name), e)
+
+            LOGGER.info('Stored site map file: {}'.format(file_name))
+
+    def _store_measured(self, file_path, file_name):
+        with METRICS.time('store'):
+            self._store(file_path, file_name)
+
+        METRICS.increment('stored_bytes', os.path.getsize(file_path))
+
+    @abstractmethod
+    def _store(self, file_path, file_name):
+        pass
+
+    def _complete(self):
+        pass
+
+    def _abort(self):
+        pass
+
+
+# Adds the files to a tar archive, which only replaces an earlier archive once it is complete.
+# A tar archive is written sequentially, so a single worker adds the files in turn.
+class TarArchiveSink(FileSink):
+
+    def __init__(self, archive_path):
+        super().__init__(1)
+        self.archive_path = archive_path
+        self.temp_archive_path = '{}.tmp'.format(archive_path)
+        self.archive = tarfile.open(self.temp_archive_path, 'w')
+
+    def _store(self, file_path, file_name):
+        self.archive.add(file_path, arcname=file_name)
+
+    def _complete(self):
+        self.archive.close()
+        os.replace(self.temp_archive_path, self.archive_path)
+        LOGGER.info('Saved site map archive: {}'.format(self.archive_path))
+
+    def _abort(self):
+        self.archive.close()
+        os.unlink(self.temp_archive_path)
+
+
+# Uploads the files to a bucket of an S3-compatible object store. Files larger than a part are
+# uploaded in parts, in parallel. As the index is stored last, it only lists files that can
+# already be fetched.
+class S3Sink(FileSink):
+
+    def __init__(self, client, bucket, prefix, part_size, nof_workers):
+        super().__init__(nof_workers)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        # Parts have their own workers, as file workers wait for the parts of their file
+        self.part_executor = ThreadPoolExecutor(max_workers=nof_workers)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        self.part_executor.shutdown(wait=True)
+
+    def _store(self, file_path, file_name):
+        key = self.prefix + file_name
+        content_type = get_content_type(file_name)
+
+        if os.path.getsize(file_path) <= self.part_size:
+            with open(file_path, 'rb') as file:
+                self.client.put_object(self.bucket, key, file.read(), content_type)
+        else:
+            self._upload_in_parts(file_path, key, content_type)
+
+    def _upload_in_parts(self, file_path, key, content_type):
+        upload_id = self.client.create_multipart_upload(self.bucket, key, content_type)
+
+        try:
+            parts = [
+                self.part_executor.submit(self._upload_part, file_path, key, upload_id, part_number, offset)
+                for part_number, offset in enumerate(range(0, os.path.getsize(file_path), self.part_size), 1)
+            ]
+            self.client.complete_multipart_upload(self.bucket, key, upload_id, [part.result() for part in parts])
+        except Exception:
+            # Parts of an unfinished upload are kept, and paid for, until it is aborted
+            self._try_abort_upload(key, upload_id)
+            raise
+
+    def _upload_part(self, file_path, key, upload_id, part_number, offset):
+        with open(file_path, 'rb') as file:
+            file.seek(offset)
+            return self.client.upload_part(self.bucket, key, upload_id, part_number, file.read(self.part_size))
+
+    def _try_abort_upload(self, key, upload_id):
+        try:
+            self.client.abort_multipart_upload(self.bucket, key, upload_id)
+        except Exception as e:
+            LOGGER.warning('Failed to abort multipart upload of {}: {}'.format(key, e))
+
+
+def get_content_type(file_name):
+    return CONTENT_TYPES.get(os.path.splitext(file_name)[1], 'application/octet-stream')
+
+
+def create_sink(config):
+    if config.sink == 'tar':
+        return TarArchiveSink(config.tar_file_path or '{}.tar'.format(os.path.normpath(config.site_map_directory_path)))
+
+    if config.sink == 's3':
+        client = S3Client(
+            config.s3_endpoint_url,
+            config.s3_region,
+            config.s3_access_key,
+            config.s3_secret_key,
+            max_connections=config.upload_workers * 2,
+        )
+        return S3Sink(
+            client, config.s3_bucket, config.s3_prefix, int(config.s3_part_size_mb * 1024 * 1024), config.upload_workers)
+
+    return LocalDirectorySink()
@@ -1,6 +1,12 @@
 import os
 import datetime
-from xml.etree.ElementTree import ElementTree, Element, SubElement
+from site_map_writer import SiteMapWriter, read_site_map_url_page
+from models import SiteMapUrlPage
+from manifest import SiteMapManifest, load_manifest, save_manifest
+from compression import FileCompressor
+from sinks import LocalDirectorySink
+from checkpoint import Checkpoint, load_checkpoint, save_checkpoint, remove_checkpoint
+from metrics import METRICS
 import re
 import logging
 
@@ -8,41 +14,145 @@ LOGGER = logging.getLogger(__name__)
 
 class SiteMapCreator():
 
-    def __init__(self, config):
+    def __init__(self, config, site_map_directory_path=None, file_name_prefix=None, sink=None):
         self.config = config
+        self.site_map_directory_path = site_map_directory_path or config.site_map_directory_path
+        self.file_name_prefix = file_name_prefix or config.base_site_map_filename
         self.records_in_current_file = 0
         self.current_file_number = 0
-        self.current_site_map = self._create_empty_site_map_document()
+        self.current_site_map = None
         self.site_map_file_names = []
+        self.site_map_files = []
+        self.compressor = None
+        self.current_site_map_cursor = None
+        self.nof_checkpointed_files = 0
+        self.previous_site_map_files = {}
+        self.sink = sink or LocalDirectorySink()
+        self.site_map_index_file_names = []
 
     def create_site_map_index_file(self):
         try:
-            site_map_index = self._create_site_map_index_document()
-            self._save_site_map_index_to_file(site_map_index)
+            self.wait_for_compressed_files()
+            self._save_site_map_index_to_file()
         except Exception as e:
             raise Exception('Failed to create site map index file', e)
 
     def append_urls_to_site_map(self, urls):
         remaining_space_in_current_doc = self.config.max_urls_per_file - self._nof_urls_in_current_site_map()
         nof_urls_to_add_to_existing_doc = min(remaining_space_in_current_doc, len(urls))
+        nof_urls_added_to_existing_doc = 0
 
-        self._append_urls(urls[0:nof_urls_to_add_to_existing_doc], self.current_site_map)
-                
-        if self._nof_urls_in_current_site_map() == self.config.max_urls_per_file:
+        if nof_urls_to_add_to_existing_doc > 0:
+            nof_urls_added_to_existing_doc = self._append_urls(
+                urls[0:nof_urls_to_add_to_existing_doc], self._get_current_site_map())
+
+        # The writer refuses URLs once the file would exceed its size limit
+        if (self._nof_urls_in_current_site_map() == self.config.max_urls_per_file or
+                nof_urls_added_to_existing_doc < nof_urls_to_add_to_existing_doc):
             self._save_current_site_map()
             self.current_file_number += 1
-            self.current_site_map = self._create_empty_site_map_document()
 
-        if len(urls) > nof_urls_to_add_to_existing_doc:
-            self.append_urls_to_site_map(urls[nof_urls_to_add_to_existing_doc:])
+        if len(urls) > nof_urls_added_to_existing_doc:
+            self.append_urls_to_site_map(urls[nof_urls_added_to_existing_doc:])
+
+    def save_manifest(self):
+        high_water_mark = max(
+            (site_map_file['max_url_last_modified'] for site_map_file in self.site_map_files), default=None)
+        save_manifest(SiteMapManifest(high_water_mark, self.site_map_files), self._get_manifest_file_path())
+
+    def load_manifest(self):
+        manifest = load_manifest(self._get_manifest_file_path())
+
+        if manifest:
+            self._restore_site_map_files(manifest.files)
+
+        return manifest
+
+    # Files of the previous run are kept while the site map is regenerated, so that the ones
+    # that come out with the same content can be left untouched
+    def load_previous_site_map_files(self):
+        manifest = load_manifest(self._get_manifest_file_path())
+
+        if manifest:
+            self.previous_site_map_files = {site_map_file['name']: site_map_file for site_map_file in manifest.files}
+
+    def remove_stale_site_map_files(self):
+        self.wait_for_compressed_files()
+        self.previous_site_map_files = {}
+        self.clear_site_map_directory(
+            except_file_names=self.site_map_file_names + [self.config.site_map_index_filename])
+
+    # Hands the site map over to the sink in full, with the index and manifest last, once they are written
+    def finish_sink(self):
+        self.wait_for_compressed_files()
+        file_names = self.site_map_file_names + self.site_map_index_file_names + [self.config.manifest_filename]
+        self.sink.finish([(self._get_file_path(file_name), file_name) for file_name in file_names])
+
+    def add_site_map_files(self, site_map_files):
+        self._restore_site_map_files(self.site_map_files + site_map_files)
+
+    def load_checkpoint(self):
+        checkpoint = load_checkpoint(self._get_checkpoint_file_path())
+
+        if checkpoint:
+            self._restore_site_map_files(checkpoint.files)
+
+        return checkpoint
+
+    def remove_checkpoint(self):
+        remove_checkpoint(self._get_checkpoint_file_path())
+
+    # Returns the URLs that no longer fit in the file within its size limit
+    def rewrite_site_map_file(self, file_name, urls):
+        file_path = self._get_file_path(file_name)
+        # The compressor writes to the temp path of the compressed file, so the XML of a compressed
+        # file goes to the temp path of its uncompressed name instead
+        temp_file_path = self._get_temp_file_path(
+            file_path[:-len('.gz')] if self._is_compressed(file_name) else file_path)
+
+        try:
+            site_map = SiteMapWriter(
+                open(temp_file_path, 'wb'), self.config.file_encoding, max_bytes=self.config.max_bytes_per_file)
+
+            try:
+                nof_urls_added = self._append_urls(urls, site_map)
+            finally:
+                site_map.close()
 
-    def clear_site_map_directory(self):
+            if self._is_compressed(file_name):
+                self._get_compressor().submit(temp_file_path, file_path, self._get_sink_submission(file_name))
+            else:
+                os.replace(temp_file_path, file_path)
+                self.sink.submit(file_path, file_name)
+        except Exception as e:
+            raise Exception('Failed to rewrite site map file: {}'.format(file_path), e)
+
+        position = self.site_map_file_names.index(file_name)
+        self.site_map_files[position] = self._summarise_site_map(site_map, file_name)
+        LOGGER.info('Rewrote site map file: {}'.format(file_path))
+        return urls[nof_urls_added:]
+
+    def read_site_map_file(self, file_name):
+        file_path = self._get_file_path(file_name)
+
+        try:
+            return read_site_map_url_page(file_path)
+        except Exception as e:
+            raise Exception('Failed to read site map file: {}'.format(file_path), e)
+
+    def wait_for_compressed_files(self):
+        if self.compressor:
+            self.compressor.wait()
+
+    def clear_site_map_directory(self, except_file_names=()):
         LOGGER.info('Clearing site map directory...')
         
         try:
-            for filename in os.listdir(self.config.site_map_directory_path):
-                file_path = os.path.join(self.config.site_map_directory_path, filename)
-                if self._is_site_map_file(filename, file_path) or filename == self.config.site_map_index_filename:
+            for filename in os.listdir(self.site_map_directory_path):
+                file_path = os.path.join(self.site_map_directory_path, filename)
+                if filename in except_file_names or filename in self.previous_site_map_files:
+                    continue
+                if self._is_site_map_file(filename, file_path) or is_site_map_index_file(self.config, filename):
                     os.unlink(file_path)
                     LOGGER.info('Deleted file {}'.format(file_path))
         except Exception as e:
@@ -53,84 +163,221 @@ class SiteMapCreator():
             self._save_current_site_map()
 
     def _nof_urls_in_current_site_map(self):
-        return len(self.current_site_map.getroot().getchildren())
+        return self.current_site_map.nof_entries if self.current_site_map else 0
 
     def _is_site_map_file(self, filename, file_path):
-        site_map_filename_pattern = '{}_\\d+\\.xml'.format(self.config.base_site_map_filename)
+        site_map_filename_pattern = '{}_(\\d+_)?\\d+\\.xml(\\.gz)?'.format(self.config.base_site_map_filename)
         return os.path.isfile(file_path) and re.fullmatch(site_map_filename_pattern, filename)
 
-    def _create_empty_site_map_document(self):
-        url_set_element = Element('urlset')
-        url_set_element.set('xmlns', 'http://www.sitemaps.org/schemas/sitemap/0.9')
-        document = ElementTree(url_set_element)
-        return document
-
-    def _create_site_map_index_document(self):
-        site_map_index_element = Element('sitemapindex')
-        site_map_index_element.set('xmlns', 'http://www.sitemaps.org/schemas/sitemap/0.9')
+    def _get_current_site_map(self):
+        if not self.current_site_map:
+            file_path = self._get_file_path(self._get_file_name(self.current_file_number))
 
-        last_modified = datetime.datetime.now()
+            if self.config.skip_unchanged_files:
+                file_path = self._get_temp_file_path(file_path)
 
-        for file_name in self.site_map_file_names:
-            site_map_element = self._create_site_map_element(file_name, last_modified)
-            site_map_index_element.append(site_map_element)
+            try:
+                self.current_site_map = SiteMapWriter(
+                    open(file_path, 'wb'), self.config.file_encoding, max_bytes=self.config.max_bytes_per_file)
+            except Exception as e:
+                raise Exception('Failed to create site map file: {}'.format(file_path), e)
 
-        return ElementTree(site_map_index_element)
+        return self.current_site_map
 
     def _append_urls(self, urls, site_map):
-        url_set_element = site_map.getroot()
-        
-        for url in urls:
-            url_element = self._add_sub_element(url_set_element, 'url')
-            self._add_sub_element(url_element, 'loc', url.location)
-            self._add_sub_element(url_element, 'lastmod', url.last_modified)
-            self._add_sub_element(url_element, 'changefreq', url.change_frequency)
-
-    def _create_site_map_element(self, file_name, last_modified):
-        site_map_element = Element('sitemap')
-        self._add_sub_element(site_map_element, 'loc', self._get_site_map_url(file_name))
-        self._add_sub_element(site_map_element, 'lastmod', last_modified.strftime('%Y-%m-%d'))
-        return site_map_element
+        if isinstance(urls, SiteMapUrlPage):
+            nof_urls_added = site_map.write_url_page(urls)
+        else:
+            nof_urls_added = 0
 
-    def _get_site_map_url(self, file_name):
-        return '{}/{}'.format(self.config.site_map_directory_url, file_name)
+            for url in urls:
+                if not site_map.write_url(url.location, url.last_modified, url.change_frequency):
+                    break
+                nof_urls_added += 1
 
-    def _add_sub_element(self, parent, tag, text=None):
-        sub_element = SubElement(parent, tag)
+        if nof_urls_added:
+            self.current_site_map_cursor = urls[nof_urls_added - 1].cursor
 
-        if text:
-            sub_element.text = text
+        return nof_urls_added
 
-        return sub_element
+    def _get_site_map_url(self, file_name):
+        return '{}/{}'.format(self.config.site_map_directory_url, file_name)
 
     def _save_current_site_map(self):
         filename = self._get_file_name(self.current_file_number)
-        self._save_site_map_to_file(self.current_site_map, filename)
+        site_map, self.current_site_map = self.current_site_map, None
+        self._save_site_map_to_file(site_map, filename)
+
+    def _save_site_map_to_file(self, site_map, file_name):
+        file_path = self._get_file_path(file_name)
+        stored_file_name = self._get_compressed_file_name(file_name) if self.config.compress_output else file_name
+        unchanged_site_map_file = None
 
-    def _save_site_map_to_file(self, site_map, file_name):                
         try:
-            file_path = self._get_file_path(file_name)
-            self._save_xml_doc_to_file(site_map, file_path)            
+            site_map.close()
+
+            if self.config.skip_unchanged_files:
+                unchanged_site_map_file = self._find_unchanged_site_map_file(site_map, stored_file_name)
+                self._keep_or_replace_site_map_file(file_path, unchanged_site_map_file)
+
+            if self.config.compress_output and not unchanged_site_map_file:
+                self._get_compressor().submit(
+                    file_path, self._get_file_path(stored_file_name), self._get_sink_submission(stored_file_name))
+            elif not unchanged_site_map_file:
+                self.sink.submit(file_path, stored_file_name)
         except Exception as e:
             raise Exception('Failed to create site map file: {}'.format(file_path), e)
         else:
-            self.site_map_file_names += [file_name]
-            LOGGER.info('Created site map file: {}'.format(file_path))
+            self.site_map_file_names += [stored_file_name]
+            self.site_map_files += [self._summarise_site_map(site_map, stored_file_name, unchanged_site_map_file)]
+            METRICS.increment('site_map_files')
+            LOGGER.info('{} site map file: {}'.format('Kept unchanged' if unchanged_site_map_file else 'Created', file_path))
+
+        if self.config.checkpoint_interval and len(self.site_map_files) % self.config.checkpoint_interval == 0:
+            self._save_checkpoint(self.current_site_map_cursor)
+
+    def _get_sink_submission(self, file_name):
+        return lambda: self.sink.submit(self._get_file_path(file_name), file_name)
+
+    # Files are only listed in a checkpoint once they are completely on disk, so compression
+    # has to catch up first
+    def _save_checkpoint(self, cursor):
+        self.wait_for_compressed_files()
+
+        for file_name in self.site_map_file_names[self.nof_checkpointed_files:]:
+            self._sync_file(self._get_file_path(file_name))
+
+        self.nof_checkpointed_files = len(self.site_map_file_names)
+        save_checkpoint(Checkpoint(cursor, self.site_map_files), self._get_checkpoint_file_path())
+        LOGGER.info('Saved checkpoint after {} site map files'.format(len(self.site_map_files)))
+
+    def _find_unchanged_site_map_file(self, site_map, file_name):
+        previous_site_map_file = self.previous_site_map_files.get(file_name)
+
+        if (previous_site_map_file and previous_site_map_file.get('digest') == site_map.digest and
+                os.path.isfile(self._get_file_path(file_name))):
+            return previous_site_map_file
+
+        return None
+
+    def _keep_or_replace_site_map_file(self, file_path, unchanged_site_map_file):
+        if unchanged_site_map_file:
+            os.unlink(self._get_temp_file_path(file_path))
+        else:
+            os.replace(self._get_temp_file_path(file_path), file_path)
+
+    def _restore_site_map_files(self, site_map_files):
+        self.site_map_files = site_map_files
+        self.site_map_file_names = [site_map_file['name'] for site_map_file in site_map_files]
+        self.current_file_number = len(site_map_files)
+        self.nof_checkpointed_files = len(site_map_files)
+
+    def _sync_file(self, file_path):
+        with open(file_path, 'rb') as file:
+            os.fsync(file.fileno())
+
+    def _summarise_site_map(self, site_map, file_name, unchanged_site_map_file=None):
+        if unchanged_site_map_file:
+            last_modified = unchanged_site_map_file['last_modified']
+        else:
+            last_modified = datetime.datetime.now().strftime('%Y-%m-%d')
+
+        return {
+            'name': file_name,
+            'url_count': site_map.nof_entries,
+            'byte_count': site_map.nof_bytes,
+            'first_location': site_map.min_location,
+            'last_location': site_map.max_location,
+            'max_url_last_modified': site_map.max_last_modified,
+            'last_modified': last_modified,
+            'digest': site_map.digest,
+        }
+
+    def _save_site_map_index_to_file(self):
+        file_path = self._get_file_path(self.config.site_map_index_filename)
 
-    def _save_site_map_index_to_file(self, site_map_index):
         try:
-            file_path = self._get_file_path(self.config.site_map_index_filename)
-            self._save_xml_doc_to_file(site_map_index, file_path)
+            if len(self.site_map_files) <= self.config.max_site_maps_per_index:
+                self._write_site_map_index(file_path, self.site_map_files)
+                self.site_map_index_file_names = [self.config.site_map_index_filename]
+            else:
+                child_indexes = self._save_child_site_map_indexes()
+                self._write_site_map_index(file_path, child_indexes)
+                self.site_map_index_file_names = [
+                    child_index['name'] for child_index in child_indexes] + [self.config.site_map_index_filename]
         except Exception as e:
             raise Exception('Failed to create site map index file: {}'.format(file_path), e)
         else:
             LOGGER.info('Created site map index file: {}'.format(file_path))
 
-    def _save_xml_doc_to_file(self, xml, file_path):
-        xml.write(file_path, xml_declaration=True, encoding=self.config.file_encoding)
+    # The protocol limits an index to 50,000 entries, so bigger site maps get an index of indexes.
+    # Each child index is streamed from a slice of the site map files, one at a time.
+    def _save_child_site_map_indexes(self):
+        child_indexes = []
+
+        for start in range(0, len(self.site_map_files), self.config.max_site_maps_per_index):
+            site_map_files = self.site_map_files[start:start + self.config.max_site_maps_per_index]
+            file_name = self._get_child_site_map_index_file_name(len(child_indexes))
+
+            self._write_site_map_index(self._get_file_path(file_name), site_map_files)
+            child_indexes += [{
+                'name': file_name,
+                'max_url_last_modified': max(
+                    self._get_index_last_modified(site_map_file) for site_map_file in site_map_files),
+            }]
+            LOGGER.info('Created child site map index file: {}'.format(file_name))
+
+        return child_indexes
+
+    def _write_site_map_index(self, file_path, site_map_files):
+        site_map_index = SiteMapWriter(open(file_path, 'wb'), self.config.file_encoding, root_tag='sitemapindex')
+
+        try:
+            for site_map_file in site_map_files:
+                site_map_index.write_site_map(
+                    self._get_site_map_url(site_map_file['name']), self._get_index_last_modified(site_map_file))
+        finally:
+            site_map_index.close()
+
+    # A file's entry in the index is dated by the latest change among its URLs, so that crawlers
+    # only fetch it again when one of them changes. Files without URL dates fall back to the date
+    # they were written.
+    def _get_index_last_modified(self, site_map_file):
+        return site_map_file.get('max_url_last_modified') or site_map_file.get('last_modified')
+
+    def _get_child_site_map_index_file_name(self, index_number):
+        base_name, extension = os.path.splitext(self.config.site_map_index_filename)
+        return '{}_{}{}'.format(base_name, index_number, extension)
+
+    def _get_compressor(self):
+        if not self.compressor:
+            self.compressor = FileCompressor(self.config.compression_workers, self.config.compression_level)
+
+        return self.compressor
+
+    def _is_compressed(self, file_name):
+        return file_name.endswith('.gz')
+
+    def _get_compressed_file_name(self, file_name):
+        return '{}.gz'.format(file_name)
+
+    def _get_checkpoint_file_path(self):
+        return self._get_file_path(self.config.checkpoint_filename)
+
+    def _get_manifest_file_path(self):
+        return self._get_file_path(self.config.manifest_filename)
+
+    def _get_temp_file_path(self, file_path):
+        return '{}.tmp'.format(file_path)
 
     def _get_file_path(self, file_name):
-        return '{}/{}'.format(self.config.site_map_directory_path, file_name)
+        return '{}/{}'.format(self.site_map_directory_path, file_name)
 
     def _get_file_name(self, file_number):
-        return "{}_{}.xml".format(self.config.base_site_map_filename, file_number)
+        return "{}_{}.xml".format(self.file_name_prefix, file_number)
+
+
+def is_site_map_index_file(config, file_name):
+    base_name, extension = os.path.splitext(config.site_map_index_filename)
+    child_index_pattern = '{}_\\d+{}'.format(re.escape(base_name), re.escape(extension))
+    return file_name == config.site_map_index_filename or re.fullmatch(child_index_pattern, file_name) is not None
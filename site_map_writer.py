@@ -0,0 +1,171 @@
+from xml.etree.ElementTree import iterparse
+import gzip
+import hashlib
+from xml.sax.saxutils import escape
+from models import SiteMapUrl, create_page
+from metrics import METRICS
+
+SITE_MAP_NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+# Streams a site map document straight to a binary file. The output matches what
+# ElementTree used to write for the same document, byte for byte. With max_bytes set, entries
+# that would take the closed document past that size are refused, except for the first one.
+# The content is hashed as it is written, and its digest is available once the writer is closed.
+class SiteMapWriter():
+
+    def __init__(self, file, encoding, root_tag='urlset', max_bytes=None):
+        self.file = file
+        self.encoding = encoding.lower()
+        self.root_tag = root_tag
+        self.max_bytes = max_bytes
+        self.nof_entries = 0
+        self.nof_bytes = 0
+        self.content_hash = hashlib.sha256()
+        self.digest = None
+        self.min_location = None
+        self.max_location = None
+        self.max_last_modified = None
+        self._write("<?xml version='1.0' encoding='{}'?>\n<{} xmlns=\"{}\"".format(
+            self.encoding, self.root_tag, SITE_MAP_NAMESPACE))
+
+    def write_url(self, location, last_modified, change_frequency):
+        written = self._write_entry(_url_entry(location, last_modified, _element('changefreq', change_frequency)))
+
+        if written:
+            self._update_statistics(location, location, last_modified)
+
+        return written
+
+    def write_url_page(self, page):
+        if not len(page):
+            return 0
+
+        with METRICS.time('xml_serialisation'):
+            change_frequency = _element('changefreq', page.change_frequency)
+            entries = [
+                _url_entry(location, last_modified, change_frequency)
+                for location, last_modified in zip(page.locations, page.last_modified)
+            ]
+
+        nof_written_urls = self._write_entries(entries)
+
+        if nof_written_urls:
+            written_page = page if nof_written_urls == len(page) else page[:nof_written_urls]
+            self._update_statistics(
+                min(written_page.locations), max(written_page.locations), max(written_page.last_modified))
+
+        return nof_written_urls
+
+    def write_site_map(self, location, last_modified):
+        self._write_entry('<sitemap>{}{}</sitemap>'.format(
+            _element('loc', location),
+            _element('lastmod', last_modified),
+        ))
+
+    def close(self):
+        try:
+            self._write('</{}>'.format(self.root_tag) if self.nof_entries else ' />')
+            self.digest = self.content_hash.hexdigest()
+        finally:
+            self.file.close()
+
+    def _write_entry(self, entry):
+        return self._write_entries([entry]) == 1
+
+    def _write_entries(self, entries):
+        # The root start tag is only completed here so that a document without
+        # entries can still be closed as an empty element, as ElementTree does
+        with METRICS.time('xml_serialisation'):
+            prefix = '' if self.nof_entries else '>'
+            content = self._encode(prefix + ''.join(entries))
+
+            # The whole batch normally fits, so entries are only measured one by one near the limit
+            if not self._fits(len(content)):
+                content, entries = self._fit_entries(prefix, entries)
+
+        self._write_bytes(content)
+        self.nof_entries += len(entries)
+        return len(entries)
+
+    def _fit_entries(self, prefix, entries):
+        encoded_prefix = self._encode(prefix)
+        encoded_entries = []
+        nof_bytes = len(encoded_prefix)
+
+        for entry in entries:
+            encoded_entry = self._encode(entry)
+            nof_bytes += len(encoded_entry)
+
+            if (self.nof_entries or encoded_entries) and not self._fits(nof_bytes):
+                break
+
+            encoded_entries.append(encoded_entry)
+
+        if not encoded_entries:
+            return b'', []
+
+        return encoded_prefix + b''.join(encoded_entries), entries[:len(encoded_entries)]
+
+    def _fits(self, nof_bytes):
+        closing_tag_length = len('</{}>'.format(self.root_tag))
+        return self.max_bytes is None or self.nof_bytes + nof_bytes + closing_tag_length <= self.max_bytes
+
+    def _update_statistics(self, min_location, max_location, max_last_modified):
+        if self.min_location is None:
+            self.min_location = min_location
+            self.max_location = max_location
+            self.max_last_modified = max_last_modified
+        else:
+            self.min_location = min(self.min_location, min_location)
+            self.max_location = max(self.max_location, max_location)
+            self.max_last_modified = max(self.max_last_modified, max_last_modified)
+
+    def _write(self, text):
+        self._write_bytes(self._encode(text))
+
+    def _write_bytes(self, content):
+        with METRICS.time('file_write'):
+            self.file.write(content)
+
+        self.content_hash.update(content)
+        self.nof_bytes += len(content)
+        METRICS.increment('bytes_written', len(content))
+
+    def _encode(self, text):
+        return text.encode(self.encoding, 'xmlcharrefreplace')
+
+
+# The number of bytes a URL takes in a site map document
+def get_url_entry_size(location, last_modified, change_frequency, encoding):
+    entry = _url_entry(location, last_modified, _element('changefreq', change_frequency))
+    return len(entry.encode(encoding.lower(), 'xmlcharrefreplace'))
+
+
+def _url_entry(location, last_modified, change_frequency_element):
+    return '<url>{}{}{}</url>'.format(_element('loc', location), _element('lastmod', last_modified), change_frequency_element)
+
+
+def _element(tag, text):
+    if text:
+        return '<{0}>{1}</{0}>'.format(tag, escape(text))
+
+    return '<{} />'.format(tag)
+
+
+def read_site_map_urls(file_path):
+    namespace = '{{{}}}'.format(SITE_MAP_NAMESPACE)
+
+    with (gzip.open(file_path) if file_path.endswith('.gz') else open(file_path, 'rb')) as file:
+        for event, element in iterparse(file):
+            if element.tag == namespace + 'url':
+                yield SiteMapUrl(
+                    location=element.findtext(namespace + 'loc') or '',
+                    last_modified=element.findtext(namespace + 'lastmod') or '',
+                    change_frequency=element.findtext(namespace + 'changefreq') or '',
+                )
+                element.clear()
+
+
+def read_site_map_url_page(file_path):
+    return create_page(read_site_map_urls(file_path))
@@ -0,0 +1,150 @@
+from elasticsearch_scan import SORT_FIELDS, convert_to_site_map_entries
+from metrics import METRICS
+import json
+import logging
+import mmap
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+# Action lines of an export in the bulk API format, which precede the document they apply to
+BULK_ACTIONS = {'index', 'create'}
+
+
+# Reads records from a local snapshot instead of Elasticsearch. A snapshot holds one JSON document
+# per line: a search hit with _source and optionally sort, as recorded from a live run, or the
+# source itself, as in an export in the bulk API format, whose action lines are skipped. The file
+# is memory-mapped and each page of lines is parsed in one go.
+#
+# Queries are evaluated here, as far as the generator uses them. Sorted reading needs a snapshot
+# sorted on postcode and address key, as one recorded from a sorted run is.
+class SnapshotClient():
+
+    def __init__(self, config, query=None, sort=False, search_after=None):
+        self.config = config
+        self.matches = create_query_matcher(query)
+        self.sort = sort
+        self.search_after = search_after
+        self.last_cursor = None
+        self.position = 0
+        self.file = open(config.snapshot_file_path, 'rb')
+        self.map = self._map_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.map:
+            self.map.close()
+
+        self.file.close()
+
+    def next_page_of_records(self):
+        with METRICS.time('snapshot_read'):
+            address_page = self._next_page_of_hits(self.config.page_size)
+
+        with METRICS.time('conversion'):
+            site_map_entries = convert_to_site_map_entries(self.config, address_page, self.sort)
+
+        METRICS.increment('records', len(site_map_entries))
+        LOGGER.info('Read {} records from the snapshot'.format(len(site_map_entries)))
+        return site_map_entries
+
+    def _map_file(self):
+        try:
+            return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped
+            return b''
+
+    def _next_page_of_hits(self, nof_hits):
+        hits = []
+
+        while len(hits) < nof_hits and self.position < len(self.map):
+            lines = self._next_lines(nof_hits - len(hits))
+
+            try:
+                documents = json.loads(b'[' + b','.join(lines) + b']')
+            except ValueError as e:
+                raise Exception('Failed to parse snapshot: {}'.format(self.config.snapshot_file_path), e)
+
+            hits += [hit for hit in map(self._get_hit, documents) if hit and self._is_wanted(hit)]
+
+        return hits
+
+    def _next_lines(self, nof_lines):
+        lines = []
+
+        while len(lines) < nof_lines and self.position < len(self.map):
+            end = self.map.find(b'\n', self.position)
+            end = len(self.map) if end == -1 else end
+            line = self.map[self.position:end].strip()
+            self.position = end + 1
+
+            if line:
+                lines.append(line)
+
+        return lines
+
+    def _get_hit(self, document):
+        if '_source' in document:
+            return document
+
+        if len(document) == 1 and next(iter(document)) in BULK_ACTIONS:
+            return None
+
+        return {'_source': document}
+
+    def _is_wanted(self, hit):
+        if not self.matches(hit['_source']):
+            return False
+
+        if not self.sort:
+            return True
+
+        cursor = hit.get('sort') or [hit['_source'][field] for field in SORT_FIELDS]
+        hit['sort'] = cursor
+
+        if self.last_cursor is not None and cursor <= self.last_cursor:
+            raise Exception('Snapshot is not sorted on {}: {}'.format(', '.join(SORT_FIELDS), cursor))
+
+        self.last_cursor = cursor
+        return self.search_after is None or cursor > self.search_after
+
+
+# Supports the queries the generator sends: ranges of modification times for incremental updates,
+# and postcode regular expressions combined with bool for shards
+def create_query_matcher(query):
+    if not query:
+        return lambda source: True
+
+    if 'range' in query:
+        (field, bounds), = query['range'].items()
+        return lambda source: _in_range(source[field], bounds)
+
+    if 'regexp' in query:
+        (field, pattern), = query['regexp'].items()
+        regexp = re.compile(pattern)
+        return lambda source: regexp.fullmatch(source[field]) is not None
+
+    if 'bool' in query:
+        must = [create_query_matcher(clause) for clause in query['bool'].get('must', [])]
+        should = [create_query_matcher(clause) for clause in query['bool'].get('should', [])]
+        must_not = [create_query_matcher(clause) for clause in query['bool'].get('must_not', [])]
+        return lambda source: (
+            all(matches(source) for matches in must) and
+            (not should or any(matches(source) for matches in should)) and
+            not any(matches(source) for matches in must_not)
+        )
+
+    raise Exception('Query is not supported on snapshots', query)
+
+
+# Values are compared as strings, which orders the dates of records correctly
+def _in_range(value, bounds):
+    return (
+        ('gte' not in bounds or value >= bounds['gte']) and
+        ('gt' not in bounds or value > bounds['gt']) and
+        ('lte' not in bounds or value <= bounds['lte']) and
+        ('lt' not in bounds or value < bounds['lt'])
+    )
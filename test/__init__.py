@@ -17,5 +17,122 @@ FakeConfig = namedtuple(
         'file_encoding', 
         'es_index', 
         'es_doc_type',
+        'slices',
+        'slice_method',
+        'prefetch_depth',
+        'incremental',
+        'manifest_filename',
+        'compress_output',
+        'compression_level',
+        'compression_workers',
+        'atomic_publish',
+        'keep_generations',
+        'rollback',
+        'checkpoint_interval',
+        'checkpoint_filename',
+        'resume',
+        'source_fields',
+        'filter_response',
+        'shards',
+        'shard_field',
+        'distributed_role',
+        'work_directory_path',
+        'max_site_maps_per_index',
+        'max_bytes_per_file',
+        'skip_unchanged_files',
+        'metrics_file_path',
+        'prometheus_file_path',
+        'profile_file_path',
+        'trace_memory',
+        'es_max_connections',
+        'es_compression',
+        'es_sniff_interval',
+        'dedup_mode',
+        'dedup_memory_mb',
+        'dedup_directory_path',
+        'sorted_extraction',
+        'adaptive_page_size',
+        'min_page_size',
+        'max_page_size',
+        'target_latency_seconds',
+        'max_response_mb',
+        'max_retries',
+        'retry_backoff_seconds',
+        'max_requests_per_second',
+        'max_documents_per_second',
+        'sink',
+        'tar_file_path',
+        's3_endpoint_url',
+        's3_region',
+        's3_bucket',
+        's3_prefix',
+        's3_access_key',
+        's3_secret_key',
+        's3_part_size_mb',
+        'upload_workers',
+        'snapshot_file_path',
+        'record_file_path',
+        'claim_timeout_seconds',
      ]
 )
+
+# Options added after the original set default to their command line defaults,
+# so tests only need to name them when they matter
+FakeConfig.__new__.__defaults__ = (
+    1,
+    'scroll',
+    0,
+    False,
+    'site_map_manifest.json',
+    False,
+    6,
+    2,
+    False,
+    1,
+    False,
+    0,
+    'site_map_checkpoint.json',
+    False,
+    ['postcode', 'addressKey', 'entryDatetime'],
+    True,
+    1,
+    'postcode',
+    None,
+    'work',
+    50000,
+    50 * 1024 * 1024,
+    False,
+    None,
+    None,
+    None,
+    False,
+    10,
+    False,
+    0,
+    None,
+    256,
+    None,
+    False,
+    False,
+    100,
+    10000,
+    1.0,
+    10,
+    3,
+    1.0,
+    0,
+    0,
+    'local',
+    None,
+    'https://s3.amazonaws.com',
+    'us-east-1',
+    None,
+    '',
+    None,
+    None,
+    8,
+    4,
+    None,
+    None,
+    600,
+)
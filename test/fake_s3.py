@@ -0,0 +1,140 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.etree.ElementTree import fromstring
+import hashlib
+import itertools
+import threading
+
+
+# A local stand-in for an S3-compatible object store, with path-style buckets. It checks that
+# requests are signed and that the payload hash matches the body, but not the signature itself.
+class FakeS3Server():
+
+    def __init__(self, min_part_size=0, fail_parts=()):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted_uploads = []
+        self.min_part_size = min_part_size
+        self.fail_parts = set(fail_parts)
+        self.upload_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._create_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _create_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                key, query, body = self._read_request()
+
+                if body is None:
+                    return
+
+                if key not in fake.objects:
+                    return self._respond(404)
+
+                self._respond(200, fake.objects[key]['body'])
+
+            def do_PUT(self):
+                key, query, body = self._read_request()
+
+                if body is None:
+                    return
+
+                if 'uploadId' in query:
+                    part_number = int(query['partNumber'][0])
+
+                    if part_number in fake.fail_parts:
+                        return self._respond(500)
+
+                    with fake.lock:
+                        fake.uploads[query['uploadId'][0]]['parts'][part_number] = body
+                else:
+                    with fake.lock:
+                        fake.objects[key] = {'body': body, 'content_type': self.headers['Content-Type']}
+
+                self._respond(200, headers={'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+            def do_POST(self):
+                key, query, body = self._read_request()
+
+                if body is None:
+                    return
+
+                if 'uploads' in query:
+                    upload_id = str(next(fake.upload_ids))
+
+                    with fake.lock:
+                        fake.uploads[upload_id] = {
+                            'key': key, 'content_type': self.headers['Content-Type'], 'parts': {}}
+
+                    return self._respond(200, (
+                        '<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                        '<UploadId>{}</UploadId></InitiateMultipartUploadResult>').format(upload_id).encode())
+
+                with fake.lock:
+                    upload = fake.uploads.pop(query['uploadId'][0])
+
+                part_numbers = [int(part.findtext('PartNumber')) for part in fromstring(body).iter('Part')]
+                parts = [upload['parts'][part_number] for part_number in part_numbers]
+
+                if any(len(part) < fake.min_part_size for part in parts[:-1]):
+                    return self._respond(200, b'<Error><Code>EntityTooSmall</Code></Error>')
+
+                with fake.lock:
+                    fake.objects[key] = {'body': b''.join(parts), 'content_type': upload['content_type']}
+
+                self._respond(200, b'<CompleteMultipartUploadResult />')
+
+            def do_DELETE(self):
+                key, query, body = self._read_request()
+
+                if body is None:
+                    return
+
+                with fake.lock:
+                    fake.uploads.pop(query['uploadId'][0], None)
+                    fake.aborted_uploads.append(key)
+
+                self._respond(204)
+
+            def _read_request(self):
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                query = parse_qs(url.query, keep_blank_values=True)
+
+                if (not self.headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 ') or
+                        self.headers.get('x-amz-content-sha256') != hashlib.sha256(body).hexdigest()):
+                    self._respond(403)
+                    body = None
+
+                return url.path.lstrip('/'), query, body
+
+            def _respond(self, status, body=b'', headers=None):
+                self.send_response(status)
+
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
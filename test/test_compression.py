@@ -0,0 +1,44 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from compression import FileCompressor, compress_file
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _create_file(self, file_name, content):
+        file_path = os.path.join(self.directory, file_name)
+
+        with open(file_path, 'wb') as file:
+            file.write(content)
+
+        return file_path
+
+    def test_compress_file_replaces_source_with_deterministic_gzip_file(self):
+        target_paths = [os.path.join(self.directory, 'target_{}.xml.gz'.format(i)) for i in range(0, 2)]
+
+        for target_path in target_paths:
+            compress_file(self._create_file('source.xml', b'<urlset />'), target_path, 9)
+
+        self.assertListEqual(sorted(os.listdir(self.directory)), ['target_0.xml.gz', 'target_1.xml.gz'])
+
+        with open(target_paths[0], 'rb') as first, open(target_paths[1], 'rb') as second:
+            self.assertEqual(first.read(), second.read())
+
+        with gzip.open(target_paths[0]) as compressed_file:
+            self.assertEqual(compressed_file.read(), b'<urlset />')
+
+    def test_wait_raises_when_a_file_could_not_be_compressed(self):
+        compressor = FileCompressor(2, 6)
+        compressor.submit(os.path.join(self.directory, 'missing.xml'), os.path.join(self.directory, 'missing.xml.gz'))
+
+        with self.assertRaises(Exception):
+            compressor.wait()
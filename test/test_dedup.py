@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+from dedup import HashedUrlIndex, SpillingUrlIndex, UrlDeduplicator, create_url_deduplicator
+from models import SiteMapUrlPage
+from test import FakeConfig
+
+CONFIG = FakeConfig(
+    base_page_url='n/a',
+    elasticsearch_url='n/a',
+    site_map_directory_path='n/a',
+    site_map_directory_url='n/a',
+    page_size='n/a',
+    url_change_frequency='n/a',
+    scroll_expiry='n/a',
+    request_timeout='n/a',
+    base_site_map_filename='n/a',
+    site_map_index_filename='n/a',
+    max_urls_per_file='n/a',
+    file_encoding='n/a',
+    es_doc_type='n/a',
+    es_index='n/a',
+)
+
+def create_page(names, cursors=None):
+    return SiteMapUrlPage(
+        ['http://localhost/{}'.format(name) for name in names],
+        ['2015-03-0{}'.format(i + 1) for i in range(0, len(names))],
+        'daily',
+        cursors,
+    )
+
+
+class UrlDeduplicatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_filter_drops_urls_seen_earlier_in_the_page_or_in_earlier_pages(self):
+        for dedup_mode in ['hashed', 'exact']:
+            config = CONFIG._replace(dedup_mode=dedup_mode, dedup_memory_mb=1, dedup_directory_path=self.directory)
+
+            with create_url_deduplicator(config) as deduplicator:
+                deduplicator.filter(create_page('AB'))
+                page = deduplicator.filter(create_page('CADC', cursors=[['C'], ['A'], ['D'], ['C2']]))
+
+            self.assertListEqual(page.locations, ['http://localhost/C', 'http://localhost/D'])
+            self.assertListEqual(page.last_modified, ['2015-03-01', '2015-03-03'])
+            self.assertListEqual(page.cursors, [['C'], ['D']])
+            self.assertEqual(deduplicator.nof_duplicates, 2)
+
+    def test_filter_passes_on_pages_without_duplicates_as_they_are(self):
+        page = create_page('AB')
+
+        with UrlDeduplicator(HashedUrlIndex(1024)) as deduplicator:
+            self.assertIs(deduplicator.filter(page), page)
+
+    def test_exact_index_is_removed_when_closed(self):
+        index = SpillingUrlIndex(1024 * 1024, self.directory)
+        index.add_new(['http://localhost/A'])
+        index.close()
+
+        self.assertListEqual(os.listdir(self.directory), [])
+
+    def test_hashed_index_refuses_more_urls_than_fit_in_its_memory_budget(self):
+        index = HashedUrlIndex(16 * 8)
+
+        with self.assertRaises(Exception):
+            index.add_new(['http://localhost/{}'.format(i) for i in range(0, 16)])
+
+    def test_hashed_index_keeps_every_url_while_growing(self):
+        index = HashedUrlIndex(1024 * 1024, initial_nof_slots=16)
+        locations = ['http://localhost/{}'.format(i) for i in range(0, 1000)]
+
+        self.assertEqual(len(index.add_new(locations)), 1000)
+        self.assertListEqual(index.add_new(locations), [])
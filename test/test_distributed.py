@@ -0,0 +1,142 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from distributed import DistributedGeneration
+from test import FakeConfig
+
+
+class FakeGenerator():
+
+    def __init__(self, generated_shards_path):
+        self.generated_shards_path = generated_shards_path
+
+    def generate_shard(self, site_map_directory_path, shard_number, query):
+        with open(self.generated_shards_path, 'at') as generated_shards_file:
+            generated_shards_file.write('{}\n'.format(shard_number))
+
+        return [{
+            'name': 'site_map_{}_0.xml'.format(shard_number),
+            'url_count': 1,
+            'first_location': 'http://localhost/{}'.format(shard_number),
+            'last_location': 'http://localhost/{}'.format(shard_number),
+            'max_url_last_modified': '2015-03-01',
+            'last_modified': '2015-03-02',
+        }]
+
+
+def run_worker(config, generated_shards_path):
+    DistributedGeneration(config, FakeGenerator(generated_shards_path)).work()
+
+
+class DistributedGenerationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.generated_shards_path = os.path.join(self.directory, 'generated_shards')
+        self.config = FakeConfig(
+            base_page_url='n/a',
+            elasticsearch_url='n/a',
+            site_map_directory_path=os.path.join(self.directory, 'site_map'),
+            site_map_directory_url='http://localhost/site-map',
+            page_size='n/a',
+            url_change_frequency='n/a',
+            scroll_expiry='n/a',
+            request_timeout='n/a',
+            base_site_map_filename='site_map',
+            site_map_index_filename='site_map_index.xml',
+            max_urls_per_file=1,
+            file_encoding='UTF-8',
+            es_doc_type='n/a',
+            es_index='n/a',
+        )._replace(shards=6, work_directory_path=os.path.join(self.directory, 'work'))
+        os.makedirs(self.config.site_map_directory_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_workers_in_several_processes_generate_each_shard_exactly_once(self):
+        DistributedGeneration(self.config, None).coordinate()
+
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(self.config, self.generated_shards_path))
+            for _ in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        with open(self.generated_shards_path) as generated_shards_file:
+            generated_shards = sorted(int(shard) for shard in generated_shards_file.read().split())
+
+        self.assertListEqual(generated_shards, list(range(6)))
+
+    def test_merge_writes_the_index_with_the_files_of_every_shard_in_shard_order(self):
+        distributed_generation = DistributedGeneration(self.config, FakeGenerator(self.generated_shards_path))
+        distributed_generation.coordinate()
+        distributed_generation.work()
+        distributed_generation.merge()
+
+        with open(os.path.join(self.config.site_map_directory_path, 'site_map_index.xml')) as index_file:
+            index = index_file.read()
+        with open(os.path.join(self.config.site_map_directory_path, 'site_map_manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        self.assertListEqual(
+            [index.index('site_map_{}_0.xml'.format(shard)) for shard in range(6)],
+            sorted(index.index('site_map_{}_0.xml'.format(shard)) for shard in range(6)))
+        self.assertListEqual(
+            [site_map_file['name'] for site_map_file in manifest['files']],
+            ['site_map_{}_0.xml'.format(shard) for shard in range(6)])
+
+    def test_merge_refuses_to_write_the_index_while_shards_are_missing(self):
+        distributed_generation = DistributedGeneration(self.config, FakeGenerator(self.generated_shards_path))
+        distributed_generation.coordinate()
+        os.close(os.open(os.path.join(self.config.work_directory_path, 'claims', '0.lock'), os.O_CREAT))
+        distributed_generation.work()
+
+        with self.assertRaises(Exception) as context:
+            distributed_generation.merge()
+
+        self.assertEqual(context.exception.args[1], [0])
+        self.assertFalse(os.path.exists(os.path.join(self.config.site_map_directory_path, 'site_map_index.xml')))
+        self.assertIn(0, context.exception.args[2])
+
+    def _hold_claim(self, shard, touched_seconds_ago):
+        claim_path = os.path.join(self.config.work_directory_path, 'claims', '{}.lock'.format(shard))
+
+        with open(claim_path, 'wt') as claim_file:
+            claim_file.write('gone-host:1234')
+
+        touched = time.time() - touched_seconds_ago
+        os.utime(claim_path, (touched, touched))
+
+    def test_work_takes_over_shards_whose_claim_has_not_been_touched_for_the_claim_timeout(self):
+        distributed_generation = DistributedGeneration(self.config, FakeGenerator(self.generated_shards_path))
+        distributed_generation.coordinate()
+        self._hold_claim(0, 2 * self.config.claim_timeout_seconds)
+        self._hold_claim(1, 1)
+
+        distributed_generation.work()
+
+        with open(self.generated_shards_path) as generated_shards_file:
+            generated_shards = sorted(int(shard) for shard in generated_shards_file.read().split())
+
+        self.assertListEqual(generated_shards, [0, 2, 3, 4, 5])
+
+    def test_work_does_not_take_over_finished_shards_whatever_the_age_of_their_claim(self):
+        distributed_generation = DistributedGeneration(self.config, FakeGenerator(self.generated_shards_path))
+        distributed_generation.coordinate()
+        distributed_generation.work()
+
+        for shard in range(6):
+            self._hold_claim(shard, 2 * self.config.claim_timeout_seconds)
+
+        os.unlink(self.generated_shards_path)
+        distributed_generation.work()
+
+        self.assertFalse(os.path.exists(self.generated_shards_path))
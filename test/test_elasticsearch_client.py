@@ -1,7 +1,8 @@
 import unittest
 import elasticsearch
-from mock import patch
-from elasticsearch_scan import ElasticsearchClient
+from mock import call, patch
+from elasticsearch_scan import ElasticsearchClient, SlicedElasticsearchClient, convert_entry_datetime, create_elasticsearch
+from datetime import datetime
 from models import SiteMapUrl
 from test import FakeConfig
 
@@ -22,6 +23,8 @@ CONFIG = FakeConfig(
     es_index='landregistry',
 )
 
+FILTER_PATH = '_scroll_id,hits.hits._source,hits.hits.sort'
+
 SCROLL_ID = 'cXVlcnlUaGVuRmV0Y2g7NTs3Nzp3eC1HUHBzSlJicXJxcDFJVU53V1NBOzc4Ond4LUdQcHNKUmJxcnFwMUlVTndXU0E7NzY6d3gtR1Bwc0pSYnFycXAxSVVOd1dTQTs4MDp3eC1HUHBzSlJicXJxcDFJVU53V1NBOzc5Ond4LUdQcHNKUmJxcnFwMUlVTndXU0E7MDs='
 
 SEARCH_RESULT = {
@@ -66,6 +69,26 @@ SEARCH_RESULT = {
     'took': 3
 }
 
+def create_search_result(scroll_id, address_keys):
+    return {
+        '_scroll_id': scroll_id,
+        'hits': {
+            'hits': [
+                {
+                    '_source': {
+                        'entryDatetime': '2014-06-07T09:01:38+00',
+                        'postcode': 'EX2 4RQ',
+                        'addressKey': '{}_EX2_4RQ'.format(address_key),
+                    }
+                } for address_key in address_keys
+            ]
+        }
+    }
+
+def get_address_segments(site_map_entries):
+    return [entry.location.split('/')[-1] for entry in site_map_entries]
+
+
 class ElasticsearchClientTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -76,7 +99,7 @@ class ElasticsearchClientTestCase(unittest.TestCase):
     def test_next_page_of_records_calls_search_on_first_call(self, mock_scroll, mock_search):
         ElasticsearchClient(CONFIG).next_page_of_records()
         self.assertEqual(mock_scroll.mock_calls, [])
-        mock_search.assert_called_once_with(CONFIG.es_index, CONFIG.es_doc_type, params={'timeout': CONFIG.request_timeout, 'scroll': CONFIG.scroll_expiry, 'size': CONFIG.page_size }, body=None)
+        mock_search.assert_called_once_with(CONFIG.es_index, CONFIG.es_doc_type, params={'timeout': CONFIG.request_timeout, 'scroll': CONFIG.scroll_expiry, 'size': CONFIG.page_size, 'filter_path': FILTER_PATH }, body={'_source': CONFIG.source_fields})
 
     @patch.object(elasticsearch.Elasticsearch, 'search', return_value=SEARCH_RESULT)
     @patch.object(elasticsearch.Elasticsearch, 'scroll', return_value=SEARCH_RESULT)
@@ -91,9 +114,10 @@ class ElasticsearchClientTestCase(unittest.TestCase):
             params={
                 'timeout': CONFIG.request_timeout, 
                 'scroll': CONFIG.scroll_expiry, 
-                'size': CONFIG.page_size 
+                'size': CONFIG.page_size,
+                'filter_path': FILTER_PATH,
             }, 
-            body=None)
+            body={'_source': CONFIG.source_fields})
         
         mock_scroll.assert_called_once_with(
             scroll_id=SCROLL_ID, 
@@ -101,7 +125,8 @@ class ElasticsearchClientTestCase(unittest.TestCase):
                 'scroll': CONFIG.scroll_expiry, 
                 'search_type': 'scan', 
                 'timeout': CONFIG.request_timeout, 
-                'size': CONFIG.page_size 
+                'size': CONFIG.page_size,
+                'filter_path': FILTER_PATH,
             })
 
     @patch.object(elasticsearch.Elasticsearch, 'search', return_value=SEARCH_RESULT)
@@ -117,8 +142,10 @@ class ElasticsearchClientTestCase(unittest.TestCase):
             change_frequency='daily',
         )
         
-        self.assertSequenceEqual(search_result, [expected_site_map_url])
-        self.assertEqual(scroll_result, [expected_site_map_url])
+        self.assertSequenceEqual(list(search_result), [expected_site_map_url])
+        self.assertEqual(list(scroll_result), [expected_site_map_url])
+        self.assertListEqual(scroll_result.locations, [expected_site_map_url.location])
+        self.assertListEqual(scroll_result.last_modified, [expected_site_map_url.last_modified])
 
     @patch.object(elasticsearch.Elasticsearch, 'search', return_value=SEARCH_RESULT)
     @patch.object(elasticsearch.Elasticsearch, 'clear_scroll')
@@ -129,3 +156,224 @@ class ElasticsearchClientTestCase(unittest.TestCase):
             client.next_page_of_records()
         
         mock_clear_scroll.assert_called_once_with(SCROLL_ID)
+
+
+    @patch.object(elasticsearch.Elasticsearch, 'search')
+    @patch.object(elasticsearch.Elasticsearch, 'scroll')
+    def test_next_page_of_records_searches_after_the_last_cursor_when_sorting(self, mock_scroll, mock_search):
+        search_result = create_search_result(SCROLL_ID, ['18_RIVERSTH_ROAD_EXETER'])
+        search_result['hits']['hits'][0]['sort'] = ['EX2 4RQ', '18_RIVERSTH_ROAD_EXETER_EX2_4RQ']
+        mock_search.return_value = search_result
+
+        client = ElasticsearchClient(CONFIG, query={'range': {'addressKey': {'gt': 'A'}}}, sort=True)
+        site_map_entries = client.next_page_of_records()
+        client.next_page_of_records()
+
+        params = {
+            'timeout': CONFIG.request_timeout,
+            'size': CONFIG.page_size,
+            'filter_path': FILTER_PATH,
+        }
+        body = {
+            '_source': CONFIG.source_fields,
+            'query': {'range': {'addressKey': {'gt': 'A'}}},
+            'sort': [{'postcode': 'asc'}, {'addressKey': 'asc'}],
+        }
+        mock_search.assert_has_calls([
+            call(CONFIG.es_index, CONFIG.es_doc_type, params=params, body=body),
+            call(CONFIG.es_index, CONFIG.es_doc_type, params=params,
+                 body=dict(body, search_after=['EX2 4RQ', '18_RIVERSTH_ROAD_EXETER_EX2_4RQ'])),
+        ])
+        mock_scroll.assert_not_called()
+        self.assertEqual(site_map_entries[0].cursor, ['EX2 4RQ', '18_RIVERSTH_ROAD_EXETER_EX2_4RQ'])
+
+
+    @patch.object(elasticsearch.Elasticsearch, 'search')
+    def test_next_page_of_records_starts_after_the_given_cursor_when_resuming(self, mock_search):
+        mock_search.return_value = create_search_result(SCROLL_ID, [])
+
+        ElasticsearchClient(CONFIG, sort=True, search_after=['EX2 4RQ', 'KEY_1']).next_page_of_records()
+
+        self.assertEqual(mock_search.call_args[1]['body']['search_after'], ['EX2 4RQ', 'KEY_1'])
+
+
+    @patch('request_control.time.sleep')
+    @patch.object(elasticsearch.Elasticsearch, 'search')
+    def test_next_page_of_records_repeats_the_same_search_after_a_timeout(self, mock_search, mock_sleep):
+        mock_search.side_effect = [
+            elasticsearch.ConnectionTimeout('TIMEOUT', 'slow', None), create_search_result(SCROLL_ID, [])]
+
+        ElasticsearchClient(CONFIG, sort=True, search_after=['EX2 4RQ', 'KEY_1']).next_page_of_records()
+
+        self.assertEqual(mock_search.call_count, 2)
+        self.assertEqual(mock_search.mock_calls[0], mock_search.mock_calls[1])
+
+    @patch('request_control.time.sleep')
+    @patch.object(elasticsearch.Elasticsearch, 'search', return_value=SEARCH_RESULT)
+    @patch.object(elasticsearch.Elasticsearch, 'scroll')
+    def test_next_page_of_records_does_not_repeat_a_scroll_that_timed_out(self, mock_scroll, mock_search, mock_sleep):
+        mock_scroll.side_effect = elasticsearch.ConnectionTimeout('TIMEOUT', 'slow', None)
+
+        client = ElasticsearchClient(CONFIG)
+        client.next_page_of_records()
+
+        with self.assertRaises(Exception):
+            client.next_page_of_records()
+
+        self.assertEqual(mock_scroll.call_count, 1)
+
+    @patch.object(elasticsearch.Elasticsearch, 'search', return_value=create_search_result(SCROLL_ID, []))
+    def test_next_page_of_records_asks_for_the_adapted_page_size(self, mock_search):
+        client = ElasticsearchClient(CONFIG._replace(adaptive_page_size=True, min_page_size=5), sort=True)
+        client.page_size.shrink()
+
+        client.next_page_of_records()
+
+        self.assertEqual(mock_search.call_args[1]['params']['size'], 5)
+
+
+    @patch.object(elasticsearch.Elasticsearch, 'search', return_value={'_scroll_id': SCROLL_ID})
+    def test_next_page_of_records_returns_no_records_when_filtered_response_has_no_hits(self, mock_search):
+        self.assertEqual(len(ElasticsearchClient(CONFIG).next_page_of_records()), 0)
+
+    @patch.object(elasticsearch.Elasticsearch, 'search', return_value=SEARCH_RESULT)
+    def test_next_page_of_records_does_not_filter_response_when_disabled(self, mock_search):
+        ElasticsearchClient(CONFIG._replace(filter_response=False)).next_page_of_records()
+        self.assertNotIn('filter_path', mock_search.mock_calls[0][2]['params'])
+
+
+class SlicedElasticsearchClientTestCase(unittest.TestCase):
+
+    @patch.object(elasticsearch.Elasticsearch, 'search')
+    @patch.object(elasticsearch.Elasticsearch, 'scroll')
+    def test_next_page_of_records_merges_slices_in_slice_order(self, mock_scroll, mock_search):
+        scroll_results = {
+            'slice0': [create_search_result('slice0', ['A2']), create_search_result('slice0', [])],
+            'slice1': [create_search_result('slice1', ['B2', 'B3']), create_search_result('slice1', ['B4']),
+                       create_search_result('slice1', [])],
+        }
+
+        mock_search.side_effect = lambda index, doc_type, body, params: create_search_result(
+            'slice{}'.format(body['slice']['id']), ['A1'] if body['slice']['id'] == 0 else ['B1'])
+        mock_scroll.side_effect = lambda scroll_id, params: scroll_results[scroll_id].pop(0)
+
+        client = SlicedElasticsearchClient(CONFIG._replace(slices=2))
+        pages = [get_address_segments(client.next_page_of_records()) for i in range(0, 5)]
+
+        self.assertListEqual(pages, [['A1', 'B1'], ['A2', 'B2', 'B3'], ['B4'], [], []])
+        self.assertListEqual(
+            sorted(call[2]['body']['slice']['id'] for call in mock_search.mock_calls), [0, 1])
+        self.assertTrue(all(call[2]['body']['slice']['max'] == 2 for call in mock_search.mock_calls))
+
+    @patch.object(elasticsearch.Elasticsearch, 'search')
+    @patch.object(elasticsearch.Elasticsearch, 'scroll', return_value=create_search_result('slice0', []))
+    def test_next_page_of_records_continues_sliced_scrolls_with_the_scroll_parameters_only(self, mock_scroll, mock_search):
+        mock_search.side_effect = lambda index, doc_type, body, params: create_search_result(
+            'slice{}'.format(body['slice']['id']), ['A1'])
+
+        client = SlicedElasticsearchClient(CONFIG._replace(slices=2))
+        client.next_page_of_records()
+        client.next_page_of_records()
+
+        self.assertEqual(mock_scroll.call_count, 2)
+        self.assertTrue(all(
+            call[2]['params'] == {'scroll': CONFIG.scroll_expiry, 'filter_path': FILTER_PATH}
+            for call in mock_scroll.mock_calls))
+
+    @patch.object(elasticsearch.Elasticsearch, 'search_shards', return_value={'shards': [[], [], [], [], []]})
+    @patch.object(elasticsearch.Elasticsearch, 'search', return_value=create_search_result(SCROLL_ID, []))
+    def test_next_page_of_records_reads_disjoint_shards_when_slicing_by_shard(self, mock_search, mock_search_shards):
+        client = SlicedElasticsearchClient(CONFIG._replace(slices=2, slice_method='shards'))
+        client.next_page_of_records()
+
+        preferences = sorted(call[2]['params']['preference'] for call in mock_search.mock_calls)
+        self.assertListEqual(preferences, ['_shards:0,2,4', '_shards:1,3'])
+        self.assertTrue(all('slice' not in call[2]['body'] for call in mock_search.mock_calls))
+
+    @patch.object(elasticsearch.Elasticsearch, 'search_shards', return_value={'shards': [[], []]})
+    @patch.object(elasticsearch.Elasticsearch, 'search')
+    def test_next_page_of_records_merges_sorted_slices_in_sort_order_whatever_their_page_sizes(
+            self, mock_search, mock_search_shards):
+        shard_pages = {
+            '_shards:0': [['A', 'B', 'E', 'F'], ['H']],
+            '_shards:1': [['C'], ['D', 'G'], ['I', 'J']],
+        }
+
+        def search(index, doc_type, body, params):
+            keys = shard_pages[params['preference']].pop(0) if shard_pages[params['preference']] else []
+            result = create_search_result(None, keys)
+
+            for hit in result['hits']['hits']:
+                hit['sort'] = [hit['_source']['postcode'], hit['_source']['addressKey']]
+
+            return result
+
+        mock_search.side_effect = search
+
+        client = SlicedElasticsearchClient(CONFIG._replace(slices=2, slice_method='shards'), sort=True)
+        pages = []
+        site_map_entries = client.next_page_of_records()
+
+        while site_map_entries:
+            pages.append(get_address_segments(site_map_entries))
+            site_map_entries = client.next_page_of_records()
+
+        self.assertListEqual(pages, [['A', 'B', 'C'], ['D', 'E', 'F'], ['G'], ['H'], ['I', 'J']])
+
+    @patch.object(elasticsearch.Elasticsearch, 'search', return_value=SEARCH_RESULT)
+    @patch.object(elasticsearch.Elasticsearch, 'clear_scroll')
+    def test_exit_clears_the_scroll_of_every_slice(self, mock_clear_scroll, mock_search):
+        with SlicedElasticsearchClient(CONFIG._replace(slices=3)) as client:
+            client.next_page_of_records()
+
+        self.assertListEqual(mock_clear_scroll.mock_calls, [call(SCROLL_ID)] * 3)
+
+
+class CreateElasticsearchTestCase(unittest.TestCase):
+
+    def test_create_elasticsearch_uses_every_node_of_the_elasticsearch_url_in_turn(self):
+        client = create_elasticsearch(CONFIG._replace(elasticsearch_url='http://node1:9200,http://node2:9200'))
+
+        self.assertListEqual(
+            sorted(connection.host for connection in client.transport.connection_pool.connections),
+            ['http://node1:9200', 'http://node2:9200'])
+        self.assertIsInstance(
+            client.transport.connection_pool.selector, elasticsearch.connection_pool.RoundRobinSelector)
+
+    def test_create_elasticsearch_keeps_the_configured_number_of_connections_to_each_node(self):
+        client = create_elasticsearch(CONFIG._replace(es_max_connections=32))
+
+        self.assertEqual(client.transport.get_connection().pool.pool.maxsize, 32)
+
+    def test_create_elasticsearch_asks_for_compressed_responses_when_configured(self):
+        client = create_elasticsearch(CONFIG._replace(es_compression=True))
+
+        self.assertIn('gzip', client.transport.get_connection().headers['accept-encoding'])
+
+    @patch.object(elasticsearch.Transport, 'sniff_hosts')
+    def test_create_elasticsearch_sniffs_the_cluster_nodes_when_configured(self, mock_sniff_hosts):
+        client = create_elasticsearch(CONFIG._replace(es_sniff_interval=60))
+
+        mock_sniff_hosts.assert_called_once_with(True)
+        self.assertEqual(client.transport.sniffer_timeout, 60)
+        self.assertTrue(client.transport.sniff_on_connection_fail)
+
+
+class ConvertEntryDatetimeTestCase(unittest.TestCase):
+
+    def test_convert_entry_datetime_matches_strptime_and_strftime(self):
+        entry_datetimes = [
+            '2014-06-07T09:01:38+00',
+            '2016-02-29T23:59:59+00',
+            '2000-01-01T00:00:00+00',
+            '2014-6-7T9:1:38+00',
+        ]
+
+        for entry_datetime in entry_datetimes:
+            expected = datetime.strptime(entry_datetime, '%Y-%m-%dT%H:%M:%S+00').strftime('%Y-%m-%dT%H:%M+00:00')
+            self.assertEqual(convert_entry_datetime(entry_datetime), expected)
+
+    def test_convert_entry_datetime_rejects_invalid_values(self):
+        for entry_datetime in ['2015-02-29T09:01:38+00', '2014-06-07T24:01:38+00', '2014-06-07T09:01:60+00', '']:
+            with self.assertRaises(ValueError):
+                convert_entry_datetime(entry_datetime)
@@ -1,9 +1,17 @@
+import itertools
+import os
+import shutil
+import tempfile
 import unittest
 from mock import patch
 from mock import call
 import elasticsearch_scan
+import incremental
 from generate import Generator
-from models import SiteMapUrl
+from manifest import SiteMapManifest
+from checkpoint import Checkpoint
+from sharding import get_shard_queries
+from models import SiteMapUrl, SiteMapUrlPage
 import site_map
 from test import FakeConfig
 
@@ -32,8 +40,10 @@ class GeneratorTestCase(unittest.TestCase):
     @patch.object(site_map.SiteMapCreator, 'append_urls_to_site_map')
     @patch.object(site_map.SiteMapCreator, 'flush_site_map')
     @patch.object(site_map.SiteMapCreator, 'create_site_map_index_file')
+    @patch.object(site_map.SiteMapCreator, 'save_manifest')
     def test_generate_property_site_map_passes_each_es_data_page_to_site_map_creator(
             self,
+            mock_save_manifest,
             mock_create_site_map_index_file,
             mock_flush_site_map,
             mock_append_urls_to_site_map,
@@ -54,3 +64,213 @@ class GeneratorTestCase(unittest.TestCase):
         mock_flush_site_map.assert_called_once_with()
         mock_create_site_map_index_file.assert_called_once_with()
         self.assertEqual(len(mock_client_exit.mock_calls), 1)
+        mock_save_manifest.assert_called_once_with()
+
+    @patch.object(elasticsearch_scan.SlicedElasticsearchClient, '__init__', return_value=None)
+    @patch.object(elasticsearch_scan.SlicedElasticsearchClient, 'next_page_of_records', return_value=[])
+    @patch.object(elasticsearch_scan.SlicedElasticsearchClient, '__exit__')
+    @patch.object(site_map.SiteMapCreator, 'clear_site_map_directory')
+    @patch.object(site_map.SiteMapCreator, 'create_site_map_index_file')
+    @patch.object(site_map.SiteMapCreator, 'save_manifest')
+    def test_generate_property_site_map_reads_slices_in_parallel_when_configured(
+            self,
+            mock_save_manifest,
+            mock_create_site_map_index_file,
+            mock_clear_site_map_directory,
+            mock_client_exit,
+            mock_next_page_of_records,
+            mock_client_init):
+
+        Generator(CONFIG._replace(slices=4)).generate_property_site_map()
+
+        mock_client_init.assert_called_once_with(CONFIG._replace(slices=4), query=None, sort=False)
+        mock_next_page_of_records.assert_called_once_with()
+
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__init__', return_value=None)
+    @patch.object(elasticsearch_scan.ElasticsearchClient, 'next_page_of_records')
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__exit__')
+    @patch.object(site_map.SiteMapCreator, 'load_manifest')
+    @patch.object(site_map.SiteMapCreator, 'clear_site_map_directory')
+    @patch.object(site_map.SiteMapCreator, 'create_site_map_index_file')
+    @patch.object(site_map.SiteMapCreator, 'save_manifest')
+    @patch.object(incremental.SiteMapUpdater, 'apply_changes')
+    def test_generate_property_site_map_only_applies_records_modified_since_last_run_when_incremental(
+            self,
+            mock_apply_changes,
+            mock_save_manifest,
+            mock_create_site_map_index_file,
+            mock_clear_site_map_directory,
+            mock_load_manifest,
+            mock_client_exit,
+            mock_next_page_of_records,
+            mock_client_init):
+
+        url_list_1 = SiteMapUrlPage(['loc1'], ['2015-03-01'], 'daily')
+        url_list_2 = SiteMapUrlPage(['loc2'], ['2015-03-02'], 'daily')
+
+        mock_load_manifest.return_value = SiteMapManifest('2015-03-01T10:15+00:00', [])
+        mock_next_page_of_records.side_effect = [url_list_1, url_list_2, []]
+        config = CONFIG._replace(incremental=True)
+
+        Generator(config).generate_property_site_map()
+
+        mock_client_init.assert_called_once_with(
+            config, query={'range': {'entryDatetime': {'gte': '2015-03-01T10:15:00+00'}}}, sort=False, search_after=None)
+        mock_clear_site_map_directory.assert_not_called()
+        self.assertListEqual(list(mock_apply_changes.call_args[0][0]), list(url_list_1) + list(url_list_2))
+        mock_create_site_map_index_file.assert_called_once_with()
+        mock_save_manifest.assert_called_once_with()
+
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__init__', return_value=None)
+    @patch.object(elasticsearch_scan.ElasticsearchClient, 'next_page_of_records', return_value=[])
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__exit__')
+    @patch.object(site_map.SiteMapCreator, 'load_manifest')
+    @patch.object(site_map.SiteMapCreator, 'create_site_map_index_file')
+    @patch.object(site_map.SiteMapCreator, 'save_manifest')
+    @patch.object(site_map.SiteMapCreator, 'remove_checkpoint')
+    @patch.object(incremental.SiteMapUpdater, 'apply_changes')
+    def test_generate_property_site_map_does_not_leave_a_checkpoint_after_an_incremental_update(
+            self,
+            mock_apply_changes,
+            mock_remove_checkpoint,
+            mock_save_manifest,
+            mock_create_site_map_index_file,
+            mock_load_manifest,
+            mock_client_exit,
+            mock_next_page_of_records,
+            mock_client_init):
+
+        mock_load_manifest.return_value = SiteMapManifest('2015-03-01T10:15+00:00', [])
+
+        Generator(CONFIG._replace(incremental=True, checkpoint_interval=5)).generate_property_site_map()
+
+        mock_remove_checkpoint.assert_called_once_with()
+
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__init__', return_value=None)
+    @patch.object(elasticsearch_scan.ElasticsearchClient, 'next_page_of_records', return_value=[])
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__exit__')
+    @patch.object(site_map.SiteMapCreator, 'load_manifest', return_value=None)
+    @patch.object(site_map.SiteMapCreator, 'clear_site_map_directory')
+    @patch.object(site_map.SiteMapCreator, 'create_site_map_index_file')
+    @patch.object(site_map.SiteMapCreator, 'save_manifest')
+    def test_generate_property_site_map_reads_sorted_records_for_a_full_incremental_run(
+            self,
+            mock_save_manifest,
+            mock_create_site_map_index_file,
+            mock_clear_site_map_directory,
+            mock_load_manifest,
+            mock_client_exit,
+            mock_next_page_of_records,
+            mock_client_init):
+
+        config = CONFIG._replace(incremental=True)
+
+        Generator(config).generate_property_site_map()
+
+        mock_client_init.assert_called_once_with(config, query=None, sort=True, search_after=None)
+
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__init__', return_value=None)
+    @patch.object(elasticsearch_scan.ElasticsearchClient, 'next_page_of_records', return_value=[])
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__exit__')
+    @patch.object(site_map.SiteMapCreator, 'load_checkpoint')
+    @patch.object(site_map.SiteMapCreator, 'clear_site_map_directory')
+    @patch.object(site_map.SiteMapCreator, 'create_site_map_index_file')
+    @patch.object(site_map.SiteMapCreator, 'save_manifest')
+    @patch.object(site_map.SiteMapCreator, 'remove_checkpoint')
+    def test_generate_property_site_map_resumes_after_the_checkpoint_cursor(
+            self,
+            mock_remove_checkpoint,
+            mock_save_manifest,
+            mock_create_site_map_index_file,
+            mock_clear_site_map_directory,
+            mock_load_checkpoint,
+            mock_client_exit,
+            mock_next_page_of_records,
+            mock_client_init):
+
+        mock_load_checkpoint.return_value = Checkpoint(['KEY_1'], [{'name': 'sitemap_0.xml'}])
+        config = CONFIG._replace(checkpoint_interval=5, resume=True)
+
+        Generator(config).generate_property_site_map()
+
+        mock_client_init.assert_called_once_with(config, query=None, sort=True, search_after=['KEY_1'])
+        mock_clear_site_map_directory.assert_called_once_with(except_file_names=[])
+        mock_create_site_map_index_file.assert_called_once_with()
+        mock_remove_checkpoint.assert_called_once_with()
+
+    def test_generate_property_site_map_refuses_checkpoints_with_several_slices(self):
+        with self.assertRaises(Exception):
+            Generator(CONFIG._replace(checkpoint_interval=5, slices=2)).generate_property_site_map()
+
+    def test_generate_property_site_map_refuses_sorted_extraction_with_scroll_slices(self):
+        with self.assertRaises(Exception):
+            Generator(CONFIG._replace(sorted_extraction=True, slices=2)).generate_property_site_map()
+
+    def test_generate_property_site_map_refuses_to_record_several_slices_or_a_resumed_run(self):
+        for changes in [{'slices': 2}, {'shards': 2}, {'resume': True}]:
+            with self.assertRaises(Exception):
+                Generator(CONFIG._replace(record_file_path='n/a', **changes)).generate_property_site_map()
+
+    @patch('generate.DistributedGeneration')
+    def test_run_distributed_role_refuses_checkpoints_resuming_and_recording(self, mock_distributed_generation):
+        for changes in [{'checkpoint_interval': 5}, {'resume': True}, {'record_file_path': 'n/a'}]:
+            with self.assertRaises(Exception):
+                Generator(CONFIG._replace(**changes)).run_distributed_role('work')
+
+        mock_distributed_generation.assert_not_called()
+
+    @patch('generate.DistributedGeneration')
+    def test_run_distributed_role_refuses_the_options_a_single_run_refuses(self, mock_distributed_generation):
+        with self.assertRaises(Exception):
+            Generator(CONFIG._replace(sorted_extraction=True, slices=2)).run_distributed_role('work')
+
+        mock_distributed_generation.assert_not_called()
+
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__init__', return_value=None)
+    @patch.object(elasticsearch_scan.ElasticsearchClient, 'next_page_of_records')
+    @patch.object(elasticsearch_scan.ElasticsearchClient, '__exit__')
+    @patch('generate.multiprocessing.Pool')
+    def test_generate_property_site_map_generates_each_shard_into_its_own_files(
+            self,
+            mock_pool,
+            mock_client_exit,
+            mock_next_page_of_records,
+            mock_client_init):
+
+        directory = tempfile.mkdtemp()
+
+        try:
+            mock_pool.return_value.__enter__.return_value.starmap.side_effect = \
+                lambda function, arguments: list(itertools.starmap(function, arguments))
+            mock_next_page_of_records.side_effect = [
+                SiteMapUrlPage(['http://localhost/A1', 'http://localhost/A2'], ['2015-03-01', '2015-03-01'], 'daily'),
+                [],
+                SiteMapUrlPage(['http://localhost/B1'], ['2015-03-02'], 'daily'),
+                [],
+            ]
+            config = CONFIG._replace(
+                site_map_directory_path=directory,
+                site_map_directory_url='http://localhost/site-map',
+                base_site_map_filename='site_map',
+                site_map_index_filename='site_map_index.xml',
+                max_urls_per_file=1,
+                file_encoding='UTF-8',
+                shards=2,
+            )
+
+            Generator(config).generate_property_site_map()
+
+            mock_pool.assert_called_once_with(2)
+            self.assertListEqual(
+                [call[2]['query'] for call in mock_client_init.mock_calls], get_shard_queries(2, 'postcode'))
+            self.assertListEqual(
+                sorted(os.listdir(directory)),
+                ['site_map_0_0.xml', 'site_map_0_1.xml', 'site_map_1_0.xml', 'site_map_index.xml',
+                 'site_map_manifest.json'])
+
+            with open(os.path.join(directory, 'site_map_index.xml')) as index_file:
+                index = index_file.read()
+
+            self.assertLess(index.index('site_map_0_1.xml'), index.index('site_map_1_0.xml'))
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,214 @@
+import os
+import shutil
+import tempfile
+import unittest
+from incremental import SiteMapFileRanges, SiteMapUpdater, get_modified_since_query
+from models import SiteMapUrl, SiteMapUrlPage
+from site_map import SiteMapCreator
+from site_map_writer import get_url_entry_size
+from test import FakeConfig
+
+CONFIG = FakeConfig(
+    base_page_url='n/a',
+    elasticsearch_url='n/a',
+    site_map_directory_path='n/a',
+    site_map_directory_url='http://localhost/sitemap/directory/url',
+    page_size=0,
+    url_change_frequency='n/a',
+    scroll_expiry='n/a',
+    request_timeout='n/a',
+    base_site_map_filename='sitemap',
+    site_map_index_filename='sitemap_index.xml',
+    max_urls_per_file=3,
+    file_encoding='UTF-8',
+    es_doc_type='n/a',
+    es_index='n/a',
+)
+
+def create_site_map_url(name, last_modified='2015-03-02T10:00+00:00'):
+    return SiteMapUrl(
+        location='http://localhost/property/{}'.format(name),
+        last_modified=last_modified,
+        change_frequency='daily',
+    )
+
+
+class SiteMapUpdaterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = CONFIG._replace(site_map_directory_path=self.directory)
+
+        site_map_creator = SiteMapCreator(self.config)
+        site_map_creator.append_urls_to_site_map([create_site_map_url(name) for name in 'ACEGIK'])
+        site_map_creator.flush_site_map()
+        site_map_creator.save_manifest()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_apply_changes_rewrites_only_files_containing_changed_urls(self):
+        untouched_file_path = os.path.join(self.directory, 'sitemap_1.xml')
+        os.utime(untouched_file_path, (0, 0))
+
+        site_map_creator = SiteMapCreator(self.config)
+        site_map_creator.load_manifest()
+        changed_url = create_site_map_url('C', '2015-03-05T08:30+00:00')
+
+        SiteMapUpdater(self.config, site_map_creator).apply_changes([changed_url])
+
+        self.assertIn(changed_url, site_map_creator.read_site_map_file('sitemap_0.xml'))
+        self.assertEqual(os.path.getmtime(untouched_file_path), 0)
+        self.assertEqual(site_map_creator.site_map_files[0]['max_url_last_modified'], '2015-03-05T08:30+00:00')
+
+    def test_apply_changes_does_not_rewrite_files_when_changed_urls_are_identical(self):
+        os.utime(os.path.join(self.directory, 'sitemap_0.xml'), (0, 0))
+
+        site_map_creator = SiteMapCreator(self.config)
+        site_map_creator.load_manifest()
+
+        SiteMapUpdater(self.config, site_map_creator).apply_changes([create_site_map_url('A')])
+
+        self.assertEqual(os.path.getmtime(os.path.join(self.directory, 'sitemap_0.xml')), 0)
+
+    def test_apply_changes_rewrites_files_with_the_change_frequency_of_a_changed_page(self):
+        site_map_creator = SiteMapCreator(self.config)
+        site_map_creator.load_manifest()
+
+        SiteMapUpdater(self.config, site_map_creator).apply_changes(SiteMapUrlPage(
+            ['http://localhost/property/A'], ['2015-03-02T10:00+00:00'], 'weekly'))
+
+        self.assertListEqual(
+            [url.change_frequency for url in site_map_creator.read_site_map_file('sitemap_0.xml')],
+            ['weekly', 'weekly', 'weekly'])
+        self.assertListEqual(
+            [url.change_frequency for url in site_map_creator.read_site_map_file('sitemap_1.xml')],
+            ['daily', 'daily', 'daily'])
+
+    def test_apply_changes_adds_new_urls_to_files_with_space_and_then_to_new_files(self):
+        site_map_creator = SiteMapCreator(self.config._replace(max_urls_per_file=4))
+        site_map_creator.load_manifest()
+
+        SiteMapUpdater(self.config._replace(max_urls_per_file=4), site_map_creator).apply_changes(
+            [create_site_map_url('B'), create_site_map_url('H'), create_site_map_url('Z')])
+
+        self.assertListEqual(site_map_creator.site_map_file_names, ['sitemap_0.xml', 'sitemap_1.xml', 'sitemap_2.xml'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_0.xml')], ['A', 'C', 'E', 'B'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_1.xml')], ['G', 'I', 'K', 'H'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_2.xml')], ['Z'])
+
+    def test_apply_changes_moves_urls_that_would_take_a_file_past_its_byte_limit_to_new_files(self):
+        site_map_creator = SiteMapCreator(self.config)
+        site_map_creator.load_manifest()
+        config = self.config._replace(
+            max_urls_per_file=4, max_bytes_per_file=site_map_creator.site_map_files[0]['byte_count'] + 1)
+        site_map_creator = SiteMapCreator(config)
+        site_map_creator.load_manifest()
+
+        SiteMapUpdater(config, site_map_creator).apply_changes([create_site_map_url('B')])
+
+        self.assertListEqual(site_map_creator.site_map_file_names, ['sitemap_0.xml', 'sitemap_1.xml', 'sitemap_2.xml'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_0.xml')], ['A', 'C', 'E'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_2.xml')], ['B'])
+
+        for site_map_file in site_map_creator.site_map_files:
+            self.assertLessEqual(
+                os.path.getsize(os.path.join(self.directory, site_map_file['name'])), config.max_bytes_per_file)
+
+    def test_apply_changes_adds_new_urls_to_files_with_bytes_to_spare_and_then_to_new_files(self):
+        site_map_creator = SiteMapCreator(self.config)
+        site_map_creator.load_manifest()
+        config = self.config._replace(max_urls_per_file=4, max_bytes_per_file=(
+            site_map_creator.site_map_files[0]['byte_count'] +
+            get_url_entry_size(create_site_map_url('B').location, '2015-03-02T10:00+00:00', 'daily', 'UTF-8')))
+        site_map_creator = SiteMapCreator(config)
+        site_map_creator.load_manifest()
+
+        SiteMapUpdater(config, site_map_creator).apply_changes(
+            [create_site_map_url('B'), create_site_map_url('D'), create_site_map_url('H')])
+
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_0.xml')], ['A', 'C', 'E', 'B'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_1.xml')], ['G', 'I', 'K', 'D'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_2.xml')], ['H'])
+        self.assertListEqual(
+            [site_map_file['byte_count'] for site_map_file in site_map_creator.site_map_files[:2]],
+            [config.max_bytes_per_file, config.max_bytes_per_file])
+
+    def test_apply_changes_moves_urls_refused_by_the_rewrite_to_new_files_without_recorded_byte_counts(self):
+        site_map_creator = SiteMapCreator(self.config)
+        site_map_creator.load_manifest()
+        config = self.config._replace(
+            max_urls_per_file=4, max_bytes_per_file=site_map_creator.site_map_files[0]['byte_count'] + 1)
+        site_map_creator = SiteMapCreator(config)
+        site_map_creator.load_manifest()
+
+        for site_map_file in site_map_creator.site_map_files:
+            del site_map_file['byte_count']
+
+        SiteMapUpdater(config, site_map_creator).apply_changes([create_site_map_url('B')])
+
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_0.xml')], ['A', 'C', 'E'])
+        self.assertListEqual(
+            [url.location[-1] for url in site_map_creator.read_site_map_file('sitemap_2.xml')], ['B'])
+
+    def test_apply_changes_rewrites_compressed_files(self):
+        config = self.config._replace(compress_output=True)
+        site_map_creator = SiteMapCreator(config)
+        site_map_creator.clear_site_map_directory()
+        site_map_creator.append_urls_to_site_map([create_site_map_url(name) for name in 'ACEGIK'])
+        site_map_creator.flush_site_map()
+        site_map_creator.wait_for_compressed_files()
+        site_map_creator.save_manifest()
+
+        site_map_creator = SiteMapCreator(config)
+        site_map_creator.load_manifest()
+        changed_url = create_site_map_url('C', '2015-03-05T08:30+00:00')
+
+        SiteMapUpdater(config, site_map_creator).apply_changes([changed_url])
+        site_map_creator.wait_for_compressed_files()
+
+        self.assertListEqual(
+            list(site_map_creator.read_site_map_file('sitemap_0.xml.gz')),
+            [create_site_map_url('A'), changed_url, create_site_map_url('E')])
+        self.assertListEqual(sorted(os.listdir(self.directory)), [
+            'site_map_manifest.json', 'sitemap_0.xml.gz', 'sitemap_1.xml.gz'])
+
+
+class SiteMapFileRangesTestCase(unittest.TestCase):
+
+    def test_find_files_covering_finds_every_file_whose_range_holds_the_location_nearest_first(self):
+        file_ranges = SiteMapFileRanges([
+            {'name': 'sitemap_0.xml', 'first_location': 'A', 'last_location': 'M'},
+            {'name': 'sitemap_1.xml', 'first_location': 'N', 'last_location': 'P'},
+            {'name': 'sitemap_2.xml', 'first_location': 'C', 'last_location': 'E'},
+            {'name': 'sitemap_3.xml', 'first_location': None, 'last_location': None},
+        ])
+
+        def find_file_names(location):
+            return [site_map_file['name'] for site_map_file in file_ranges.find_files_covering(location)]
+
+        self.assertListEqual(find_file_names('D'), ['sitemap_2.xml', 'sitemap_0.xml'])
+        self.assertListEqual(find_file_names('F'), ['sitemap_0.xml'])
+        self.assertListEqual(find_file_names('O'), ['sitemap_1.xml'])
+        self.assertListEqual(find_file_names('Q'), [])
+
+
+class GetModifiedSinceQueryTestCase(unittest.TestCase):
+
+    def test_get_modified_since_query_reads_again_from_the_start_of_the_high_water_mark_minute(self):
+        self.assertEqual(
+            get_modified_since_query('2015-03-05T08:30+00:00'),
+            {'range': {'entryDatetime': {'gte': '2015-03-05T08:30:00+00'}}}
+        )
+
+    def test_get_modified_since_query_reads_everything_without_a_high_water_mark(self):
+        self.assertIsNone(get_modified_since_query(None))
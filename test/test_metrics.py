@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from metrics import Metrics, save_metrics_file, save_prometheus_file
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_time_adds_up_the_time_and_calls_of_a_stage_across_threads(self):
+        metrics = Metrics()
+
+        def time_stage():
+            with metrics.time('conversion'):
+                pass
+
+        threads = [threading.Thread(target=time_stage) for _ in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(metrics.snapshot()['stages']['conversion']['calls'], 4)
+
+    def test_merge_adds_the_metrics_of_another_process(self):
+        metrics = Metrics()
+        metrics.add_time('conversion', 1.5)
+        metrics.increment('records', 1000)
+
+        metrics.merge({'stages': {'conversion': {'seconds': 0.5, 'calls': 2}}, 'counters': {'records': 500}})
+
+        self.assertDictEqual(metrics.snapshot(), {
+            'stages': {'conversion': {'seconds': 2.0, 'calls': 3}},
+            'counters': {'records': 1500},
+        })
+
+    def test_reset_clears_all_metrics(self):
+        metrics = Metrics()
+        metrics.add_time('conversion', 1.5)
+        metrics.increment('records', 1000)
+
+        metrics.reset()
+
+        self.assertDictEqual(metrics.snapshot(), {'stages': {}, 'counters': {}})
+
+
+class MetricsFileTestCase(unittest.TestCase):
+
+    SNAPSHOT = {
+        'stages': {'total': {'seconds': 2.5, 'calls': 1}, 'conversion': {'seconds': 0.5, 'calls': 10}},
+        'counters': {'records': 10000},
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_metrics_file_saves_snapshot_as_json(self):
+        file_path = os.path.join(self.directory, 'metrics.json')
+
+        save_metrics_file(self.SNAPSHOT, file_path)
+
+        with open(file_path) as file:
+            self.assertDictEqual(json.load(file), self.SNAPSHOT)
+
+    def test_save_prometheus_file_writes_a_sample_per_stage_and_counter(self):
+        file_path = os.path.join(self.directory, 'site_map.prom')
+
+        save_prometheus_file(self.SNAPSHOT, file_path)
+
+        with open(file_path) as file:
+            lines = file.read().splitlines()
+
+        self.assertIn('property_site_map_stage_seconds{stage="conversion"} 0.5', lines)
+        self.assertIn('property_site_map_stage_calls{stage="total"} 1', lines)
+        self.assertIn('# TYPE property_site_map_records gauge', lines)
+        self.assertIn('property_site_map_records 10000', lines)
+        self.assertListEqual(os.listdir(self.directory), ['site_map.prom'])
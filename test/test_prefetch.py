@@ -0,0 +1,65 @@
+import threading
+import unittest
+from mock import MagicMock
+from prefetch import PrefetchingClient
+
+
+class FakeClient():
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.exited = False
+        self.nof_fetched_pages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.exited = True
+
+    def next_page_of_records(self):
+        self.nof_fetched_pages += 1
+        page = self.pages.pop(0)
+
+        if isinstance(page, Exception):
+            raise page
+
+        return page
+
+
+class PrefetchingClientTestCase(unittest.TestCase):
+
+    def test_next_page_of_records_returns_pages_in_order(self):
+        client = FakeClient([['a'], ['b', 'c'], []])
+
+        with PrefetchingClient(client, 2) as prefetching_client:
+            pages = [prefetching_client.next_page_of_records() for i in range(0, 4)]
+
+        self.assertListEqual(pages, [['a'], ['b', 'c'], [], []])
+        self.assertEqual(client.nof_fetched_pages, 3)
+
+    def test_next_page_of_records_passes_on_errors_from_the_producer(self):
+        error = Exception('scroll failed')
+        client = FakeClient([['a'], error])
+
+        with self.assertRaises(Exception) as context:
+            with PrefetchingClient(client, 1) as prefetching_client:
+                prefetching_client.next_page_of_records()
+                prefetching_client.next_page_of_records()
+
+        self.assertIs(context.exception, error)
+        self.assertTrue(client.exited)
+
+    def test_exit_stops_the_producer_before_exiting_the_client(self):
+        client = FakeClient([['a']] * 100)
+        stopped_producer = threading.Event()
+        client.__exit__ = MagicMock(side_effect=lambda *args: stopped_producer.set())
+
+        with self.assertRaises(ValueError):
+            with PrefetchingClient(client, 1) as prefetching_client:
+                prefetching_client.next_page_of_records()
+                raise ValueError('failed to write site map')
+
+        self.assertTrue(stopped_producer.is_set())
+        self.assertFalse(prefetching_client.producer.is_alive())
+        self.assertLess(client.nof_fetched_pages, 100)
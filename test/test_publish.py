@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+from publish import SiteMapPublisher
+from test import FakeConfig
+
+CONFIG = FakeConfig(
+    base_page_url='n/a',
+    elasticsearch_url='n/a',
+    site_map_directory_path='n/a',
+    site_map_directory_url='n/a',
+    page_size='n/a',
+    url_change_frequency='n/a',
+    scroll_expiry='n/a',
+    request_timeout='n/a',
+    base_site_map_filename='sitemap',
+    site_map_index_filename='sitemap_index.xml',
+    max_urls_per_file='n/a',
+    file_encoding='n/a',
+    es_doc_type='n/a',
+    es_index='n/a',
+)
+
+def write_file(directory_path, file_name, content):
+    with open(os.path.join(directory_path, file_name), 'wt') as file:
+        file.write(content)
+
+def read_file(directory_path, file_name):
+    with open(os.path.join(directory_path, file_name), 'rt') as file:
+        return file.read()
+
+
+class SiteMapPublisherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.site_map_directory_path = os.path.join(self.directory, 'site_maps')
+        self.config = CONFIG._replace(site_map_directory_path=self.site_map_directory_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _publish_generation(self, publisher, content, seed_with_published_files=False):
+        staging_directory_path = publisher.create_staging_directory(seed_with_published_files)
+        write_file(staging_directory_path, 'sitemap_0.xml', content)
+        publisher.publish(staging_directory_path)
+        return staging_directory_path
+
+    def test_publish_points_site_map_directory_to_the_new_generation(self):
+        publisher = SiteMapPublisher(self.config)
+        self._publish_generation(publisher, 'first')
+        second_generation_path = self._publish_generation(publisher, 'second')
+
+        self.assertTrue(os.path.islink(self.site_map_directory_path))
+        self.assertEqual(os.path.realpath(self.site_map_directory_path), os.path.realpath(second_generation_path))
+        self.assertEqual(read_file(self.site_map_directory_path, 'sitemap_0.xml'), 'second')
+
+    def test_publish_keeps_only_the_configured_number_of_previous_generations(self):
+        publisher = SiteMapPublisher(self.config._replace(keep_generations=1))
+
+        for content in ['first', 'second', 'third']:
+            self._publish_generation(publisher, content)
+
+        generations = os.listdir(publisher.generations_directory_path)
+        contents = sorted(read_file(os.path.join(publisher.generations_directory_path, generation), 'sitemap_0.xml')
+                          for generation in generations)
+
+        self.assertListEqual(contents, ['second', 'third'])
+
+    def test_publish_adopts_an_existing_site_map_directory_as_previous_generation(self):
+        os.mkdir(self.site_map_directory_path)
+        write_file(self.site_map_directory_path, 'sitemap_0.xml', 'existing')
+
+        publisher = SiteMapPublisher(self.config)
+        self._publish_generation(publisher, 'new')
+        publisher.rollback()
+
+        self.assertEqual(read_file(self.site_map_directory_path, 'sitemap_0.xml'), 'existing')
+
+    def test_rollback_publishes_the_previous_generation_again(self):
+        publisher = SiteMapPublisher(self.config)
+        self._publish_generation(publisher, 'first')
+        self._publish_generation(publisher, 'second')
+
+        publisher.rollback()
+
+        self.assertEqual(read_file(self.site_map_directory_path, 'sitemap_0.xml'), 'first')
+
+        with self.assertRaises(Exception):
+            publisher.rollback()
+
+    def test_rollback_after_publishing_over_a_rollback_returns_to_the_generation_rolled_back_to(self):
+        publisher = SiteMapPublisher(self.config._replace(keep_generations=1))
+        self._publish_generation(publisher, 'good')
+        self._publish_generation(publisher, 'bad')
+        publisher.rollback()
+        self._publish_generation(publisher, 'next')
+
+        publisher.rollback()
+
+        self.assertEqual(read_file(self.site_map_directory_path, 'sitemap_0.xml'), 'good')
+        self.assertEqual(len(os.listdir(publisher.generations_directory_path)), 1)
+
+    def test_create_staging_directory_seeds_site_map_files_without_sharing_later_changes(self):
+        publisher = SiteMapPublisher(self.config)
+        first_generation_path = self._publish_generation(publisher, 'first')
+        write_file(first_generation_path, self.config.site_map_index_filename, 'index')
+
+        staging_directory_path = publisher.create_staging_directory(seed_with_published_files=True)
+
+        self.assertListEqual(os.listdir(staging_directory_path), ['sitemap_0.xml'])
+
+        write_file(staging_directory_path, 'sitemap_0.xml.tmp', 'changed')
+        os.replace(os.path.join(staging_directory_path, 'sitemap_0.xml.tmp'),
+                   os.path.join(staging_directory_path, 'sitemap_0.xml'))
+
+        self.assertEqual(read_file(self.site_map_directory_path, 'sitemap_0.xml'), 'first')
+
+    def test_discard_removes_the_staging_directory(self):
+        publisher = SiteMapPublisher(self.config)
+        staging_directory_path = publisher.create_staging_directory()
+
+        publisher.discard(staging_directory_path)
+
+        self.assertFalse(os.path.exists(staging_directory_path))
+        self.assertFalse(os.path.exists(self.site_map_directory_path))
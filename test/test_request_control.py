@@ -0,0 +1,124 @@
+import unittest
+from elasticsearch import ConnectionTimeout, NotFoundError, TransportError
+from mock import MagicMock
+from request_control import AdaptivePageSize, RateLimiter, RetryPolicy
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+    def test_call_retries_transient_failures_with_growing_backoff(self):
+        sleep = MagicMock()
+        request = MagicMock(side_effect=[TransportError(429, 'rejected'), ConnectionTimeout('TIMEOUT', 'slow', None), 'page'])
+
+        result = RetryPolicy(3, 1.0, sleep=sleep).call(request, repeatable=True)
+
+        self.assertEqual(result, 'page')
+        self.assertEqual(request.call_count, 3)
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 1.0 and 0 <= delays[1] <= 2.0)
+
+    def test_call_gives_up_after_the_maximum_number_of_retries(self):
+        request = MagicMock(side_effect=TransportError(503, 'unavailable'))
+
+        with self.assertRaises(TransportError):
+            RetryPolicy(2, 1.0, sleep=MagicMock()).call(request, repeatable=True)
+
+        self.assertEqual(request.call_count, 3)
+
+    def test_call_does_not_retry_timeouts_of_requests_that_cannot_be_repeated(self):
+        request = MagicMock(side_effect=ConnectionTimeout('TIMEOUT', 'slow', None))
+
+        with self.assertRaises(ConnectionTimeout):
+            RetryPolicy(3, 1.0, sleep=MagicMock()).call(request, repeatable=False)
+
+        self.assertEqual(request.call_count, 1)
+
+    def test_call_does_not_retry_permanent_failures(self):
+        request = MagicMock(side_effect=NotFoundError(404, 'scroll expired'))
+
+        with self.assertRaises(NotFoundError):
+            RetryPolicy(3, 1.0, sleep=MagicMock()).call(request, repeatable=True)
+
+        self.assertEqual(request.call_count, 1)
+
+    def test_call_reports_each_retry(self):
+        on_retry = MagicMock()
+        request = MagicMock(side_effect=[TransportError(429, 'rejected'), 'page'])
+
+        RetryPolicy(3, 1.0, sleep=MagicMock()).call(request, repeatable=False, on_retry=on_retry)
+
+        on_retry.assert_called_once_with()
+
+
+class AdaptivePageSizeTestCase(unittest.TestCase):
+
+    def test_observe_halves_the_page_size_after_a_slow_or_large_response(self):
+        page_size = AdaptivePageSize(1000, 100, 5000, 1.0, 1000000)
+
+        page_size.observe(2.0, 1000)
+        self.assertEqual(page_size.size, 500)
+
+        page_size.observe(0.1, 2000000)
+        self.assertEqual(page_size.size, 250)
+
+    def test_observe_grows_the_page_size_after_a_fast_and_small_response(self):
+        page_size = AdaptivePageSize(1000, 100, 5000, 1.0, 1000000)
+
+        page_size.observe(0.1, 1000)
+
+        self.assertEqual(page_size.size, 1250)
+
+    def test_observe_keeps_the_page_size_within_its_bounds(self):
+        page_size = AdaptivePageSize(1000, 800, 1100, 1.0, 1000000)
+
+        page_size.observe(0.1, 1000)
+        self.assertEqual(page_size.size, 1100)
+
+        page_size.observe(2.0, 1000)
+        self.assertEqual(page_size.size, 800)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_wait_for_request_spaces_requests_out(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter(max_requests_per_second=4, clock=clock, sleep=clock.sleep)
+
+        for _ in range(0, 3):
+            rate_limiter.wait_for_request()
+
+        self.assertListEqual(clock.sleeps, [0.25, 0.25])
+
+    def test_wait_for_request_holds_requests_back_until_documents_fit_within_the_limit(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter(max_documents_per_second=1000, clock=clock, sleep=clock.sleep)
+
+        rate_limiter.wait_for_request()
+        rate_limiter.record_documents(500)
+        rate_limiter.wait_for_request()
+
+        self.assertListEqual(clock.sleeps, [0.5])
+
+    def test_wait_for_request_does_not_wait_without_limits(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+
+        for _ in range(0, 3):
+            rate_limiter.wait_for_request()
+            rate_limiter.record_documents(1000)
+
+        self.assertListEqual(clock.sleeps, [])
@@ -0,0 +1,141 @@
+import gzip
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import namedtuple
+from email.utils import formatdate
+from serve import SiteMapServer, get_last_modified
+
+ServeConfig = namedtuple('ServeConfig', [
+    'site_map_directory_path', 'site_map_index_filename', 'manifest_filename', 'host', 'port'])
+
+SITE_MAP_CONTENT = b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" />'
+
+
+class SiteMapServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._write_file('site_map_0.xml', SITE_MAP_CONTENT)
+        self._write_file('site_map_1.xml.gz', gzip.compress(SITE_MAP_CONTENT, mtime=0))
+        self._write_file('site_map_index.xml', b'<sitemapindex />')
+        self._write_file('site_map_checkpoint.json', b'{}')
+        self._write_file('site_map_manifest.json', json.dumps({'high_water_mark': None, 'files': [
+            {'name': 'site_map_0.xml', 'url_count': 0, 'digest': 'digest0', 'last_modified': '2015-03-02'},
+            {'name': 'site_map_1.xml.gz', 'url_count': 0, 'digest': 'digest1', 'last_modified': '2015-03-02'},
+        ]}).encode())
+
+        config = ServeConfig(self.directory, 'site_map_index.xml', 'site_map_manifest.json', '127.0.0.1', 0)
+        self.server = SiteMapServer(config)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def _write_file(self, file_name, content):
+        with open(os.path.join(self.directory, file_name), 'wb') as file:
+            file.write(content)
+
+    def _get(self, path, headers=None, method='GET'):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1])
+
+        try:
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+        finally:
+            connection.close()
+
+    def test_site_map_files_are_served_with_the_validators_of_the_manifest(self):
+        response, body = self._get('/site_map_0.xml')
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, SITE_MAP_CONTENT)
+        self.assertEqual(response.getheader('ETag'), '"digest0"')
+        self.assertEqual(response.getheader('Last-Modified'), 'Mon, 02 Mar 2015 00:00:00 GMT')
+        self.assertEqual(response.getheader('Content-Type'), 'application/xml')
+
+    def test_unchanged_files_are_not_sent_again(self):
+        response, body = self._get('/site_map_0.xml', {'If-None-Match': '"digest0"'})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, b'')
+
+        response, body = self._get('/site_map_0.xml', {'If-Modified-Since': 'Tue, 03 Mar 2015 00:00:00 GMT'})
+        self.assertEqual(response.status, 304)
+
+        response, body = self._get('/site_map_0.xml', {'If-None-Match': '"digest-of-an-older-file"'})
+        self.assertEqual(response.status, 200)
+
+    def test_compressed_site_map_files_are_served_as_stored(self):
+        response, body = self._get('/site_map_1.xml.gz', {'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(gzip.decompress(body), SITE_MAP_CONTENT)
+        self.assertEqual(response.getheader('Content-Type'), 'application/gzip')
+        self.assertIsNone(response.getheader('Content-Encoding'))
+
+    def test_compressed_site_map_files_are_sent_with_gzip_encoding_by_their_uncompressed_name(self):
+        response, body = self._get('/site_map_1.xml', {'Accept-Encoding': 'deflate, gzip'})
+
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(response.getheader('ETag'), '"digest1-gzip"')
+        self.assertEqual(gzip.decompress(body), SITE_MAP_CONTENT)
+
+    def test_compressed_site_map_files_are_decompressed_for_clients_that_do_not_accept_gzip(self):
+        response, body = self._get('/site_map_1.xml')
+
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(response.getheader('ETag'), '"digest1"')
+        self.assertEqual(body, SITE_MAP_CONTENT)
+
+    def test_precompressed_variants_of_other_files_are_served_to_clients_that_accept_gzip(self):
+        self._write_file('site_map_index.xml.gz', gzip.compress(b'<sitemapindex />'))
+
+        response, body = self._get('/site_map_index.xml', {'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(body), b'<sitemapindex />')
+
+    def test_index_files_are_served(self):
+        response, body = self._get('/site_map_index.xml')
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, b'<sitemapindex />')
+
+    def test_head_requests_get_the_headers_only(self):
+        response, body = self._get('/site_map_0.xml', method='HEAD')
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Length'), str(len(SITE_MAP_CONTENT)))
+        self.assertEqual(body, b'')
+
+    def test_files_that_are_not_part_of_the_site_map_are_not_served(self):
+        for path in ['/site_map_checkpoint.json', '/site_map_manifest.json', '/../etc/passwd', '/site_map_2.xml']:
+            response, body = self._get(path)
+            self.assertEqual(response.status, 404, path)
+
+    def test_a_replaced_manifest_is_read_again(self):
+        self._get('/site_map_0.xml')
+        self._write_file('site_map_manifest.json', json.dumps({'high_water_mark': None, 'files': [
+            {'name': 'site_map_0.xml', 'url_count': 0, 'digest': 'digest2', 'last_modified': '2015-03-04'},
+        ]}).encode())
+
+        response, body = self._get('/site_map_0.xml')
+
+        self.assertEqual(response.getheader('ETag'), '"digest2"')
+
+
+class GetLastModifiedTestCase(unittest.TestCase):
+
+    def test_get_last_modified_uses_the_modification_time_on_the_day_of_the_manifest(self):
+        self.assertEqual(formatdate(get_last_modified('2015-03-02', 1425300000.5), usegmt=True),
+                         'Mon, 02 Mar 2015 12:40:00 GMT')
+        self.assertEqual(formatdate(get_last_modified('2015-03-02', 1425500000), usegmt=True),
+                         'Mon, 02 Mar 2015 00:00:00 GMT')
@@ -0,0 +1,31 @@
+import unittest
+from sharding import POSTCODE_AREAS, get_shard_areas, get_shard_queries
+
+
+class ShardingTestCase(unittest.TestCase):
+
+    def test_get_shard_areas_assigns_every_area_to_exactly_one_shard(self):
+        shard_areas = get_shard_areas(16)
+
+        self.assertEqual(len(shard_areas), 16)
+        self.assertListEqual(sorted(area for areas in shard_areas for area in areas), sorted(POSTCODE_AREAS))
+
+    def test_get_shard_queries_match_area_letters_followed_by_a_digit(self):
+        shard_queries = get_shard_queries(len(POSTCODE_AREAS), 'postcode')
+
+        self.assertEqual(shard_queries[1], {'regexp': {'postcode': '(AL)[0-9].*'}})
+
+    def test_get_shard_queries_reads_unknown_areas_in_the_first_shard(self):
+        shard_queries = get_shard_queries(2, 'postcode')
+        should = shard_queries[0]['bool']['should']
+
+        self.assertEqual(should[0], {'regexp': {'postcode': '({})[0-9].*'.format('|'.join(POSTCODE_AREAS[0::2]))}})
+        self.assertEqual(
+            should[1],
+            {'bool': {'must_not': [{'regexp': {'postcode': '({})[0-9].*'.format('|'.join(POSTCODE_AREAS))}}]}}
+        )
+
+    def test_get_shard_areas_refuses_more_shards_than_postcode_areas(self):
+        self.assertEqual(len(get_shard_areas(len(POSTCODE_AREAS))), len(POSTCODE_AREAS))
+        self.assertRaises(Exception, get_shard_areas, len(POSTCODE_AREAS) + 1)
+        self.assertRaises(Exception, get_shard_queries, len(POSTCODE_AREAS) + 1, 'postcode')
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from s3 import S3Client
+from sinks import S3Sink, TarArchiveSink
+from test.fake_s3 import FakeS3Server
+
+
+class SinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _create_file(self, file_name, content):
+        file_path = os.path.join(self.directory, file_name)
+
+        with open(file_path, 'wb') as file:
+            file.write(content)
+
+        return file_path
+
+
+class TarArchiveSinkTestCase(SinkTestCase):
+
+    def test_finish_saves_an_archive_of_submitted_and_remaining_files_in_order(self):
+        archive_path = os.path.join(self.directory, 'sitemap.tar')
+        files = [(self._create_file(name, name.encode()), name) for name in ['sitemap_0.xml', 'sitemap_index.xml']]
+
+        with TarArchiveSink(archive_path) as sink:
+            sink.submit(*files[0])
+            self.assertFalse(os.path.exists(archive_path))
+            sink.finish(files)
+
+        with tarfile.open(archive_path) as archive:
+            self.assertListEqual(archive.getnames(), ['sitemap_0.xml', 'sitemap_index.xml'])
+            self.assertEqual(archive.extractfile('sitemap_index.xml').read(), b'sitemap_index.xml')
+
+    def test_an_unfinished_archive_is_removed_on_failure(self):
+        archive_path = os.path.join(self.directory, 'sitemap.tar')
+
+        with self.assertRaises(ValueError):
+            with TarArchiveSink(archive_path) as sink:
+                sink.submit(self._create_file('sitemap_0.xml', b'<urlset />'), 'sitemap_0.xml')
+                raise ValueError()
+
+        self.assertListEqual(os.listdir(self.directory), ['sitemap_0.xml'])
+
+
+class S3SinkTestCase(SinkTestCase):
+
+    def test_finish_uploads_small_files_whole_and_large_files_in_parts(self):
+        large_content = os.urandom(2500)
+        files = [
+            (self._create_file('sitemap_0.xml.gz', large_content), 'sitemap_0.xml.gz'),
+            (self._create_file('sitemap_index.xml', b'<sitemapindex />'), 'sitemap_index.xml'),
+        ]
+
+        with FakeS3Server(min_part_size=1000) as server:
+            client = S3Client(server.url, 'us-east-1', 'key', 'secret')
+
+            with S3Sink(client, 'bucket', 'sitemaps/', 1000, 3) as sink:
+                sink.submit(*files[0])
+                sink.finish(files)
+
+            self.assertEqual(server.objects['bucket/sitemaps/sitemap_0.xml.gz']['body'], large_content)
+            self.assertEqual(server.objects['bucket/sitemaps/sitemap_0.xml.gz']['content_type'], 'application/gzip')
+            self.assertEqual(server.objects['bucket/sitemaps/sitemap_index.xml']['body'], b'<sitemapindex />')
+
+    def test_finish_aborts_the_multipart_upload_of_a_file_that_failed(self):
+        file_path = self._create_file('sitemap_0.xml', os.urandom(2500))
+
+        with FakeS3Server(fail_parts=[2]) as server:
+            client = S3Client(server.url, 'us-east-1', 'key', 'secret')
+
+            with self.assertRaises(Exception):
+                with S3Sink(client, 'bucket', '', 1000, 3) as sink:
+                    sink.finish([(file_path, 'sitemap_0.xml')])
+
+            self.assertListEqual(server.aborted_uploads, ['bucket/sitemap_0.xml'])
+            self.assertDictEqual(server.objects, {})
+            self.assertDictEqual(server.uploads, {})
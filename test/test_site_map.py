@@ -1,13 +1,17 @@
-from io import StringIO
+import json
+from io import BytesIO
 import unittest
 from mock import call, patch
 from site_map import SiteMapCreator
-from models import SiteMapUrl
-import xml
+from models import SiteMapUrl, SiteMapUrlPage
+from xml.etree.ElementTree import fromstring
 import os
 from asq.initiators import query
 from datetime import datetime
 from test import FakeConfig
+import gzip
+import shutil
+import tempfile
 
 CONFIG = FakeConfig(
     base_page_url='n/a',
@@ -33,12 +37,13 @@ def create_site_map_url(index):
         change_frequency='daily',
     )
 
-def get_locations_from_site_map(site_map):
-    site_map_elements = site_map.getroot().getchildren()
+def get_locations_from_site_map(site_map_file):
+    namespace = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+    site_map_elements = list(fromstring(site_map_file.saved_content))
 
     return (
         query(site_map_elements)
-            .select(lambda e: query(e.getchildren()).single(lambda e: e.tag == 'loc'))
+            .select(lambda e: query(list(e)).single(lambda e: e.tag == namespace + 'loc'))
             .select(lambda e: e.text)
             .to_list()
     )
@@ -52,7 +57,7 @@ class SiteMapCreatorTestCase(unittest.TestCase):
     def test_flush_site_map_creates_new_file_when_current_site_map_has_urls(self):
         fake_file = FakeFile()
 
-        with patch('xml.etree.ElementTree.open', create=True) as mock_open:
+        with patch('site_map.open', create=True) as mock_open:
             mock_open.return_value = fake_file
 
             site_map_creator = SiteMapCreator(CONFIG)
@@ -61,17 +66,34 @@ class SiteMapCreatorTestCase(unittest.TestCase):
             site_map_creator.flush_site_map()
 
             expected_file_path = '{}/{}_0.xml'.format(CONFIG.site_map_directory_path, CONFIG.base_site_map_filename)
-            mock_open.assert_called_once_with(
-                expected_file_path, 'w', encoding=CONFIG.file_encoding.lower(), errors='xmlcharrefreplace')
+            mock_open.assert_called_once_with(expected_file_path, 'wb')
             
-            with open('data/sitemap_1_url.xml') as expected_file:
-                self.assertMultiLineEqual(fake_file.saved_content, expected_file.read())
+            with open('data/sitemap_1_url.xml', 'rb') as expected_file:
+                self.assertEqual(fake_file.saved_content, expected_file.read())
+
+    def test_flush_site_map_does_not_create_file_when_current_site_map_is_empty(self):
+        with patch('site_map.open', create=True) as mock_open:
+            SiteMapCreator(CONFIG).flush_site_map()
+            self.assertListEqual(mock_open.mock_calls, [])
+
+    def test_site_map_file_escapes_text_and_encodes_unsupported_characters(self):
+        fake_file = FakeFile()
 
-    @patch.object(xml.etree.ElementTree.ElementTree, 'write')
-    def test_flush_site_map_does_not_create_file_when_current_site_map_is_empty(self, mock_write):
-        mock_write.return_value = lambda self, filename, **kwargs : None
-        SiteMapCreator(CONFIG).flush_site_map()
-        self.assertListEqual(mock_write.mock_calls, [])
+        with patch('site_map.open', create=True) as mock_open:
+            mock_open.return_value = fake_file
+
+            site_map_creator = SiteMapCreator(CONFIG._replace(file_encoding='ascii'))
+            url = SiteMapUrl(location='http://localhost/a&b<c>\u00e9', last_modified='', change_frequency='daily')
+            site_map_creator.append_urls_to_site_map([url])
+            site_map_creator.flush_site_map()
+
+            self.assertEqual(
+                fake_file.saved_content,
+                b"<?xml version='1.0' encoding='ascii'?>\n"
+                b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"><url>'
+                b'<loc>http://localhost/a&amp;b&lt;c&gt;&#233;</loc><lastmod /><changefreq>daily</changefreq>'
+                b'</url></urlset>'
+            )
 
     @patch.object(os, 'listdir')
     @patch.object(os.path, 'isfile')
@@ -117,22 +139,42 @@ class SiteMapCreatorTestCase(unittest.TestCase):
         SiteMapCreator(CONFIG).clear_site_map_directory()
         self.assertListEqual(mock_unlink.mock_calls, [])
 
+    @patch.object(os, 'listdir')
+    @patch.object(os.path, 'isfile')
+    @patch.object(os, 'unlink')
+    def test_clear_site_map_directory_deletes_compressed_site_map_files(self, mock_unlink, mock_isfile, mock_listdir):
+        filename = '{}_7.xml.gz'.format(CONFIG.base_site_map_filename)
+        mock_listdir.return_value = [filename]
+        mock_isfile.return_value = lambda path: True
+
+        SiteMapCreator(CONFIG).clear_site_map_directory()
+
+        mock_unlink.assert_called_once_with('{}/{}'.format(CONFIG.site_map_directory_path, filename))
+
     def test_append_urls_to_site_map_adds_urls_to_current_site_map_when_enough_space(self):
-        max_records_per_file = 10
-        urls_to_append = [create_site_map_url(i) for i in range(0, max_records_per_file - 1)]
+        fake_file = FakeFile()
+
+        with patch('site_map.open', create=True) as mock_open:
+            mock_open.return_value = fake_file
 
-        site_map_creator = SiteMapCreator(CONFIG._replace(max_urls_per_file=max_records_per_file))
-        site_map_creator.append_urls_to_site_map(urls_to_append)
+            max_records_per_file = 10
+            urls_to_append = [create_site_map_url(i) for i in range(0, max_records_per_file - 1)]
 
-        expected_locations = [url.location for url in urls_to_append]
-        actual_locations_in_site_map = get_locations_from_site_map(site_map_creator.current_site_map)
+            site_map_creator = SiteMapCreator(CONFIG._replace(max_urls_per_file=max_records_per_file))
+            site_map_creator.append_urls_to_site_map(urls_to_append)
+
+            self.assertEqual(site_map_creator.site_map_file_names, [])
+            self.assertFalse(fake_file.closed)
+
+            site_map_creator.flush_site_map()
 
-        self.assertListEqual(actual_locations_in_site_map, expected_locations)
+            expected_locations = [url.location for url in urls_to_append]
+            self.assertListEqual(get_locations_from_site_map(fake_file), expected_locations)
                     
     def test_append_urls_to_site_map_saves_site_map_to_file_when_full(self):
         fake_file = FakeFile()
 
-        with patch('xml.etree.ElementTree.open', create=True) as mock_open:
+        with patch('site_map.open', create=True) as mock_open:
             mock_open.return_value = fake_file
             
             max_records_per_file = 3
@@ -140,47 +182,51 @@ class SiteMapCreatorTestCase(unittest.TestCase):
 
             config = CONFIG._replace(max_urls_per_file=max_records_per_file)
             site_map_creator = SiteMapCreator(config)
-            first_site_map = site_map_creator.current_site_map
 
             site_map_creator.append_urls_to_site_map(urls_to_append)
 
-            expected_locations_in_site_map = [url.location for url in urls_to_append]
             expected_saved_file_path = '{}/{}_0.xml'.format(
                 config.site_map_directory_path, config.base_site_map_filename)
 
-            mock_open.assert_called_once_with(
-                expected_saved_file_path, 'w', encoding=config.file_encoding.lower(), errors='xmlcharrefreplace')
+            mock_open.assert_called_once_with(expected_saved_file_path, 'wb')
 
-            with open('data/sitemap_3_urls.xml') as expected_file:
+            with open('data/sitemap_3_urls.xml', 'rb') as expected_file:
                 self.assertEqual(fake_file.saved_content, expected_file.read())
 
-            self.assertListEqual(get_locations_from_site_map(first_site_map), expected_locations_in_site_map)
-            self.assertListEqual(get_locations_from_site_map(site_map_creator.current_site_map), [])
+            self.assertEqual(site_map_creator.site_map_file_names, ['{}_0.xml'.format(config.base_site_map_filename)])
+            self.assertIsNone(site_map_creator.current_site_map)
 
     def test_append_urls_to_site_map_adds_urls_to_non_empty_site_map(self):
-        urls_to_append = [create_site_map_url(i) for i in range(0, 4)]
+        fake_file = FakeFile()
+
+        with patch('site_map.open', create=True) as mock_open:
+            mock_open.return_value = fake_file
+
+            urls_to_append = [create_site_map_url(i) for i in range(0, 4)]
 
-        site_map_creator = SiteMapCreator(CONFIG)
-        site_map_creator.append_urls_to_site_map(urls_to_append[0:1])
-        site_map_creator.append_urls_to_site_map(urls_to_append[1:3])
-        site_map_creator.append_urls_to_site_map(urls_to_append[3:4])
+            site_map_creator = SiteMapCreator(CONFIG)
+            site_map_creator.append_urls_to_site_map(urls_to_append[0:1])
+            site_map_creator.append_urls_to_site_map(urls_to_append[1:3])
+            site_map_creator.append_urls_to_site_map(urls_to_append[3:4])
+            site_map_creator.flush_site_map()
 
-        expected_locations = [url.location for url in urls_to_append]
-        actual_locations_in_site_map = get_locations_from_site_map(site_map_creator.current_site_map)
+            expected_locations = [url.location for url in urls_to_append]
 
-        self.assertListEqual(actual_locations_in_site_map, expected_locations)
+            mock_open.assert_called_once_with(
+                '{}/{}_0.xml'.format(CONFIG.site_map_directory_path, CONFIG.base_site_map_filename), 'wb')
+            self.assertListEqual(get_locations_from_site_map(fake_file), expected_locations)
 
     def test_append_urls_to_site_map_saves_current_site_map_and_uses_new_one_when_not_enough_space(self):
-        fake_file = FakeFile()
+        first_fake_file = FakeFile()
+        second_fake_file = FakeFile()
 
-        with patch('xml.etree.ElementTree.open', create=True) as mock_open:
-            mock_open.return_value = fake_file
+        with patch('site_map.open', create=True) as mock_open:
+            mock_open.side_effect = [first_fake_file, second_fake_file]
 
             max_records_per_file = 2
             urls_to_append = [create_site_map_url(i) for i in range(0, max_records_per_file + 1)]
             config = CONFIG._replace(max_urls_per_file=max_records_per_file)
             site_map_creator = SiteMapCreator(config)
-            first_site_map = site_map_creator.current_site_map
 
             site_map_creator.append_urls_to_site_map(urls_to_append)
 
@@ -189,25 +235,26 @@ class SiteMapCreatorTestCase(unittest.TestCase):
             expected_saved_file_path = '{}/{}_0.xml'.format(
                 config.site_map_directory_path, config.base_site_map_filename)
 
-            mock_open.assert_called_once_with(
-                expected_saved_file_path, 'w', encoding=config.file_encoding.lower(), errors='xmlcharrefreplace')
+            self.assertEqual(site_map_creator.site_map_file_names, ['{}_0.xml'.format(config.base_site_map_filename)])
+            self.assertEqual(mock_open.mock_calls[0], call(expected_saved_file_path, 'wb'))
+            self.assertListEqual(get_locations_from_site_map(first_fake_file), expected_locations_in_first_site_map)
+
+            site_map_creator.flush_site_map()
 
-            self.assertListEqual(get_locations_from_site_map(first_site_map), expected_locations_in_first_site_map)
             self.assertListEqual(
-                get_locations_from_site_map(site_map_creator.current_site_map), 
+                get_locations_from_site_map(second_fake_file),
                 expected_locations_in_second_site_map
             )
 
     def test_create_site_map_index_file_creates_index_file_referencing_all_site_map_files(self):
-        fake_site_map_file_1 = FakeFile()
-        fake_site_map_file_2 = FakeFile()
         fake_site_map_index_file = FakeFile()
 
-        with patch('xml.etree.ElementTree.open', create=True) as mock_open:
-            mock_open.side_effect = [fake_site_map_file_1, fake_site_map_file_2, fake_site_map_index_file]
+        with patch('site_map.open', create=True) as mock_open:
+            mock_open.side_effect = [FakeFile(), FakeFile(), fake_site_map_index_file]
 
             max_records_per_file = 2
             urls_to_append = [create_site_map_url(i) for i in range(0, max_records_per_file + 1)]
+            urls_to_append[1] = urls_to_append[1]._replace(last_modified='2015-03-04')
             config = CONFIG._replace(max_urls_per_file=max_records_per_file)
             site_map_creator = SiteMapCreator(config)
 
@@ -219,30 +266,227 @@ class SiteMapCreatorTestCase(unittest.TestCase):
                 config.site_map_directory_path, config.base_site_map_filename, i) for i in range(0, 2)]
             site_map_index_file_path = '{}/{}'.format(config.site_map_directory_path, config.site_map_index_filename)
 
-            standard_args = { 'encoding': config.file_encoding.lower(), 'errors': 'xmlcharrefreplace'}
-
             expected_file_open_calls = [
-                call(site_map_file_paths[0], 'w', **standard_args),
-                call(site_map_file_paths[1], 'w', **standard_args),
-                call(site_map_index_file_path, 'w', **standard_args),
+                call(site_map_file_paths[0], 'wb'),
+                call(site_map_file_paths[1], 'wb'),
+                call(site_map_index_file_path, 'wb'),
             ]
 
             mock_open.assert_has_calls(expected_file_open_calls, any_order=False)
             
             with (open('data/sitemap_index_for_2_sitemaps.xml')) as expected_index:
-                expected_content = expected_index.read().replace(
-                    '<lastmod>2015-03-05</lastmod>', '<lastmod>{0:%Y-%m-%d}</lastmod>'.format(datetime.now()))
-                self.assertSequenceEqual(fake_site_map_index_file.saved_content, expected_content)
+                self.assertSequenceEqual(fake_site_map_index_file.saved_content.decode('utf-8'), expected_index.read())
+
+    def test_create_site_map_index_file_creates_empty_index_when_there_are_no_site_map_files(self):
+        fake_site_map_index_file = FakeFile()
+
+        with patch('site_map.open', create=True) as mock_open:
+            mock_open.return_value = fake_site_map_index_file
+            SiteMapCreator(CONFIG).create_site_map_index_file()
+
+            self.assertEqual(
+                fake_site_map_index_file.saved_content,
+                b"<?xml version='1.0' encoding='utf-8'?>\n"
+                b'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" />'
+            )
+
+
+    def test_compressed_site_map_files_are_referenced_by_the_index(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            config = CONFIG._replace(site_map_directory_path=directory, max_urls_per_file=3, compress_output=True)
+            site_map_creator = SiteMapCreator(config)
+            site_map_creator.append_urls_to_site_map([create_site_map_url(i) for i in range(0, 4)])
+            site_map_creator.flush_site_map()
+            site_map_creator.create_site_map_index_file()
+
+            self.assertListEqual(sorted(os.listdir(directory)), ['sitemap_0.xml.gz', 'sitemap_1.xml.gz', 'sitemap_index.xml'])
+
+            with gzip.open(os.path.join(directory, 'sitemap_0.xml.gz')) as compressed_file, \
+                    open('data/sitemap_3_urls.xml', 'rb') as expected_file:
+                self.assertEqual(compressed_file.read(), expected_file.read())
+
+            with open(os.path.join(directory, 'sitemap_index.xml'), 'rt') as index_file:
+                self.assertIn('<loc>{}/sitemap_1.xml.gz</loc>'.format(config.site_map_directory_url), index_file.read())
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_finished_site_map_files_go_to_the_sink_with_the_index_and_manifest_last(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            sink = RecordingSink()
+            config = CONFIG._replace(site_map_directory_path=directory, max_urls_per_file=3, compress_output=True)
+            site_map_creator = SiteMapCreator(config, sink=sink)
+            site_map_creator.append_urls_to_site_map([create_site_map_url(i) for i in range(0, 4)])
+            site_map_creator.flush_site_map()
+            site_map_creator.wait_for_compressed_files()
 
+            self.assertListEqual(sorted(sink.submitted_file_names), ['sitemap_0.xml.gz', 'sitemap_1.xml.gz'])
 
-class FakeFile(StringIO):
+            site_map_creator.create_site_map_index_file()
+            site_map_creator.save_manifest()
+            site_map_creator.finish_sink()
+
+            self.assertListEqual(
+                [file_name for file_path, file_name in sink.finished_files],
+                ['sitemap_0.xml.gz', 'sitemap_1.xml.gz', 'sitemap_index.xml', 'site_map_manifest.json'])
+            self.assertTrue(all(os.path.isfile(file_path) for file_path, file_name in sink.finished_files))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_append_urls_to_site_map_starts_new_file_when_the_current_one_reaches_max_bytes_per_file(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            config = CONFIG._replace(site_map_directory_path=directory, max_urls_per_file=10, max_bytes_per_file=400)
+            site_map_creator = SiteMapCreator(config)
+            site_map_creator.append_urls_to_site_map([create_site_map_url(i) for i in range(0, 5)])
+            site_map_creator.flush_site_map()
+
+            self.assertGreater(len(site_map_creator.site_map_files), 1)
+            self.assertEqual(sum(site_map_file['url_count'] for site_map_file in site_map_creator.site_map_files), 5)
+
+            for site_map_file in site_map_creator.site_map_files:
+                self.assertLessEqual(os.path.getsize(os.path.join(directory, site_map_file['name'])), 400)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_site_map_files_with_unchanged_content_are_left_untouched_when_skipping_unchanged_files(self):
+        directory = tempfile.mkdtemp()
+
+        def generate(urls):
+            site_map_creator = SiteMapCreator(config)
+            site_map_creator.load_previous_site_map_files()
+            site_map_creator.clear_site_map_directory()
+            site_map_creator.append_urls_to_site_map(urls)
+            site_map_creator.flush_site_map()
+            site_map_creator.remove_stale_site_map_files()
+            site_map_creator.create_site_map_index_file()
+            site_map_creator.save_manifest()
+            return site_map_creator
+
+        try:
+            config = CONFIG._replace(site_map_directory_path=directory, max_urls_per_file=2, skip_unchanged_files=True)
+            generate([create_site_map_url(i) for i in range(0, 5)])
+            previous_stat = os.stat(os.path.join(directory, 'sitemap_0.xml'))
+
+            with open(os.path.join(directory, 'site_map_manifest.json')) as manifest_file:
+                manifest = json.load(manifest_file)
+            for site_map_file in manifest['files']:
+                site_map_file['last_modified'] = '2015-03-01'
+            with open(os.path.join(directory, 'site_map_manifest.json'), 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+
+            site_map_creator = generate([create_site_map_url(i) for i in [0, 1, 2, 9]])
+            stat = os.stat(os.path.join(directory, 'sitemap_0.xml'))
+
+            self.assertEqual((stat.st_ino, stat.st_mtime_ns), (previous_stat.st_ino, previous_stat.st_mtime_ns))
+            self.assertListEqual(
+                [site_map_file['last_modified'] for site_map_file in site_map_creator.site_map_files],
+                ['2015-03-01', '{0:%Y-%m-%d}'.format(datetime.now())])
+            self.assertListEqual(
+                sorted(os.listdir(directory)),
+                ['site_map_manifest.json', 'sitemap_0.xml', 'sitemap_1.xml', 'sitemap_index.xml'])
+
+            with open(os.path.join(directory, 'sitemap_1.xml')) as site_map_file:
+                self.assertIn('TEST_PROPERTY_9', site_map_file.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_create_site_map_index_file_lists_child_indexes_when_there_are_too_many_site_map_files(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            config = CONFIG._replace(site_map_directory_path=directory, max_urls_per_file=1, max_site_maps_per_index=2)
+            site_map_creator = SiteMapCreator(config)
+            site_map_creator.append_urls_to_site_map([create_site_map_url(i) for i in range(0, 5)])
+            site_map_creator.flush_site_map()
+            site_map_creator.create_site_map_index_file()
+
+            self.assertListEqual(
+                sorted(name for name in os.listdir(directory) if name.startswith('sitemap_index')),
+                ['sitemap_index.xml', 'sitemap_index_0.xml', 'sitemap_index_1.xml', 'sitemap_index_2.xml'])
+
+            with open(os.path.join(directory, 'sitemap_index.xml'), 'rt') as index_file:
+                index = index_file.read()
+            with open(os.path.join(directory, 'sitemap_index_2.xml'), 'rt') as child_index_file:
+                child_index = child_index_file.read()
+
+            self.assertIn('<loc>{}/sitemap_index_1.xml</loc>'.format(config.site_map_directory_url), index)
+            self.assertNotIn('sitemap_0.xml', index)
+            self.assertIn('<loc>{}/sitemap_4.xml</loc>'.format(config.site_map_directory_url), child_index)
+            self.assertEqual(child_index.count('<sitemap>'), 1)
+
+            site_map_creator.clear_site_map_directory()
+
+            self.assertListEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_append_urls_to_site_map_saves_checkpoint_with_cursor_of_last_url_in_completed_files(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            config = CONFIG._replace(site_map_directory_path=directory, max_urls_per_file=2, checkpoint_interval=2)
+            urls = [create_site_map_url(i)._replace(cursor=['KEY_{}'.format(i)]) for i in range(0, 5)]
+
+            site_map_creator = SiteMapCreator(config)
+            site_map_creator.append_urls_to_site_map(urls[0:3])
+
+            self.assertIsNone(site_map_creator.load_checkpoint())
+
+            site_map_creator.append_urls_to_site_map(urls[3:5])
+
+            resumed_site_map_creator = SiteMapCreator(config)
+            checkpoint = resumed_site_map_creator.load_checkpoint()
+
+            self.assertEqual(checkpoint.cursor, ['KEY_3'])
+            self.assertListEqual(resumed_site_map_creator.site_map_file_names, ['sitemap_0.xml', 'sitemap_1.xml'])
+            self.assertEqual(resumed_site_map_creator.current_file_number, 2)
+
+            site_map_creator.remove_checkpoint()
+            self.assertIsNone(SiteMapCreator(config).load_checkpoint())
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_append_urls_to_site_map_splits_url_pages_across_files(self):
+        first_fake_file = FakeFile()
+        second_fake_file = FakeFile()
+
+        with patch('site_map.open', create=True) as mock_open:
+            mock_open.side_effect = [first_fake_file, second_fake_file]
+
+            urls = [create_site_map_url(i) for i in range(0, 3)]
+            page = SiteMapUrlPage([url.location for url in urls], [url.last_modified for url in urls], 'daily')
+
+            site_map_creator = SiteMapCreator(CONFIG._replace(max_urls_per_file=2))
+            site_map_creator.append_urls_to_site_map(page)
+            site_map_creator.flush_site_map()
+
+            self.assertListEqual(get_locations_from_site_map(first_fake_file), [url.location for url in urls[0:2]])
+            self.assertListEqual(get_locations_from_site_map(second_fake_file), [urls[2].location])
+
+
+class RecordingSink():
+
+    def __init__(self):
+        self.submitted_file_names = []
+        self.finished_files = None
+
+    def submit(self, file_path, file_name):
+        self.submitted_file_names.append(file_name)
+
+    def finish(self, files):
+        self.finished_files = files
+
+
+class FakeFile(BytesIO):
     def close(self, *args, **kwargs):
         self.saved_content = self.getvalue()
         super(FakeFile, self).close(*args, **kwargs)
-    
-    def __enter__(self):
-        return self
-    
-    def __exit__(self, *args, **kwargs):
-        self.saved_content = self.getvalue()
-        super(FakeFile, self).__exit__(*args, **kwargs)
@@ -0,0 +1,95 @@
+from io import BytesIO
+import unittest
+from site_map_writer import SiteMapWriter
+from models import SiteMapUrlPage
+
+
+def create_file():
+    file = BytesIO()
+    file.close = lambda: None
+    return file
+
+
+class SiteMapWriterTestCase(unittest.TestCase):
+
+    def test_write_url_counts_entries(self):
+        writer = SiteMapWriter(BytesIO(), 'UTF-8')
+        writer.write_url('http://localhost/1', '2015-03-02', 'daily')
+        writer.write_url('http://localhost/2', '2015-03-02', 'daily')
+
+        self.assertEqual(writer.nof_entries, 2)
+
+    def test_close_writes_empty_document_as_empty_element(self):
+        file = BytesIO()
+        file.close = lambda: None
+
+        SiteMapWriter(file, 'UTF-8').close()
+
+        self.assertEqual(
+            file.getvalue(),
+            b"<?xml version='1.0' encoding='utf-8'?>\n"
+            b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" />'
+        )
+
+    def test_write_site_map_writes_index_entry(self):
+        file = BytesIO()
+        file.close = lambda: None
+
+        writer = SiteMapWriter(file, 'UTF-8', root_tag='sitemapindex')
+        writer.write_site_map('http://localhost/site_map_0.xml', '2015-03-05')
+        writer.close()
+
+        self.assertEqual(
+            file.getvalue(),
+            b"<?xml version='1.0' encoding='utf-8'?>\n"
+            b'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"><sitemap>'
+            b'<loc>http://localhost/site_map_0.xml</loc><lastmod>2015-03-05</lastmod>'
+            b'</sitemap></sitemapindex>'
+        )
+
+    def test_write_url_page_writes_the_same_content_as_writing_urls_one_by_one(self):
+        locations = ['http://localhost/b&1', 'http://localhost/a', 'http://localhost/c']
+        last_modified = ['2015-03-02T10:00+00:00', '2015-03-04T10:00+00:00', '']
+
+        page_file = create_file()
+        page_writer = SiteMapWriter(page_file, 'UTF-8')
+        page_writer.write_url_page(SiteMapUrlPage(locations[0:1], last_modified[0:1], 'daily'))
+        page_writer.write_url_page(SiteMapUrlPage(locations[1:], last_modified[1:], 'daily'))
+        page_writer.close()
+
+        url_file = create_file()
+        url_writer = SiteMapWriter(url_file, 'UTF-8')
+
+        for location, url_last_modified in zip(locations, last_modified):
+            url_writer.write_url(location, url_last_modified, 'daily')
+
+        url_writer.close()
+
+        self.assertEqual(page_file.getvalue(), url_file.getvalue())
+        self.assertEqual(page_writer.nof_entries, 3)
+        self.assertEqual(page_writer.min_location, 'http://localhost/a')
+        self.assertEqual(page_writer.max_location, 'http://localhost/c')
+        self.assertEqual(page_writer.max_last_modified, '2015-03-04T10:00+00:00')
+
+    def test_write_url_page_only_writes_urls_that_keep_the_closed_document_within_max_bytes(self):
+        file = create_file()
+        header_length = len(SiteMapWriter(create_file(), 'UTF-8').file.getvalue())
+        url_length = len(b'<url><loc>http://localhost/1</loc><lastmod>2015-03-02</lastmod><changefreq>daily</changefreq></url>')
+        max_bytes = header_length + len(b'>') + 2 * url_length + len(b'</urlset>')
+
+        writer = SiteMapWriter(file, 'UTF-8', max_bytes=max_bytes)
+        nof_written_urls = writer.write_url_page(SiteMapUrlPage(
+            ['http://localhost/1', 'http://localhost/2', 'http://localhost/3'], ['2015-03-02'] * 3, 'daily'))
+        writer.close()
+
+        self.assertEqual(nof_written_urls, 2)
+        self.assertEqual(writer.max_location, 'http://localhost/2')
+        self.assertEqual(len(file.getvalue()), max_bytes)
+        self.assertFalse(writer.write_url('http://localhost/3', '2015-03-02', 'daily'))
+
+    def test_write_url_always_writes_the_first_url_of_a_document(self):
+        writer = SiteMapWriter(create_file(), 'UTF-8', max_bytes=10)
+
+        self.assertTrue(writer.write_url('http://localhost/1', '2015-03-02', 'daily'))
+        self.assertFalse(writer.write_url('http://localhost/2', '2015-03-02', 'daily'))
+        self.assertEqual(writer.nof_entries, 1)
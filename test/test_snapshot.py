@@ -0,0 +1,152 @@
+import unittest
+import elasticsearch
+import json
+import os
+import shutil
+import tempfile
+from mock import patch
+from elasticsearch_scan import ElasticsearchClient
+from snapshot import SnapshotClient, create_query_matcher
+from test import FakeConfig
+
+CONFIG = FakeConfig(
+    base_page_url='http://localhost:1234',
+    elasticsearch_url=None,
+    site_map_directory_path='n/a',
+    site_map_directory_url='n/a',
+    page_size=2,
+    url_change_frequency='daily',
+    scroll_expiry='5m',
+    request_timeout=123,
+    base_site_map_filename='n/a',
+    site_map_index_filename='n/a',
+    max_urls_per_file='n/a',
+    file_encoding='n/a',
+    es_doc_type='property',
+    es_index='landregistry',
+)
+
+def create_source(postcode, address_key, entry_datetime='2014-06-07T09:01:38+00'):
+    return {
+        'entryDatetime': entry_datetime,
+        'postcode': postcode,
+        'addressKey': '{}_{}'.format(address_key, postcode.replace(' ', '_')),
+    }
+
+def get_address_segments(site_map_entries):
+    return [entry.location.split('/')[-1] for entry in site_map_entries]
+
+
+class SnapshotClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot_file_path = os.path.join(self.directory, 'snapshot.ndjson')
+        self.config = CONFIG._replace(snapshot_file_path=self.snapshot_file_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_snapshot(self, documents):
+        with open(self.snapshot_file_path, 'w') as file:
+            file.writelines('{}\n'.format(json.dumps(document)) for document in documents)
+
+    def read_all_pages(self, client):
+        pages = []
+
+        with client:
+            site_map_entries = client.next_page_of_records()
+
+            while site_map_entries:
+                pages.append(get_address_segments(site_map_entries))
+                site_map_entries = client.next_page_of_records()
+
+        return pages
+
+    def test_next_page_of_records_reads_pages_of_hits(self):
+        self.write_snapshot([{'_source': create_source('EX2 4RQ', key)} for key in ['1', '2', '3']])
+
+        pages = self.read_all_pages(SnapshotClient(self.config))
+
+        self.assertEqual(pages, [['1', '2'], ['3']])
+
+    def test_next_page_of_records_skips_the_action_lines_of_a_bulk_export(self):
+        self.write_snapshot([
+            {'index': {'_index': 'landregistry', '_type': 'property', '_id': '1'}},
+            create_source('EX2 4RQ', '1'),
+            {'index': {'_index': 'landregistry', '_type': 'property', '_id': '2'}},
+            create_source('EX2 4RQ', '2'),
+        ])
+
+        pages = self.read_all_pages(SnapshotClient(self.config))
+
+        self.assertEqual(pages, [['1', '2']])
+
+    def test_next_page_of_records_returns_no_records_for_an_empty_snapshot(self):
+        self.write_snapshot([])
+
+        self.assertEqual(self.read_all_pages(SnapshotClient(self.config)), [])
+
+    def test_next_page_of_records_only_returns_records_matching_the_query(self):
+        self.write_snapshot([
+            {'_source': create_source('EX2 4RQ', '1', '2014-06-07T09:01:38+00')},
+            {'_source': create_source('EX2 4RQ', '2', '2016-01-01T00:00:00+00')},
+            {'_source': create_source('EX2 4RQ', '3', '2013-01-01T00:00:00+00')},
+            {'_source': create_source('EX2 4RQ', '4', '2017-01-01T00:00:00+00')},
+        ])
+
+        client = SnapshotClient(self.config, query={'range': {'entryDatetime': {'gt': '2014-06-07T09:01:38+00'}}})
+
+        self.assertEqual(self.read_all_pages(client), [['2', '4']])
+
+    def test_next_page_of_records_starts_after_the_given_cursor_when_sorting(self):
+        self.write_snapshot([{'_source': create_source('EX2 4RQ', key)} for key in ['1', '2', '3']])
+
+        client = SnapshotClient(self.config, sort=True, search_after=['EX2 4RQ', '1_EX2_4RQ'])
+
+        with client:
+            site_map_entries = client.next_page_of_records()
+
+        self.assertEqual(get_address_segments(site_map_entries), ['2', '3'])
+        self.assertEqual(site_map_entries[-1].cursor, ['EX2 4RQ', '3_EX2_4RQ'])
+
+    def test_next_page_of_records_rejects_an_unsorted_snapshot_when_sorting(self):
+        self.write_snapshot([{'_source': create_source('EX2 4RQ', key)} for key in ['2', '1']])
+
+        with SnapshotClient(self.config, sort=True) as client:
+            self.assertRaises(Exception, client.next_page_of_records)
+
+    @patch.object(elasticsearch.Elasticsearch, 'search')
+    def test_recorded_pages_are_replayed_from_the_snapshot(self, mock_search):
+        hits = [
+            {'_source': create_source('EX2 4RQ', key), 'sort': ['EX2 4RQ', '{}_EX2_4RQ'.format(key)]}
+            for key in ['1', '2', '3']
+        ]
+        mock_search.side_effect = [
+            {'hits': {'hits': hits[:2]}},
+            {'hits': {'hits': hits[2:]}},
+            {'hits': {'hits': []}},
+        ]
+        record_config = self.config._replace(
+            elasticsearch_url='http://localhost:4321/es', snapshot_file_path=None, record_file_path=self.snapshot_file_path)
+
+        recorded_pages = self.read_all_pages(ElasticsearchClient(record_config, sort=True))
+        replayed_pages = self.read_all_pages(SnapshotClient(self.config, sort=True))
+
+        self.assertEqual(replayed_pages, recorded_pages)
+
+
+class QueryMatcherTestCase(unittest.TestCase):
+
+    def test_create_query_matcher_matches_shard_postcodes(self):
+        matches = create_query_matcher({'bool': {
+            'must': [{'regexp': {'postcode': 'EX.*'}}],
+            'must_not': [{'regexp': {'postcode': 'EX2.*'}}],
+        }})
+
+        self.assertTrue(matches({'postcode': 'EX1 1AA'}))
+        self.assertFalse(matches({'postcode': 'EX2 4RQ'}))
+        self.assertFalse(matches({'postcode': 'PL1 1AA'}))
+
+    def test_create_query_matcher_rejects_unsupported_queries(self):
+        self.assertRaises(Exception, create_query_matcher, {'match': {'postcode': 'EX2 4RQ'}})